@@ -0,0 +1,109 @@
+"""
+Compares two benchmark result files written by benchmarks.run.
+
+    python -m benchmarks.compare baseline.json results.json --fail-above 10
+
+Prints the relative change of every metric found in both files. Metrics
+ending in _s, _bytes, requests or file_reads are better when lower, the
+throughput metrics (_mb_s, _per_s) when higher. With --fail-above, exits
+with status 1 if any metric regressed by more than that many percent.
+"""
+import sys
+import json
+import argparse
+
+HIGHER_IS_BETTER = ("_mb_s", "_per_s")
+LOWER_IS_BETTER = ("_s", "_bytes", "requests", "file_reads", "get_config", "misses")
+# Metrics describing the workload, not the client.
+IGNORED = ("input_bytes", "instances", "runs")
+
+
+def _direction(metric):
+    """ Returns 1 if higher values are better, -1 if lower, 0 if unknown. """
+    if metric in IGNORED:
+        return 0
+    if metric.endswith(HIGHER_IS_BETTER):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def compare(baseline, results):
+    """
+    Returns (name, metric, before, after, change percent, regressed percent)
+    rows for the metrics found in both results. The regression is the change
+    in the direction that is worse for the metric, positive if it got worse.
+    """
+    rows = []
+    for name in sorted(set(baseline["results"]) & set(results["results"])):
+        before_metrics = baseline["results"][name]
+        after_metrics = results["results"][name]
+        for metric in sorted(set(before_metrics) & set(after_metrics)):
+            before, after = before_metrics[metric], after_metrics[metric]
+            direction = _direction(metric)
+            if not direction or not isinstance(before, (int, float)):
+                continue
+            if before == 0:
+                change = 0.0 if after == 0 else float("inf")
+            else:
+                change = (after - before) / abs(before) * 100
+            rows.append((name, metric, before, after, change, -direction * change))
+    return rows
+
+
+def main(argv=None):
+    """ Prints the comparison and returns the exit status. """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("results")
+    parser.add_argument(
+        "--fail-above",
+        type=float,
+        help="fail if a metric regressed by more than this many percent",
+    )
+    args = parser.parse_args(argv)
+    with open(args.baseline) as fin:
+        baseline = json.load(fin)
+    with open(args.results) as fin:
+        results = json.load(fin)
+
+    print(
+        "{} ({}) -> {} ({})".format(
+            args.baseline,
+            baseline.get("git_revision"),
+            args.results,
+            results.get("git_revision"),
+        )
+    )
+    if baseline.get("settings") != results.get("settings"):
+        print(
+            "Warning: the results were run with different settings.", file=sys.stderr
+        )
+    regressed = []
+    rows = compare(baseline, results)
+    for name, metric, before, after, change, regression in rows:
+        print(
+            "{:<56} {:>14.6g} {:>14.6g} {:>+8.1f}%{}".format(
+                name + "." + metric,
+                before,
+                after,
+                change,
+                " worse" if regression > 0 else "",
+            )
+        )
+        if args.fail_above is not None and regression > args.fail_above:
+            regressed.append(name + "." + metric)
+    if regressed:
+        print(
+            "Regressed by more than {}%: {}".format(
+                args.fail_above, ", ".join(regressed)
+            ),
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+A local stand-in for the EasyTensor API, used by the benchmarks.
+
+It implements the endpoints the client talks to:
+    POST /v1/dj-rest-auth/login/            login
+    POST /v1/dj-rest-auth/token/refresh/    token refresh
+    POST /v1/model-uploads/                 single and multipart upload URLs
+    POST /v1/model-uploads/lookup/          content hash lookup
+    POST /v1/models/                        model registration
+    POST /v1/query-access-token/            query token creation
+    POST /query/                            predictions (echoes sums), in
+                                            json, base64 or tensor frames
+    PUT  /sink/...                          the upload sink
+    POST /complete/...                      multipart completion
+
+Uploaded bytes are counted and discarded, so the sink never holds an
+archive in memory. Every request is counted per endpoint. Content hashes
+become known to the lookup once their upload completed. The tests inject
+server errors into part uploads with FakeState.fail_parts, and into queries
+with FakeState.fail_queries.
+"""
+import json
+import time
+import uuid
+import base64
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TOKEN_LIFETIME = 60 * 60
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def make_jwt(expires_at, issued_at=None):
+    """
+    Returns an unsigned JWT expiring at the passed unix timestamp, with an
+    `iat` claim if issued_at is passed.
+    """
+
+    def encode(obj):
+        raw = json.dumps(obj).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+    header = encode({"alg": "none", "typ": "JWT"})
+    claims = {"exp": int(expires_at)}
+    if issued_at is not None:
+        claims["iat"] = int(issued_at)
+    return "{}.{}.".format(header, encode(claims))
+
+
+def _total(values):
+    """ Returns the sum of a nested list of numbers. """
+    return sum(_total(value) if isinstance(value, list) else value for value in values)
+
+
+class FakeState:
+    """ What the fake server has seen, shared by its handler threads. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.bytes_received = 0
+        self.hashes = {}
+        self.pending_hashes = {}
+        self.models = []
+        self.latency = 0.0
+        # part number -> number of upload attempts to answer with a 500.
+        self.fail_parts = collections.Counter()
+        # part number -> number of upload attempts received.
+        self.part_uploads = collections.Counter()
+        # statuses the next query requests are answered with, in order.
+        self.fail_queries = collections.deque()
+        # the number of instances of every query request, in arrival order.
+        self.query_sizes = []
+
+    def count(self, endpoint, received=0):
+        """ Counts a request to the endpoint and the bytes it carried. """
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.bytes_received += received
+
+    def reset(self):
+        """ Clears the counters, keeping the known uploads. """
+        with self.lock:
+            self.requests.clear()
+            self.bytes_received = 0
+            self.fail_parts.clear()
+            self.part_uploads.clear()
+            self.fail_queries.clear()
+            self.query_sizes = []
+
+    def complete(self, address):
+        """ Makes the content hash of a finished upload known to the lookup. """
+        with self.lock:
+            content_hash = self.pending_hashes.pop(address, None)
+            if content_hash is not None:
+                self.hashes[content_hash] = address
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately, Nagle's algorithm and
+    # delayed ACKs would hold the body back for about 40ms on every call.
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def _consume(self):
+        """ Reads the request body in chunks, returning it unless discarded. """
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            return self._consume_chunked()
+        remaining = int(self.headers.get("Content-Length", 0))
+        total = remaining
+        keep = [] if not self.path.startswith("/sink/") else None
+        while remaining:
+            chunk = self.rfile.read(min(remaining, READ_CHUNK_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if keep is not None:
+                keep.append(chunk)
+        return total, b"".join(keep or [])
+
+    def _consume_chunked(self):
+        total = 0
+        keep = [] if not self.path.startswith("/sink/") else None
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return total, b"".join(keep or [])
+            while size:
+                chunk = self.rfile.read(min(size, READ_CHUNK_SIZE))
+                size -= len(chunk)
+                total += len(chunk)
+                if keep is not None:
+                    keep.append(chunk)
+            self.rfile.readline()
+
+    def _send(self, obj, code=200, headers=()):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _base(self):
+        return "http://{}:{}".format(*self.server.server_address[:2])
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Dispatches the API calls. """
+        size, body = self._consume()
+        state = self.state
+        if state.latency:
+            time.sleep(state.latency)
+        path = self.path
+        if path.startswith("/complete/"):
+            state.count("complete", size)
+            state.complete(path[len("/complete/") :])
+            return self._send({})
+        state.count(path, size)
+        if path == "/query/":
+            with state.lock:
+                status = state.fail_queries.popleft() if state.fail_queries else None
+            if status is not None:
+                return self._send({"detail": "Injected failure."}, status)
+            return self._query(body)
+        request = json.loads(body or b"{}")
+        if path == "/v1/dj-rest-auth/login/":
+            return self._send(
+                {
+                    "access_token": make_jwt(time.time() + TOKEN_LIFETIME),
+                    "refresh_token": str(uuid.uuid4()),
+                }
+            )
+        if path == "/v1/dj-rest-auth/token/refresh/":
+            return self._send({"access": make_jwt(time.time() + TOKEN_LIFETIME)})
+        if path == "/v1/model-uploads/":
+            return self._send(self._upload_urls(request))
+        if path == "/v1/model-uploads/lookup/":
+            with state.lock:
+                address = state.hashes.get(request.get("hash"))
+            return self._send({"exists": address is not None, "address": address})
+        if path == "/v1/models/":
+            with state.lock:
+                state.models.append(request)
+                model_id = str(len(state.models))
+            return self._send({"id": model_id})
+        if path == "/v1/query-access-token/":
+            return self._send({"id": str(uuid.uuid4())})
+        return self._send({"detail": "Not found."}, 404)
+
+    def _query(self, body):
+        """
+        Answers with the sum of every instance, in the encoding of the
+        request: a tensor frame for frames, json lists otherwise.
+        """
+        # pylint: disable=import-outside-toplevel
+        from easytensor.encoding import (
+            FRAME_CONTENT_TYPE,
+            decode_base64,
+            decode_frame,
+            encode_frame,
+        )
+
+        if self.headers.get("Content-Type", "").startswith(FRAME_CONTENT_TYPE):
+            arrays = decode_frame(body)
+            self._count_instances(len(arrays))
+            frame = encode_frame([array.sum().reshape(1) for array in arrays])
+            data = b"".join(iter(frame.read, b""))
+            self.send_response(200)
+            self.send_header("Content-Type", FRAME_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return None
+        predictions = []
+        instances = json.loads(body or b"{}").get("instances", [])
+        self._count_instances(len(instances))
+        for instance in instances:
+            if isinstance(instance, dict) and "b64" in instance:
+                instance = decode_base64(instance).reshape(-1).tolist()
+            predictions.append(
+                [_total(instance)] if isinstance(instance, list) else instance
+            )
+        return self._send({"predictions": predictions})
+
+    def _count_instances(self, count):
+        with self.state.lock:
+            self.state.query_sizes.append(count)
+
+    def _upload_urls(self, request):
+        address = request["filename"]
+        if request.get("contentHash"):
+            with self.state.lock:
+                self.state.pending_hashes[address] = request["contentHash"]
+        sink = self._base() + "/sink/" + address
+        if "parts" not in request:
+            return {"url": sink, "method": "PUT"}
+        return {
+            "uploadId": request.get("uploadId") or str(uuid.uuid4()),
+            "parts": [
+                {
+                    "partNumber": number,
+                    "url": "{}/{}".format(sink, number),
+                    "method": "PUT",
+                }
+                for number in range(1, request["parts"] + 1)
+            ],
+            "completeUrl": self._base() + "/complete/" + address,
+            "completeMethod": "POST",
+        }
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """ The upload sink. """
+        size, _ = self._consume()
+        state = self.state
+        state.count("sink", size)
+        address, _, part = self.path[len("/sink/") :].partition("/")
+        if not part:
+            state.complete(address)
+            return self._send({}, headers=[("ETag", '"{}"'.format(uuid.uuid4().hex))])
+        with state.lock:
+            state.part_uploads[int(part)] += 1
+            failing = state.fail_parts[int(part)] > 0
+            if failing:
+                state.fail_parts[int(part)] -= 1
+        if failing:
+            return self._send({"detail": "Injected failure."}, 500)
+        return self._send({}, headers=[("ETag", '"{}"'.format(uuid.uuid4().hex))])
+
+
+class FakeServer:
+    """
+    A fake EasyTensor API server running in a background thread.
+    latency: seconds added to every API call (not to uploads).
+    """
+
+    def __init__(self, latency=0.0):
+        self.state = FakeState()
+        self.state.latency = latency
+        handler = type("Handler", (_Handler,), {"state": self.state})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """ The base URL of the server. """
+        return "http://{}:{}".format(*self._server.server_address[:2])
+
+    def start(self):
+        """ Starts serving in a daemon thread. """
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-easytensor", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the server. """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,804 @@
+"""
+The EasyTensor client benchmark suite.
+
+Runs the client against a local fake API server (see fake_server.py) with
+synthetic models, and writes the results as JSON so runs can be compared
+across versions with benchmarks/compare.py.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --only archive,upload --size-mb 256
+
+The benchmarks run in a temporary HOME, so they never touch the real
+~/.easytensor config. Benchmarks that need a framework that isn't installed
+(e.g. torch for the weight export benchmarks) are reported as skipped.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import collections
+from datetime import datetime, timezone
+
+SCHEMA_VERSION = 1
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIB = 1024 * 1024
+# Size of the layers of the synthetic weights, and of their bias and norm
+# vectors, in bytes and floats.
+LAYER_BYTES = 4 * MIB
+LAYER_VECTOR = 1024
+# The median time `import easytensor` may take, in seconds.
+IMPORT_BUDGET_S = 0.5
+# Modules importing easytensor, or any of its framework helpers, must not load.
+FRAMEWORK_MODULES = ("torch", "tensorflow", "transformers")
+
+
+class Skipped(Exception):
+    """ Raised by benchmarks that can't run in this environment. """
+
+
+def _isolate_home():
+    """
+    Points HOME at a fresh temporary directory. Must run before easytensor
+    is imported, which reads the config location from the home directory.
+    """
+    home = tempfile.mkdtemp(prefix="easytensor-bench-")
+    os.environ["HOME"] = home
+    os.environ["USERPROFILE"] = home
+    return home
+
+
+def _timed(func, repeat):
+    """
+    Runs func repeat times and returns the durations in seconds and the
+    result of the last run.
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+
+def _summary(durations, size=None):
+    """ Returns the timing metrics of the durations. """
+    metrics = {
+        "median_s": statistics.median(durations),
+        "min_s": min(durations),
+        "runs": len(durations),
+    }
+    if size:
+        metrics["input_bytes"] = size
+        metrics["median_mb_s"] = size / MIB / metrics["median_s"]
+    return metrics
+
+
+def _latencies(durations):
+    """ Returns the p50 and p99 latencies of the durations, in milliseconds. """
+    cuts = statistics.quantiles(durations, n=100, method="inclusive")
+    return {"p50_ms": cuts[49] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+def _tree_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+# synthetic models
+
+
+MODEL_CLASS_SOURCE = '''
+class Model:
+    """ A stand-in model class. """
+
+    def predict_single(self, instance):
+        return instance
+'''
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fout:
+        fout.write(data)
+
+
+def _layer(rng, size):
+    """
+    Returns the float32 bytes of one synthetic layer: normally distributed
+    weights with the spread of trained ones, then a bias of zeros and a norm
+    scale of ones, like a state_dict.
+    """
+    import numpy as np
+
+    count = size // 4
+    vector = min(LAYER_VECTOR, count // 4)
+    weights = rng.normal(0.0, 0.02, count - 2 * vector).astype("<f4")
+    layer = np.concatenate(
+        [weights, np.zeros(vector, "<f4"), np.ones(vector, "<f4")]
+    ).tobytes()
+    return layer + b"\x00" * (size - len(layer))
+
+
+def _weights_file(path, size):
+    """
+    Writes a synthetic float32 state_dict of size bytes, layer by layer. Its
+    exponent bytes compress like those of real checkpoints, unlike random
+    bytes, so the AUTO and parallel gzip modes are measured on realistic data.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fout:
+        for offset in range(0, size, LAYER_BYTES):
+            fout.write(_layer(rng, min(LAYER_BYTES, size - offset)))
+
+
+def _text(size):
+    """ Returns compressible bytes, like graphs, vocabularies and configs. """
+    line = b"the quick brown fox jumps over the lazy dog 0123456789\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def make_models(directory, size):
+    """
+    Writes a synthetic model of every framework, weighing roughly size
+    bytes, and returns their locations.
+    """
+    weights = int(size * 0.9)
+    small = max(size - weights, 1) // 2
+    class_file = os.path.join(directory, "model.py")
+    _write(class_file, MODEL_CLASS_SOURCE.encode("utf-8"))
+
+    saved_model = os.path.join(directory, "saved_model")
+    _write(os.path.join(saved_model, "saved_model.pb"), _text(small))
+    _weights_file(
+        os.path.join(saved_model, "variables", "variables.data-00000-of-00001"),
+        weights,
+    )
+    _write(os.path.join(saved_model, "variables", "variables.index"), _text(4096))
+    _write(os.path.join(saved_model, "assets", "vocab.txt"), _text(small))
+
+    pytorch_weights = os.path.join(directory, "pytorch", "model.pt")
+    _weights_file(pytorch_weights, weights)
+
+    checkpoint = os.path.join(directory, "checkpoint")
+    _write(os.path.join(checkpoint, "config.json"), _text(2048))
+    _write(os.path.join(checkpoint, "tokenizer.json"), _text(small))
+    _weights_file(os.path.join(checkpoint, "pytorch_model.bin"), weights)
+    return {
+        "class_file": class_file,
+        "tensorflow": saved_model,
+        "pytorch": pytorch_weights,
+        "transformers": checkpoint,
+    }
+
+
+# benchmarks
+
+
+_IMPORT_CHILD = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in {frameworks!r} if name in sys.modules]]))
+"""
+
+
+def bench_import(ctx):
+    """
+    The time it takes to import the package and its framework helpers.
+    Fails if `import easytensor` takes longer than the import budget, or if
+    any of the imports loads a machine learning framework.
+    """
+    results = {}
+    for module in (
+        "easytensor",
+        "easytensor.tensorflow",
+        "easytensor.pytorch",
+        "easytensor.transformers",
+    ):
+        code = _IMPORT_CHILD.format(module=module, frameworks=FRAMEWORK_MODULES)
+        durations = []
+        loaded = set()
+        for _ in range(ctx.repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", code],
+                check=True,
+                capture_output=True,
+                text=True,
+                cwd=REPO_ROOT,
+                env=dict(os.environ, PYTHONPATH=REPO_ROOT),
+            ).stdout
+            elapsed, frameworks = json.loads(output.strip().splitlines()[-1])
+            durations.append(elapsed)
+            loaded.update(frameworks)
+        results["import." + module] = _summary(durations)
+        if loaded:
+            ctx.fail(
+                "import {} loaded {}".format(module, ", ".join(sorted(loaded)))
+            )
+    median = results["import.easytensor"]["median_s"]
+    if median > ctx.import_budget:
+        ctx.fail(
+            "import easytensor took {:.3f}s, over the {:.3f}s budget".format(
+                median, ctx.import_budget
+            )
+        )
+    return results
+
+
+def _compressions():
+    from easytensor.constants import Compression
+
+    compressions = [
+        Compression.NONE,
+        Compression.GZIP,
+        Compression.PARALLEL_GZIP,
+        Compression.AUTO,
+    ]
+    try:
+        import zstandard  # pylint: disable=unused-import
+
+        compressions.append(Compression.ZSTD)
+    except ImportError:
+        pass
+    return compressions
+
+
+def bench_archive(ctx):
+    """ create_model_archive throughput per framework and compression. """
+    from easytensor.tensorflow.upload import create_model_archive as tf_archive
+    from easytensor.pytorch.upload import create_model_archive as pt_archive
+    from easytensor.transformers.upload import create_model_archive as tr_archive
+
+    models = ctx.models
+    packagers = {
+        "tensorflow": (
+            lambda compression: tf_archive(
+                models["tensorflow"], compression, member_cache=False
+            ),
+            _tree_size(models["tensorflow"]),
+        ),
+        "pytorch": (
+            lambda compression: pt_archive(
+                models["pytorch"], models["class_file"], compression
+            ),
+            _tree_size(models["pytorch"]),
+        ),
+        "transformers": (
+            lambda compression: tr_archive(
+                models["transformers"], models["class_file"], compression
+            ),
+            _tree_size(models["transformers"]),
+        ),
+    }
+    results = {}
+    for framework, (package, size) in packagers.items():
+        for compression in _compressions():
+            archives = []
+
+            def run(package=package, compression=compression, archives=archives):
+                archives.append(package(compression))
+
+            durations, _ = _timed(run, ctx.repeat)
+            metrics = _summary(durations, size)
+            metrics["archive_bytes"] = os.path.getsize(archives[-1])
+            metrics["ratio"] = metrics["archive_bytes"] / size
+            for archive in archives:
+                os.remove(archive)
+            results["archive.{}.{}".format(framework, compression.value)] = metrics
+    return results
+
+
+def bench_member_cache(ctx):
+    """ Rebuilding a TensorFlow archive from cached members, cold and warm. """
+    from easytensor.member_cache import MemberCache, create_cached_archive
+    from easytensor.tensorflow.upload import archive_members
+
+    members = archive_members(ctx.models["tensorflow"])
+    size = _tree_size(ctx.models["tensorflow"])
+    cache_directory = tempfile.mkdtemp(dir=ctx.home)
+    results = {}
+    for label in ("cold", "warm"):
+        cache = MemberCache(cache_directory)
+        start = time.perf_counter()
+        archive = create_cached_archive(members, "gzip", cache)
+        metrics = _summary([time.perf_counter() - start], size)
+        metrics.update(hits=cache.hits, misses=cache.misses)
+        os.remove(archive)
+        results["member_cache.tensorflow." + label] = metrics
+    return results
+
+
+def bench_upload(ctx):
+    """ upload_archive throughput, single request, multipart and streamed. """
+    from easytensor.archive import create_archive, stream_archive
+    from easytensor.upload import upload_archive, upload_archive_stream
+    from easytensor.client import get_client
+
+    members = [(ctx.models["pytorch"], "model.pt")]
+    archive = create_archive(members, "none")
+    size = os.path.getsize(archive)
+    modes = {
+        "single": lambda: upload_archive(archive, dedup=False),
+        "multipart": lambda: upload_archive(
+            archive,
+            multipart=True,
+            chunk_size=8 * MIB,
+            resume=False,
+            dedup=False,
+        ),
+        "stream": lambda: upload_archive_stream(stream_archive(members, "none")),
+    }
+    results = {}
+    for mode, upload in modes.items():
+        ctx.server.state.reset()
+        before = get_client().connection_stats()
+        with _quiet():
+            durations, _ = _timed(upload, ctx.repeat)
+        after = get_client().connection_stats()
+        metrics = _summary(durations, size)
+        metrics["requests"] = after["requests"] - before["requests"]
+        metrics["bytes_received"] = ctx.server.state.bytes_received
+        results["upload." + mode] = metrics
+    os.remove(archive)
+    return results
+
+
+def bench_upload_model(ctx):
+    """ End-to-end upload_model latency, broken down by stage. """
+    from easytensor.batch import upload_models
+    from easytensor.constants import Framework
+    from easytensor.tensorflow import upload_model
+
+    size = _tree_size(ctx.models["tensorflow"])
+    with _quiet():
+        durations, _ = _timed(
+            lambda: upload_model("benchmark", ctx.models["tensorflow"]), ctx.repeat
+        )
+    results = {"upload_model.tensorflow": _summary(durations, size)}
+
+    # the batch uploader times every stage of every model.
+    stages = {}
+    with _quiet():
+        for _ in range(ctx.repeat):
+            (result,) = upload_models(
+                [("benchmark", ctx.models["tensorflow"], {})],
+                Framework.TENSORFLOW,
+                dedup=False,
+            )
+            if result.error is not None:
+                raise result.error
+            for stage, duration in result.timings.items():
+                stages.setdefault(stage, []).append(duration)
+    for stage, durations in stages.items():
+        results["upload_model.tensorflow.stage." + stage] = _summary(durations)
+    return results
+
+
+@contextlib.contextmanager
+def _count_config_reads():
+    """
+    Counts get_config calls, in every module that imported it, and the
+    actual reads of the config file.
+    """
+    from easytensor import config
+
+    counts = {"get_config": 0, "file_reads": 0}
+    read_config, get_config = config._read_config, config.get_config
+
+    def counting_read():
+        counts["file_reads"] += 1
+        return read_config()
+
+    def counting_get():
+        counts["get_config"] += 1
+        return get_config()
+
+    modules = [
+        module
+        for name, module in list(sys.modules.items())
+        if name.startswith("easytensor")
+        and getattr(module, "get_config", None) is get_config
+    ]
+    config._read_config = counting_read
+    for module in modules:
+        module.get_config = counting_get
+    try:
+        yield counts
+    finally:
+        config._read_config = read_config
+        for module in modules:
+            module.get_config = get_config
+
+
+def bench_config_reads(ctx):
+    """ The number of config reads per API call. """
+    from easytensor.auth import get_auth_token
+    from easytensor.constants import Framework
+    from easytensor.upload import create_model_object, create_query_token
+    from easytensor.tensorflow import upload_model
+
+    def cold_get_auth_token():
+        # like the first call of a new process: nothing is cached in memory.
+        from easytensor import config
+        from easytensor.auth import TOKEN_MANAGER
+
+        config._CACHE.update(key=None, config=None)
+        TOKEN_MANAGER._loaded = False
+        return get_auth_token()
+
+    calls = {
+        "get_auth_token.cold": cold_get_auth_token,
+        "get_auth_token": get_auth_token,
+        "create_model_object": lambda: create_model_object(
+            "address", "name", 1, Framework.TENSORFLOW
+        ),
+        "create_query_token": lambda: create_query_token("1"),
+        "upload_model.tensorflow": lambda: upload_model(
+            "benchmark", ctx.models["tensorflow"]
+        ),
+    }
+    results = {}
+    for name, call in calls.items():
+        with _quiet(), _count_config_reads() as counts:
+            call()
+        results["config_reads." + name] = dict(counts)
+    return results
+
+
+def _concurrent_predictions(ctx, client, instance, count=2000, threads=64):
+    """ Returns the latency and throughput of concurrent predict calls. """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _predict(_):
+        start = time.perf_counter()
+        client.predict(instance)
+        return time.perf_counter() - start
+
+    ctx.server.state.reset()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        start = time.perf_counter()
+        durations = list(executor.map(_predict, range(count)))
+        elapsed = time.perf_counter() - start
+    return {
+        "instances": count,
+        "seconds": elapsed,
+        "instances_per_s": count / elapsed,
+        "requests": ctx.server.state.requests["/query/"],
+        **_latencies(durations),
+    }
+
+
+def bench_query(ctx):
+    """
+    Prediction latency (p50/p99) and throughput, single, micro-batched and
+    streamed. Concurrent calls are also measured without micro-batching.
+    """
+    from easytensor.query import QueryClient
+
+    instance = [1.0] * 32
+    results = {}
+    # every call its own request, the baseline micro-batching is measured on.
+    with QueryClient("benchmark-token", max_batch_size=1) as client:
+        results["query.predict.concurrent.unbatched"] = _concurrent_predictions(
+            ctx, client, instance
+        )
+    with QueryClient("benchmark-token") as client:
+        durations, _ = _timed(lambda: client.predict_batch([instance]), 50)
+        results["query.predict_batch.single"] = {
+            **_summary(durations),
+            **_latencies(durations),
+        }
+
+        results["query.predict.concurrent"] = _concurrent_predictions(
+            ctx, client, instance
+        )
+        # the latency of a streamed instance runs from when predict_stream
+        # pulls it from the input to when its prediction is yielded.
+        ctx.server.state.reset()
+        count = 20000
+        pulled = collections.deque()
+
+        def _instances():
+            for _ in range(count):
+                pulled.append(time.perf_counter())
+                yield instance
+
+        durations = []
+        start = time.perf_counter()
+        for _ in client.predict_stream(_instances()):
+            durations.append(time.perf_counter() - pulled.popleft())
+        elapsed = time.perf_counter() - start
+        results["query.predict_stream"] = {
+            "instances": count,
+            "seconds": elapsed,
+            "instances_per_s": count / elapsed,
+            "requests": ctx.server.state.requests["/query/"],
+            **_latencies(durations),
+        }
+    return results
+
+
+_EXPORT_CHILD = """
+import os, sys, json, time, resource, tarfile
+sys.path.insert(0, {root!r})
+import torch
+from easytensor.archive import create_archive
+from easytensor.pytorch.upload import export_pytorch_weights, archive_members
+from easytensor.pytorch.weights import safetensors_file
+
+torch.manual_seed(0)
+layers = [torch.nn.Linear({width}, {width}) for _ in range({layers})]
+model = torch.nn.Sequential(*layers)
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if {weights_format!r} == "torch":
+    weights = export_pytorch_weights(model, {directory!r})
+else:
+    weights = safetensors_file(model, precision={precision!r})
+archive = create_archive(archive_members(weights, {class_file!r}), "gzip")
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+scale = 1 if sys.platform == "darwin" else 1024
+print(json.dumps({{
+    "seconds": elapsed,
+    "peak_extra_rss_bytes": (peak - baseline) * scale,
+    "archive_bytes": os.path.getsize(archive),
+    "parameter_bytes": sum(p.numel() * p.element_size() for p in model.parameters()),
+}}))
+os.remove(archive)
+"""
+
+
+def _payload_size(request):
+    """ Returns the size of the body requests sends for encode_instances. """
+    if "json" in request:
+        return len(json.dumps(request["json"]).encode("utf-8"))
+    return len(request["data"])
+
+
+def bench_encoding(ctx):
+    """
+    Encode time, payload size and query latency of the json, base64 and
+    binary (tensor frame) encodings, for small and image sized instances.
+    """
+    try:
+        import numpy as np
+    except ImportError as exc:
+        raise Skipped("numpy is not installed") from exc
+    from easytensor.encoding import ENCODINGS, encode_instances
+    from easytensor.query import QueryClient
+
+    shapes = {"small": (32,), "image": (224, 224, 3)}
+    batch = 8
+    repeat = max(ctx.repeat, 5)
+    results = {}
+    for label, shape in shapes.items():
+        instances = list(np.random.rand(batch, *shape).astype("float32"))
+        for encoding in ENCODINGS:
+            name = "encoding.{}.{}".format(label, encoding)
+
+            def encode():
+                request = encode_instances(instances, encoding)
+                # requests serializes json bodies when it sends them.
+                return _payload_size(request)
+
+            durations, size = _timed(encode, repeat)
+            metrics = {"encode_s": statistics.median(durations), "payload_bytes": size}
+            with QueryClient("benchmark-token", encoding=encoding) as client:
+                durations, _ = _timed(lambda: client.predict_batch(instances), repeat)
+            metrics.update(_summary(durations))
+            results[name] = metrics
+    return results
+
+
+def bench_pytorch_export(ctx):
+    """
+    Peak memory and wall time of exporting PyTorch weights with torch.save
+    against streaming them as safetensors. Each run is a fresh process, so
+    peak RSS isn't shared between the variants.
+    """
+    try:
+        import torch  # pylint: disable=unused-import
+    except ImportError as exc:
+        raise Skipped("torch is not installed") from exc
+    try:
+        import resource  # pylint: disable=unused-import
+    except ImportError as exc:
+        raise Skipped("peak RSS can't be measured on this platform") from exc
+
+    # square float32 layers adding up to roughly size bytes.
+    width = 1024
+    layers = max(1, ctx.size // (width * width * 4))
+    variants = {
+        "torch": ("torch", None),
+        "safetensors": ("safetensors", None),
+        "safetensors.fp16": ("safetensors", "fp16"),
+    }
+    results = {}
+    for name, (weights_format, precision) in variants.items():
+        directory = tempfile.mkdtemp(dir=ctx.home)
+        code = _EXPORT_CHILD.format(
+            root=REPO_ROOT,
+            width=width,
+            layers=layers,
+            weights_format=weights_format,
+            precision=precision,
+            directory=directory,
+            class_file=ctx.models["class_file"],
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True, text=True
+        ).stdout
+        results["pytorch_export." + name] = json.loads(output.strip().splitlines()[-1])
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+BENCHMARKS = {
+    "import": bench_import,
+    "archive": bench_archive,
+    "member_cache": bench_member_cache,
+    "upload": bench_upload,
+    "upload_model": bench_upload_model,
+    "config_reads": bench_config_reads,
+    "query": bench_query,
+    "encoding": bench_encoding,
+    "pytorch_export": bench_pytorch_export,
+}
+
+
+@contextlib.contextmanager
+def _quiet():
+    """ Hides the upload progress bars. """
+    with contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+class Context:
+    """ What the benchmarks share: the server, the models and the settings. """
+
+    def __init__(self, server, home, models, size, repeat, import_budget):
+        self.server = server
+        self.home = home
+        self.models = models
+        self.size = size
+        self.repeat = repeat
+        self.import_budget = import_budget
+        self.failures = []
+
+    def fail(self, message):
+        """ Records a broken guarantee. The run exits with status 1. """
+        print("  FAILED: {}".format(message), file=sys.stderr)
+        self.failures.append(message)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=REPO_ROOT,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _package_version():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    try:
+        return version("easytensor")
+    except PackageNotFoundError:
+        return None
+
+
+def main(argv=None):
+    """ Runs the benchmarks and writes the results. """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument(
+        "--only", help="comma separated benchmarks, of: " + ", ".join(BENCHMARKS)
+    )
+    parser.add_argument(
+        "--size-mb", type=int, default=64, help="size of the synthetic models"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0.0,
+        help="latency the fake server adds to every API call",
+    )
+    parser.add_argument(
+        "--import-budget-ms",
+        type=float,
+        default=IMPORT_BUDGET_S * 1000,
+        help="the most `import easytensor` may take",
+    )
+    args = parser.parse_args(argv)
+    selected = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    home = _isolate_home()
+    sys.path.insert(0, REPO_ROOT)
+    from benchmarks.fake_server import FakeServer
+
+    server = FakeServer(latency=args.latency_ms / 1000).start()
+    import easytensor
+    from easytensor.auth import TOKEN_MANAGER
+    from benchmarks.fake_server import make_jwt
+
+    # the upload module binds the URLs when it is first imported, so the
+    # base URL is set before anything imports it.
+    easytensor.set_base_url(server.url)
+    TOKEN_MANAGER.set_tokens(make_jwt(time.time() + 24 * 60 * 60), "refresh")
+
+    size = args.size_mb * MIB
+    models = make_models(os.path.join(home, "models"), size)
+    ctx = Context(
+        server, home, models, size, args.repeat, args.import_budget_ms / 1000
+    )
+    report = {
+        "schema": SCHEMA_VERSION,
+        "easytensor_version": _package_version(),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "settings": {
+            "size_mb": args.size_mb,
+            "repeat": args.repeat,
+            "latency_ms": args.latency_ms,
+        },
+        "results": {},
+        "skipped": {},
+        "failures": ctx.failures,
+    }
+    try:
+        for name in selected:
+            print("running {}".format(name), file=sys.stderr)
+            try:
+                report["results"].update(BENCHMARKS[name](ctx))
+            except Skipped as exc:
+                report["skipped"][name] = str(exc)
+                print("  skipped: {}".format(exc), file=sys.stderr)
+    finally:
+        server.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(output + "\n")
+    else:
+        print(output)
+    return 1 if ctx.failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,30 @@
 """
 Main module. Imports some functions to expose at the top level.
+
+The framework subpackages (tensorflow, pytorch and transformers) are loaded
+lazily on first attribute access, so that `import easytensor` does not pull
+in any of the heavy machine learning frameworks.
 """
-from easytensor.auth import get_auth_token
+import importlib
+from easytensor.auth import get_auth_token, start_background_refresh
 from easytensor.urls import set_base_url
-from easytensor.constants import Framework
-from easytensor import tensorflow
-from easytensor import pytorch
-from easytensor import transformers
+from easytensor.constants import Framework, Compression
+
+_LAZY_SUBPACKAGES = ("tensorflow", "pytorch", "transformers")
+
+
+def __getattr__(name):
+    """
+    Imports the framework subpackages on first access.
+    See https://www.python.org/dev/peps/pep-0562/
+    """
+    if name in _LAZY_SUBPACKAGES:
+        module = importlib.import_module("easytensor." + name)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    """ Lists the lazy subpackages alongside the loaded attributes. """
+    return sorted(list(globals()) + list(_LAZY_SUBPACKAGES))
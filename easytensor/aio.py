@@ -0,0 +1,160 @@
+"""
+A module with asyncio counterparts of the upload functions, for uploading
+many models concurrently from one event loop.
+
+The blocking work (packaging archives, HTTP calls through the shared client)
+runs in a thread pool, so the event loop is never blocked. The number of
+uploads in flight at a time is bounded by the concurrency limit, see
+set_concurrency_limit.
+See easytensor/[framework]/upload.py for the framework upload_model_async
+functions.
+"""
+import asyncio
+import functools
+import contextvars
+import threading
+import weakref
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from easytensor import upload
+from easytensor.auth import check_auth, refresh_auth, get_auth_token
+from easytensor.constants import Framework
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+
+_SETTINGS = {"concurrency": DEFAULT_CONCURRENCY}
+_EXECUTOR = {"executor": None}
+_EXECUTOR_LOCK = threading.Lock()
+# asyncio primitives are bound to the loop they're used in, keep one per loop.
+_SEMAPHORES = weakref.WeakKeyDictionary()
+_AUTH_LOCKS = weakref.WeakKeyDictionary()
+
+
+def set_concurrency_limit(limit: int):
+    """
+    Sets the maximum number of network calls in flight at a time.
+    Applies to event loops that haven't made any call yet.
+    """
+    if limit < 1:
+        raise ValueError("The concurrency limit must be at least 1.")
+    with _EXECUTOR_LOCK:
+        _SETTINGS["concurrency"] = limit
+        if _EXECUTOR["executor"] is not None:
+            _EXECUTOR["executor"].shutdown(wait=False)
+            _EXECUTOR["executor"] = None
+    _SEMAPHORES.clear()
+
+
+def _executor():
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR["executor"] is None:
+            # leave room for packaging work next to the network calls.
+            _EXECUTOR["executor"] = ThreadPoolExecutor(
+                max_workers=2 * _SETTINGS["concurrency"],
+                thread_name_prefix="easytensor-aio",
+            )
+        return _EXECUTOR["executor"]
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _SEMAPHORES:
+        _SEMAPHORES[loop] = asyncio.Semaphore(_SETTINGS["concurrency"])
+    return _SEMAPHORES[loop]
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs the blocking function in the easytensor thread pool and returns
+    its result. Used for CPU heavy packaging work.
+    The function runs in a copy of the caller's context, so its spans nest
+    under the caller's and its uploads have the caller's transfer priority.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor(), functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+async def _run_network(func, *args, **kwargs):
+    async with _semaphore():
+        return await run_blocking(func, *args, **kwargs)
+
+
+async def ensure_auth():
+    """
+    Makes sure the session is authenticated before calls are fanned out, so
+    concurrent uploads don't each prompt for credentials.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _AUTH_LOCKS:
+        _AUTH_LOCKS[loop] = asyncio.Lock()
+    async with _AUTH_LOCKS[loop]:
+        if check_auth():
+            return
+        if not await run_blocking(refresh_auth):
+            await run_blocking(get_auth_token)
+
+
+async def upload_archive(filename, **kwargs):
+    """
+    Uploads the archive and returns the ID of the model that was uploaded
+    and its size. See easytensor.upload.upload_archive for the options.
+    """
+    await ensure_auth()
+    return await _run_network(upload.upload_archive, filename, **kwargs)
+
+
+async def create_model_object(
+    address: str, name: str, size: int, framework: Framework, metadata: dict = None
+):
+    """
+    Creates a model object in EasyTensor backend and returns its ID.
+    See easytensor.upload.create_model_object.
+    """
+    await ensure_auth()
+    return await _run_network(
+        upload.create_model_object, address, name, size, framework, metadata
+    )
+
+
+async def create_query_token(model_id):
+    """
+    Creates a query token for the model with the passed model id.
+    """
+    await ensure_auth()
+    return await _run_network(upload.create_query_token, model_id)
+
+
+async def create_query_tokens(model_ids, **kwargs):
+    """
+    Returns a dict of query tokens for the models with the passed ids.
+    See easytensor.upload.create_query_tokens for the options.
+    """
+    await ensure_auth()
+    return await _run_network(upload.create_query_tokens, model_ids, **kwargs)
+
+
+async def upload_and_register(
+    archive_location,
+    model_name,
+    framework: Framework,
+    create_token=True,
+    metadata=None,
+    **kwargs
+):
+    """
+    Uploads a packaged archive and registers it as a model.
+    Returns the model ID and a query access token, or None if create_token
+    is False. Extra keyword arguments are passed to upload_archive.
+    """
+    model_address, model_size = await upload_archive(archive_location, **kwargs)
+    model_id = await create_model_object(
+        model_address, model_name, model_size, framework, metadata
+    )
+    if not create_token:
+        return model_id, None
+    return model_id, await create_query_token(model_id)
@@ -0,0 +1,369 @@
+"""
+A module for packaging model files into archives.
+Archives can either be written to a temporary file on disk or streamed
+directly into an upload request, in which case no intermediate tarball is
+ever written to disk.
+"""
+import os
+import io
+import queue
+import collections
+import hashlib
+import tarfile
+import tempfile
+import threading
+import logging
+from easytensor import tracing
+from easytensor.constants import Compression
+from easytensor.compression import open_compressor, level_for_file, DEFAULT_LEVEL
+
+LOGGER = logging.getLogger(__name__)
+
+# Size of the chunks handed to the HTTP layer when streaming an archive.
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Maximum number of chunks that can be buffered between the archiver and the
+# uploader. Bounds the memory used by a streamed upload to roughly
+# STREAM_CHUNK_SIZE * STREAM_BUFFER_CHUNKS.
+STREAM_BUFFER_CHUNKS = 16
+
+
+class ArchiveException(BaseException):
+    """ A simple exception for failures while packaging a model archive."""
+
+
+class GeneratedFile:
+    """
+    An archive member whose content is produced while the archive is written
+    instead of being read from disk, e.g. weights serialized tensor by tensor.
+    Subclasses set `size` to the exact number of bytes `chunks` yields, which
+    tar needs to know before the content is written.
+    Pass it in place of a path in the members of an archive.
+    """
+
+    size = 0
+
+    def chunks(self):
+        """ Yields the content as bytes-like objects. """
+        raise NotImplementedError()
+
+    def compression_level(self):
+        """ Returns the level used for this member in Compression.AUTO mode. """
+        return DEFAULT_LEVEL
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    A file-like reader over the chunks of a GeneratedFile. Reads within a
+    chunk return views into it, so large buffers aren't copied.
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            chunk = memoryview(chunk).cast("B")
+            if len(chunk):
+                self._chunk, self._offset = chunk, 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        # tarfile expects exactly `size` bytes until the end of the member,
+        # so reads that span chunks are joined.
+        parts = []
+        wanted = size
+        while wanted != 0:
+            if self._offset >= len(self._chunk) and not self._next_chunk():
+                break
+            end = len(self._chunk) if wanted < 0 else self._offset + wanted
+            part = self._chunk[self._offset : end]
+            self._offset += len(part)
+            parts.append(part)
+            if wanted > 0:
+                wanted -= len(part)
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+
+def _add_generated(tarout, generated, arcname):
+    tarinfo = _normalize_member(tarfile.TarInfo(arcname))
+    tarinfo.size = generated.size
+    tarinfo.mode = 0o644
+    tarout.addfile(tarinfo, _ChunkReader(generated.chunks()))
+
+
+def _normalize_member(tarinfo):
+    """
+    Strips the modification times and ownership from archive members, so
+    the same files always produce the same archive.
+    """
+    tarinfo.mtime = 0
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+
+def _walk_members(members):
+    """
+    Yields the (path, arcname) of every file and directory under the passed
+    members, in the order tarfile would add them recursively.
+    """
+    for path, arcname in members:
+        yield path, arcname
+        if isinstance(path, GeneratedFile):
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            yield from _walk_members(
+                (os.path.join(path, name), os.path.join(arcname, name))
+                for name in sorted(os.listdir(path))
+            )
+
+
+def write_archive(fileobj, members, compression=Compression.GZIP):
+    """
+    Writes a compressed tar archive of the passed members into fileobj.
+    members: a list of (path, arcname) tuples. path can also be a
+    GeneratedFile, whose content is written as it is generated.
+    compression: see easytensor.compression.
+    The archive is reproducible: identical files produce identical bytes.
+    """
+    compression = Compression(compression)
+    compressor = open_compressor(fileobj, compression)
+    span = tracing.current_span()
+    try:
+        with tarfile.open(fileobj=compressor, mode="w|") as tarout:
+            # copy generated members in large reads (python 3.8+).
+            tarout.copybufsize = STREAM_CHUNK_SIZE
+            for path, arcname in _walk_members(members):
+                if isinstance(path, GeneratedFile):
+                    if compression == Compression.AUTO:
+                        compressor.set_level(path.compression_level())
+                    _add_generated(tarout, path, arcname)
+                    span.add("bytes_in", path.size)
+                    continue
+                if compression == Compression.AUTO and os.path.isfile(path):
+                    compressor.set_level(level_for_file(path))
+                if span.recording and os.path.isfile(path):
+                    span.add("bytes_in", os.path.getsize(path))
+                tarout.add(
+                    path, arcname=arcname, recursive=False, filter=_normalize_member
+                )
+    finally:
+        compressor.close()
+
+
+def file_digest(filename, block_size=1024 * 1024):
+    """
+    Returns the hex sha256 digest of the file at filename.
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fin:
+        for block in iter(lambda: fin.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def archive_digest(filename):
+    """
+    Returns the hex sha256 digest of the archive at filename.
+    Archives built by create_archive are hashed while they are written, so
+    this only reads the file if it was created elsewhere or changed since.
+    """
+    stat = os.stat(filename)
+    with _KNOWN_DIGESTS_LOCK:
+        known = _KNOWN_DIGESTS.get(filename)
+        if known is not None:
+            if known[0] == _stat_key(stat):
+                _KNOWN_DIGESTS.move_to_end(filename)
+                return known[1]
+            # the file was changed or replaced since it was hashed.
+            del _KNOWN_DIGESTS[filename]
+    return file_digest(filename)
+
+
+# sha256 digests of the archives created by this process, keyed by location,
+# least recently used first. Lets uploads reuse the digest computed while
+# writing instead of reading the archive a second time.
+_KNOWN_DIGESTS = collections.OrderedDict()
+_KNOWN_DIGESTS_LOCK = threading.Lock()
+# Maximum number of archive digests remembered.
+KNOWN_DIGESTS_MAX_ENTRIES = 256
+
+
+def _stat_key(stat):
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def _record_digest(location, digest):
+    """
+    Remembers the digest of the archive written at location, along with its
+    size, modification time and inode, so archive_digest can tell if the
+    file changed since.
+    """
+    key = _stat_key(os.stat(location))
+    with _KNOWN_DIGESTS_LOCK:
+        _KNOWN_DIGESTS.pop(location, None)
+        _KNOWN_DIGESTS[location] = (key, digest)
+        while len(_KNOWN_DIGESTS) > KNOWN_DIGESTS_MAX_ENTRIES:
+            _KNOWN_DIGESTS.popitem(last=False)
+
+
+class _HashingWriter:
+    """ A file-like wrapper that hashes everything written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        """ Hashes and writes data to the wrapped file. """
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        """ Flushes the wrapped file. """
+        self.fileobj.flush()
+
+
+@tracing.traced("easytensor.create_archive")
+def create_archive(members, compression=Compression.GZIP):
+    """
+    Creates a temporary archive of the passed members and returns its location.
+    members: a list of (path, arcname) tuples.
+    compression: see easytensor.compression.
+    The archive is hashed as it is written, see archive_digest.
+    """
+    _, tar_location = tempfile.mkstemp()
+    with open(tar_location, "wb") as fout:
+        writer = _HashingWriter(fout)
+        write_archive(writer, members, compression)
+    stat = os.stat(tar_location)
+    span = tracing.current_span()
+    span.set("compression", Compression(compression).value)
+    span.set("bytes_out", stat.st_size)
+    _record_digest(tar_location, writer.digest.hexdigest())
+    return tar_location
+
+
+class _StreamAborted(Exception):
+    """ Raised inside the archiver thread when the consumer stops reading."""
+
+
+class ArchiveStream:
+    """
+    An iterable over the bytes of an archive that is being built in a
+    background thread.
+    The archiver writes into a bounded buffer and blocks when the consumer
+    falls behind, so packaging and network transfer overlap without holding
+    the whole archive in memory or on disk.
+    Once fully consumed, `size` holds the total number of bytes produced and
+    `digest` the hex sha256 digest of the archive.
+    """
+
+    def __init__(
+        self,
+        members,
+        compression=Compression.GZIP,
+        chunk_size=STREAM_CHUNK_SIZE,
+        max_buffered_chunks=STREAM_BUFFER_CHUNKS,
+    ):
+        self.members = members
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.digest = None
+        self._hash = hashlib.sha256()
+        self._queue = queue.Queue(maxsize=max_buffered_chunks)
+        self._buffer = bytearray()
+        self._aborted = threading.Event()
+        self._error = None
+        self._thread = None
+
+    # file-like interface used by tarfile in the archiver thread
+    def write(self, data):
+        """ Buffers data and hands it to the consumer in fixed sized chunks. """
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer[: self.chunk_size]))
+            del self._buffer[: self.chunk_size]
+        return len(data)
+
+    def _put(self, item):
+        while True:
+            if self._aborted.is_set():
+                raise _StreamAborted()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        try:
+            write_archive(self, self.members, self.compression)
+            if self._buffer:
+                self._put(bytes(self._buffer))
+                self._buffer.clear()
+        except _StreamAborted:
+            return
+        except BaseException as exc:  # pylint: disable=broad-except
+            self._error = exc
+        try:
+            self._put(None)
+        except _StreamAborted:
+            pass
+
+    def start(self):
+        """ Starts packaging the archive in a background thread. """
+        if self._thread is None:
+            # the archiver's measurements go to the span reading the stream.
+            self._thread = threading.Thread(
+                target=tracing.in_context(self._run),
+                name="easytensor-archiver",
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def close(self):
+        """ Stops the archiver. Safe to call after the stream is exhausted. """
+        self._aborted.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                self.size += len(chunk)
+                self._hash.update(chunk)
+                yield chunk
+            # raise before the consumer sees the end of the stream, so a
+            # failed archive is never uploaded as a complete one.
+            if self._error is not None:
+                raise ArchiveException(
+                    "Failed to package the model archive: {}".format(self._error)
+                ) from self._error
+            self.digest = self._hash.hexdigest()
+        finally:
+            self.close()
+
+
+def stream_archive(members, compression=Compression.GZIP):
+    """
+    Returns an ArchiveStream over the compressed tar archive of the passed
+    members.
+    members: a list of (path, arcname) tuples.
+    """
+    return ArchiveStream(members, compression)
@@ -1,32 +1,275 @@
 """
 A module to manage authentication for the user.
+
+The access token is cached in memory by a TokenManager, which reads the
+token's expiry from its JWT `exp` claim and refreshes it shortly before it
+expires, either on demand or from a background thread.
 """
+import json
+import time
+import base64
 import logging
 import functools
 import getpass
+import threading
 from datetime import datetime, timedelta
-import requests
 from easytensor.config import get_config, update_config
+from easytensor.client import get_client
 
 LOGGER = logging.getLogger(__name__)
 DATETIME_STR_FORMAT = "%m/%d/%Y, %H:%M:%S"
+# Only used for tokens whose expiry can't be read from the token itself.
 TOKEN_EXPIRE_DELTA = timedelta(hours=24)
+# Tokens are refreshed when they expire within this many seconds, or within
+# a quarter of their lifetime for short lived tokens.
+REFRESH_MARGIN = 5 * 60
+# Shortest wait between background refreshes.
+MIN_REFRESH_INTERVAL = 30
+# Wait between background refresh attempts after a failure.
+REFRESH_RETRY_INTERVAL = 60
 # pylint: disable=import-outside-toplevel
 
 
+def _jwt_claim(token: str, claim: str):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode()))
+        return float(claims[claim])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def jwt_expiry(token: str):
+    """
+    Returns the expiry of the JWT as a unix timestamp, or None if the token
+    is not a JWT or has no `exp` claim. The signature is not verified, the
+    expiry is only used to decide when to refresh.
+    """
+    return _jwt_claim(token, "exp")
+
+
+def jwt_lifetime(token: str):
+    """
+    Returns the seconds between the `iat` and `exp` claims of the JWT, or
+    None if the token doesn't have both.
+    """
+    issued_at, expiry = _jwt_claim(token, "iat"), jwt_expiry(token)
+    if issued_at is None or expiry is None or expiry <= issued_at:
+        return None
+    return expiry - issued_at
+
+
+def _config_expiry(config: dict):
+    """
+    Returns the expiry of the access token stored in config, preferring the
+    token's own `exp` claim over the locally stored estimate.
+    """
+    expiry = jwt_expiry(config["access_token"])
+    if expiry is not None:
+        return expiry
+    if "token_expire" not in config:
+        return None
+    try:
+        token_expire = datetime.strptime(config["token_expire"], DATETIME_STR_FORMAT)
+    except (TypeError, ValueError):
+        return None
+    return token_expire.timestamp()
+
+
+class TokenManager:
+    """
+    A thread-safe, in-memory cache of the access token.
+
+    Concurrent refreshes are collapsed: while one thread refreshes the token,
+    the others wait for it and use its result instead of sending their own
+    refresh request.
+    refresh_margin: the most seconds before expiry a token is refreshed. For
+    tokens that live less than four margins, a quarter of their lifetime is
+    used instead, so a fresh token always counts as valid.
+    """
+
+    def __init__(self, refresh_margin=REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = None
+        self._lifetime = None
+        self._generation = 0
+        self._loaded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        (Re)loads the access token from the config.
+        """
+        config = get_config()
+        with self._lock:
+            self._loaded = True
+            if "access_token" not in config:
+                self._access_token, self._expires_at = None, None
+                self._lifetime = None
+                return
+            self._access_token = config["access_token"]
+            self._expires_at = _config_expiry(config)
+            self._lifetime = jwt_lifetime(self._access_token)
+
+    def margin(self):
+        """
+        Returns how many seconds before its expiry the token is refreshed.
+        """
+        if self._lifetime is None:
+            return self.refresh_margin
+        return min(self.refresh_margin, self._lifetime / 4)
+
+    def _valid_for(self, seconds):
+        return (
+            self._access_token is not None
+            and self._expires_at is not None
+            and self._expires_at - seconds > time.time()
+        )
+
+    def is_valid(self, margin=0):
+        """
+        Returns True if the cached access token is valid for at least margin
+        more seconds. Only touches the disk the first time it is called.
+        """
+        if not self._loaded:
+            self.load()
+        return self._valid_for(margin)
+
+    def access_token(self):
+        """
+        Returns the cached access token, refreshing it first if it is about
+        to expire. Returns None if no valid token is available.
+        """
+        if self.is_valid(self.margin()):
+            return self._access_token
+        if self.refresh() or self.is_valid():
+            return self._access_token
+        return None
+
+    def set_tokens(self, access_token: str, refresh_token: str = None):
+        """
+        Caches the access token and stores the tokens in the config.
+        """
+        expires_at = jwt_expiry(access_token)
+        if expires_at is None:
+            expires_at = (datetime.now() + TOKEN_EXPIRE_DELTA).timestamp()
+        # a token without an iat claim was just issued.
+        lifetime = jwt_lifetime(access_token) or expires_at - time.time()
+        updates = {
+            "access_token": access_token,
+            "token_expire": datetime.fromtimestamp(expires_at).strftime(
+                DATETIME_STR_FORMAT
+            ),
+        }
+        if refresh_token is not None:
+            updates["refresh_token"] = refresh_token
+        update_config(updates)
+        with self._lock:
+            self._access_token = access_token
+            self._expires_at = expires_at
+            self._lifetime = lifetime if lifetime > 0 else None
+            self._generation += 1
+            self._loaded = True
+
+    def refresh(self):
+        """
+        Refreshes the access token using the refresh token.
+        Returns True if a fresh token is available, False otherwise.
+        If another thread is already refreshing, waits for it and reuses its
+        result.
+        """
+        generation = self._generation
+        with self._refresh_lock:
+            if self._generation != generation and self._valid_for(self.margin()):
+                return True
+            # another process may have refreshed or logged in already.
+            self.load()
+            if self._valid_for(self.margin()):
+                return True
+            return self._request_refresh()
+
+    def _request_refresh(self):
+        # support hot reloading the URL endpoint
+        from easytensor.urls import REFRESH_TOKEN_URL
+
+        config = get_config()
+        if "refresh_token" not in config:
+            return False
+        response = get_client().post(
+            REFRESH_TOKEN_URL, json={"refresh": config["refresh_token"]}, retry=True
+        )
+
+        if response.status_code == 401:
+            LOGGER.debug("Refresh token expired.")
+            return False
+        response.raise_for_status()
+        res = response.json()
+        # the refresh token is only returned when the backend rotates it.
+        self.set_tokens(res["access"], res.get("refresh"))
+        return True
+
+    def _background_refresh(self):
+        minimum_wait = 0
+        while not self._stop.is_set():
+            if not self._loaded:
+                self.load()
+            if self._expires_at is None:
+                wait = REFRESH_RETRY_INTERVAL
+            else:
+                wait = self._expires_at - self.margin() - time.time()
+            if self._stop.wait(max(wait, minimum_wait)):
+                return
+            # never loop against the refresh endpoint, e.g. when the backend
+            # issues tokens that already count as expiring.
+            minimum_wait = MIN_REFRESH_INTERVAL
+            try:
+                refreshed = self.refresh()
+            except Exception as exc:  # pylint: disable=broad-except
+                LOGGER.debug("Background token refresh failed: %s", exc)
+                refreshed = False
+            if not refreshed and self._stop.wait(REFRESH_RETRY_INTERVAL):
+                return
+
+    def start_background_refresh(self):
+        """
+        Starts a daemon thread that refreshes the token shortly before it
+        expires, so long running jobs never block on an expired token.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._background_refresh,
+                name="easytensor-token-refresh",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def stop_background_refresh(self):
+        """
+        Stops the background refresh thread, if running.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+TOKEN_MANAGER = TokenManager()
+
+
 def check_auth():
     """
     Returns True if the user session is authenticated, False otherwise.
     If the session is expired or not present, returns False.
-    TODO: safely parse date.
     """
-    config = get_config()
-    if "access_token" not in config or "token_expire" not in config:
-        return False
-    token_expire = datetime.strptime(config["token_expire"], DATETIME_STR_FORMAT)
-    if token_expire < datetime.now():
-        return False
-    return True
+    return TOKEN_MANAGER.is_valid()
 
 
 def ask_credentials():
@@ -47,8 +290,10 @@ def attempt_auth(username: str, password: str):
     # support hot reloading the URL endpoint
     from easytensor.urls import AUTHENTICATION_URL
 
-    response = requests.post(
-        url=AUTHENTICATION_URL, json={"username": username, "password": password}
+    response = get_client().post(
+        AUTHENTICATION_URL,
+        json={"username": username, "password": password},
+        retry=True,
     )
     resp = response.json()
     assert "access_token" in resp
@@ -60,22 +305,21 @@ def get_auth_token():
     Returns the authentication token of the user. If the user is not authenticated,
     the user is prompted to login.
     """
-    config = get_config()
-    if not check_auth():
-        username, password = ask_credentials()
-        auth_token, refresh_token = attempt_auth(username, password)
-        token_expire = (datetime.now() + TOKEN_EXPIRE_DELTA).strftime(
-            DATETIME_STR_FORMAT
-        )
-        update_config(
-            {
-                "access_token": auth_token,
-                "token_expire": token_expire,
-                "refresh_token": refresh_token,
-            }
-        )
+    auth_token = TOKEN_MANAGER.access_token()
+    if auth_token is not None:
         return auth_token
-    return config["access_token"]
+    return login()
+
+
+def login():
+    """
+    Prompts the user for credentials, authenticates and returns the new
+    access token.
+    """
+    username, password = ask_credentials()
+    auth_token, refresh_token = attempt_auth(username, password)
+    TOKEN_MANAGER.set_tokens(auth_token, refresh_token)
+    return auth_token
 
 
 def refresh_auth():
@@ -84,22 +328,15 @@ def refresh_auth():
     Returns False if refresh was not successful.
     Returns True if the refresh was successful.
     """
-    # support hot reloading the URL endpoint
-    from easytensor.urls import REFRESH_TOKEN_URL
+    return TOKEN_MANAGER.refresh()
 
-    config = get_config()
-    if "refresh_token" not in config:
-        return False
-    response = requests.post(
-        REFRESH_TOKEN_URL, json={"refresh": config["refresh_token"]}
-    )
 
-    if response.status_code == 401:
-        LOGGER.debug("Refresh token expired.")
-        return False
-    response.raise_for_status()
-    update_config({"access_token": response["access"]})
-    return True
+def start_background_refresh():
+    """
+    Keeps the access token fresh from a background thread.
+    See TokenManager.start_background_refresh.
+    """
+    TOKEN_MANAGER.start_background_refresh()
 
 
 def needs_auth(func):
@@ -107,13 +344,15 @@ def needs_auth(func):
     A decorator used to check authentication before performing
     the passed in function. If authentication is invalid or expired,
     the user is asked to provide credentials and is authenticated again.
+    Tokens close to expiry are refreshed ahead of time.
     """
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        if not check_auth() and not refresh_auth():
-            print("Access token is expired. Please reauthenticate.")
-            get_auth_token()
+        if not TOKEN_MANAGER.is_valid(TOKEN_MANAGER.margin()):
+            if not TOKEN_MANAGER.refresh() and not TOKEN_MANAGER.is_valid():
+                print("Access token is expired. Please reauthenticate.")
+                login()
         return func(*args, **kwargs)
 
     return wrapper
@@ -0,0 +1,229 @@
+"""
+A module for uploading many models in one call.
+
+Uploads run as a staged pipeline: while one model is on the wire, the next
+ones are exported and packaged. Packaged archives wait in a bounded queue,
+which caps the disk space used by archives that are ready but not yet
+uploaded. A failure only affects its own model; the other models carry on.
+"""
+import os
+import time
+import queue
+import shutil
+import threading
+import logging
+from easytensor.auth import needs_auth
+from easytensor.archive import ArchiveException
+from easytensor.compression import CompressionException
+from easytensor.config import BadConfig
+from easytensor.constants import Framework, Compression
+from easytensor.validation import BadModelFile
+from easytensor.upload import (
+    UploadException,
+    create_model_object,
+    create_query_token,
+    upload_archive,
+)
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=import-outside-toplevel
+
+# Maximum number of packaged archives waiting to be uploaded.
+DEFAULT_MAX_PACKAGED = 2
+# The errors that fail a single model of a batch. The easytensor exceptions
+# derive from BaseException, so they are listed next to Exception, while
+# KeyboardInterrupt and SystemExit still stop the whole batch.
+_ITEM_ERRORS = (
+    Exception,
+    ArchiveException,
+    BadConfig,
+    BadModelFile,
+    CompressionException,
+    UploadException,
+)
+_DONE = object()
+
+
+class UploadResult:
+    """
+    The outcome of uploading one model of a batch.
+    timings maps each stage (export, package, upload, register) that ran to
+    its duration in seconds. error holds the exception if the model failed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.model_id = None
+        self.query_token = None
+        self.size = None
+        self.error = None
+        self.timings = {}
+
+    @property
+    def ok(self):
+        """ True if the model was uploaded and registered. """
+        return self.error is None and self.model_id is not None
+
+    def as_dict(self):
+        """ Returns the result as a json serializable dict. """
+        return {
+            "name": self.name,
+            "model_id": self.model_id,
+            "query_token": self.query_token,
+            "size": self.size,
+            "error": None if self.error is None else repr(self.error),
+            "timings": dict(self.timings),
+        }
+
+    def __repr__(self):
+        return "UploadResult({})".format(self.as_dict())
+
+
+def _framework_stages(framework: Framework):
+    """
+    Returns the export and package functions of the framework.
+    export(model, **kwargs) returns the arguments of package, and
+    package(*exported, compression) returns the archive location.
+    """
+    if framework == Framework.TENSORFLOW:
+        from easytensor.tensorflow.upload import create_model_archive
+
+        def export(model_location):
+            return (model_location,)
+
+        return export, create_model_archive
+    if framework == Framework.PYTORCH:
+        from easytensor.pytorch.upload import (
+            export_model_files,
+            create_model_archive,
+        )
+
+        return export_model_files, create_model_archive
+    if framework == Framework.TRANSFORMERS:
+        from easytensor.transformers.upload import (
+            export_model_files,
+            create_model_archive,
+        )
+
+        return export_model_files, create_model_archive
+    raise ValueError("Unsupported framework {}".format(framework))
+
+
+class _Timer:
+    def __init__(self, result, stage):
+        self.result = result
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.result.timings[self.stage] = time.perf_counter() - self.start
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _package_all(items, framework, compression, results, packaged):
+    """
+    The export and package stages. Runs in its own thread.
+    """
+    from easytensor.pytorch.upload import BadModel
+    from easytensor.pytorch.weights import WeightsException, weights_metadata
+
+    errors = _ITEM_ERRORS + (BadModel, WeightsException)
+    export, package = _framework_stages(framework)
+    try:
+        for index, (_, model, kwargs) in enumerate(items):
+            result = results[index]
+            exported = None
+            try:
+                with _Timer(result, "export"):
+                    exported = export(model, **kwargs)
+                with _Timer(result, "package"):
+                    archive_location = package(*exported, compression)
+            except errors as exc:  # pylint: disable=broad-except
+                LOGGER.warning("Packaging %s failed: %s", result.name, exc)
+                result.error = exc
+                continue
+            finally:
+                # exported weights are only needed until they are packaged.
+                if framework != Framework.TENSORFLOW and exported is not None:
+                    shutil.rmtree(os.path.dirname(exported[-1]), ignore_errors=True)
+            # blocks while max_packaged archives are waiting for upload.
+            packaged.put((index, archive_location, weights_metadata(exported[0])))
+    finally:
+        packaged.put(_DONE)
+
+
+def _upload_all(framework, create_token, upload_kwargs, results, packaged):
+    """
+    The upload and register stages. Runs in the calling thread.
+    """
+    while True:
+        item = packaged.get()
+        if item is _DONE:
+            return
+        index, archive_location, metadata = item
+        result = results[index]
+        try:
+            with _Timer(result, "upload"):
+                address, result.size = upload_archive(
+                    archive_location, **upload_kwargs
+                )
+            with _Timer(result, "register"):
+                result.model_id = create_model_object(
+                    address, result.name, result.size, framework, metadata
+                )
+                if create_token:
+                    result.query_token = create_query_token(result.model_id)
+        except _ITEM_ERRORS as exc:  # pylint: disable=broad-except
+            LOGGER.warning("Uploading %s failed: %s", result.name, exc)
+            result.error = exc
+        finally:
+            _remove_quietly(archive_location)
+
+
+@needs_auth
+def upload_models(
+    items,
+    framework: Framework,
+    create_token=True,
+    compression=Compression.GZIP,
+    max_packaged=DEFAULT_MAX_PACKAGED,
+    **upload_kwargs
+):
+    """
+    Uploads many models of the same framework, packaging the next models
+    while the current one is uploaded.
+
+    items: a list of (name, model, kwargs) tuples. model and kwargs are the
+    framework specific arguments of the framework's upload_model:
+        TENSORFLOW: (name, model_location, {})
+        PYTORCH: (name, model, {"model_class_definition_file": ...,
+                                "model_weights_dir": ...})
+        TRANSFORMERS: (name, model, {"model_class_definition_file": ...,
+                                     "checkpoint_dir": ...})
+    max_packaged: how many packaged archives may wait for upload at a time.
+    Extra keyword arguments are passed to easytensor.upload.upload_archive.
+
+    Returns a list of UploadResult, in the order of items.
+    """
+    assert isinstance(framework, Framework)
+    results = [UploadResult(name) for name, _, _ in items]
+    packaged = queue.Queue(maxsize=max(1, max_packaged))
+    packager = threading.Thread(
+        target=_package_all,
+        args=(items, framework, compression, results, packaged),
+        name="easytensor-packager",
+        daemon=True,
+    )
+    packager.start()
+    _upload_all(framework, create_token, upload_kwargs, results, packaged)
+    packager.join()
+    return results
@@ -0,0 +1,244 @@
+"""
+A module for caching predictions on the client.
+
+Predictions are keyed by (model id, hash of the canonicalized instance), so
+repeated queries for the same input are answered without a round trip. The
+cache is bounded: the least recently used entries are evicted once it holds
+max_entries predictions, and entries older than ttl seconds are dropped.
+Caches can optionally be persisted under ~/.easytensor to survive restarts.
+
+Caching is opt-in and per model, see the cache argument of
+easytensor.query.QueryClient.
+"""
+import os
+import copy
+import json
+import time
+import atexit
+import hashlib
+import threading
+import collections
+import logging
+from easytensor.config import (
+    _EASYTENSOR_PATH,
+    ensure_easytensor_path,
+    write_json_atomic,
+)
+from easytensor.encoding import (
+    _is_array,
+    little_endian,
+    encode_base64,
+    decode_base64,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 4096
+# Seconds a prediction stays valid. None keeps predictions until evicted.
+DEFAULT_TTL = 60 * 60
+_CACHE_DIR = os.path.join(_EASYTENSOR_PATH, "prediction_cache")
+_FORMAT_VERSION = 1
+
+
+def _canonical_default(value):
+    """
+    json.dumps hook that replaces arrays (and numpy scalars) with their
+    dtype, shape and the digest of their little-endian bytes.
+    """
+    if _is_array(value) or hasattr(value, "dtype"):
+        array = little_endian(value)
+        if array.dtype.hasobject:
+            raise TypeError("Can't hash arrays of python objects.")
+        digest = hashlib.sha256(memoryview(array.reshape(-1)).cast("B"))
+        return {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "sha256": digest.hexdigest(),
+        }
+    raise TypeError("Can't hash values of type {}".format(type(value).__name__))
+
+
+def instance_hash(instance):
+    """
+    Returns the hex sha256 digest of the canonical form of the instance.
+    Dict keys are sorted and whitespace is dropped, so equal instances hash
+    the same whatever their key order; arrays are hashed by value.
+    """
+    canonical = json.dumps(
+        instance,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=_canonical_default,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def model_key(query_token: str):
+    """
+    Returns the id a model's predictions are cached under when only its query
+    token is known. The token itself is never stored.
+    """
+    return hashlib.sha256(query_token.encode("utf-8")).hexdigest()[:16]
+
+
+def _to_disk(value):
+    if _is_array(value):
+        return {"__array__": encode_base64(value)}
+    if isinstance(value, list):
+        return [_to_disk(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_disk(item) for key, item in value.items()}
+    return value
+
+
+def _from_disk(value):
+    if isinstance(value, dict):
+        if "__array__" in value and len(value) == 1:
+            return decode_base64(value["__array__"])
+        return {key: _from_disk(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_from_disk(item) for item in value]
+    return value
+
+
+class PredictionCache:
+    """
+    A thread-safe LRU cache of predictions with a per-entry TTL.
+    max_entries: the maximum number of cached predictions.
+    ttl: seconds a prediction stays valid, or None to never expire.
+    name: when set, the cache is loaded from and saved to
+    ~/.easytensor/prediction_cache/<name>.json. Saving happens on save(),
+    when the query client using the cache is closed, and at exit.
+
+    One cache can be shared by several clients, entries are keyed by model.
+    Predictions are copied when they are cached and when they are returned,
+    so callers can change their results without changing the cache.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, name=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dirty = False
+        if name is not None:
+            self.path = os.path.join(_CACHE_DIR, "{}.json".format(name))
+            self.load()
+            atexit.register(self.save)
+
+    def get(self, model_id: str, instance_digest: str):
+        """
+        Returns (True, prediction) if the prediction is cached and not
+        expired, (False, None) otherwise.
+        """
+        key = (model_id, instance_digest)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                del self._entries[key]
+                self._dirty = True
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            prediction = entry[1]
+        return True, copy.deepcopy(prediction)
+
+    def put(self, model_id: str, instance_digest: str, prediction):
+        """
+        Caches the prediction, evicting the least recently used entries if
+        the cache is full.
+        """
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        key = (model_id, instance_digest)
+        prediction = copy.deepcopy(prediction)
+        with self._lock:
+            self._entries[key] = (expires_at, prediction)
+            self._entries.move_to_end(key)
+            self._dirty = True
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, model_id: str = None):
+        """
+        Drops the cached predictions of the model, or of every model.
+        """
+        with self._lock:
+            if model_id is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == model_id]:
+                    del self._entries[key]
+            self._dirty = True
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counters and the number of
+        cached predictions.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """
+        Loads the persisted entries, skipping the expired ones. A missing or
+        unreadable cache file leaves the cache empty.
+        """
+        try:
+            with open(self.path) as fin:
+                stored = json.load(fin)
+            if stored.get("version") != _FORMAT_VERSION:
+                return
+            entries = stored["entries"]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return
+        now = time.time()
+        with self._lock:
+            for model_id, digest, expires_at, prediction in entries:
+                if expires_at is not None and expires_at <= now:
+                    continue
+                self._entries[(model_id, digest)] = (expires_at, _from_disk(prediction))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """
+        Writes the live entries to disk, in LRU order. Does nothing for caches
+        that aren't persisted or haven't changed since the last save.
+        """
+        if self.path is None:
+            return
+        now = time.time()
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [
+                [key[0], key[1], expires_at, _to_disk(prediction)]
+                for key, (expires_at, prediction) in self._entries.items()
+                if expires_at is None or expires_at > now
+            ]
+            self._dirty = False
+        ensure_easytensor_path()
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        try:
+            write_json_atomic(
+                self.path, {"version": _FORMAT_VERSION, "entries": entries}
+            )
+        except (OSError, TypeError, ValueError) as exc:
+            LOGGER.warning("Could not save the prediction cache: %s", exc)
@@ -0,0 +1,152 @@
+"""
+A module for the HTTP client shared by every call this library makes.
+The client owns a pooled requests.Session, so connections (and their TLS
+handshakes) are reused across calls, applies default timeouts and retries
+safely retryable requests with exponential backoff.
+"""
+import time
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from easytensor import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds.
+DEFAULT_TIMEOUT = (10, 300)
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_POOL_SIZE = 16
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+
+class HTTPClient:
+    """
+    A thin wrapper around a pooled requests.Session.
+
+    Requests are retried on connection errors, timeouts and the statuses in
+    RETRY_STATUSES when they are idempotent, or when the caller marks them as
+    safe to retry with retry=True. Seekable request bodies are rewound before
+    a retry; other streamed bodies (e.g. generators) can't be replayed and
+    must pass retry=False.
+    """
+
+    def __init__(
+        self,
+        timeout=DEFAULT_TIMEOUT,
+        max_retries=DEFAULT_MAX_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        pool_size=DEFAULT_POOL_SIZE,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._adapter = adapter
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+
+    def request(self, method, url, retry=None, **kwargs):
+        """
+        Sends a request through the pooled session and returns the response.
+        retry: whether the request may be retried. Defaults to True for
+        idempotent methods only.
+        The remaining keyword arguments are passed to requests.Session.request.
+        """
+        if retry is None:
+            retry = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if attempt and hasattr(kwargs.get("data"), "seek"):
+                # rewind seekable bodies before sending them again
+                kwargs["data"].seek(0)
+            with self._lock:
+                self.requests_sent += 1
+            tracing.current_span().add("http_requests")
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if (
+                    not retry
+                    or response.status_code not in RETRY_STATUSES
+                    or attempt >= self.max_retries
+                ):
+                    return response
+                reason = "status {}".format(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if not retry or attempt >= self.max_retries:
+                    raise
+                reason = str(exc)
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            tracing.current_span().add("http_retries")
+            LOGGER.debug(
+                "Retrying %s %s (attempt %s): %s", method, url, attempt, reason
+            )
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def get(self, url, **kwargs):
+        """ Sends a GET request. See request. """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """ Sends a POST request. See request. """
+        return self.request("POST", url, **kwargs)
+
+    def connection_stats(self):
+        """
+        Returns the number of requests sent, retries made and connections
+        opened by the client. Requests minus connections is the number of
+        times a pooled connection was reused.
+        """
+        connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+        return {
+            "requests": self.requests_sent,
+            "retries": self.retries,
+            "connections": connections,
+        }
+
+    def close(self):
+        """ Closes all pooled connections. """
+        self.session.close()
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the process-wide HTTP client, creating it on first use.
+    """
+    global _CLIENT  # pylint: disable=global-statement
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = HTTPClient()
+    return _CLIENT
+
+
+def configure_client(**kwargs):
+    """
+    Replaces the process-wide HTTP client with one created with the passed
+    settings. See HTTPClient for the available settings.
+    """
+    global _CLIENT  # pylint: disable=global-statement
+    with _CLIENT_LOCK:
+        if _CLIENT is not None:
+            _CLIENT.close()
+        _CLIENT = HTTPClient(**kwargs)
+    return _CLIENT
@@ -0,0 +1,255 @@
+"""
+A module for the compression stage used when packaging model archives.
+
+Supported modes (see easytensor.constants.Compression):
+NONE: gzip framing with stored (uncompressed) blocks. Cheapest to produce and
+    still readable by any gzip reader.
+GZIP: single threaded gzip, the historical default.
+PARALLEL_GZIP: the stream is cut into blocks that are compressed concurrently,
+    each into its own gzip member. Multi-member gzip files are valid gzip and
+    decompress with gzip, pigz and python's tarfile alike.
+ZSTD: zstandard compression, requires the optional `zstandard` package and a
+    backend that accepts zstd archives.
+AUTO: parallel gzip where each archive member is sampled first, and members
+    that look incompressible (e.g. float weight tensors) are stored instead
+    of compressed.
+"""
+import os
+import gzip
+import math
+import zlib
+import struct
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from easytensor.constants import Compression
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_LEVEL = 6
+STORE_LEVEL = 0
+# Size of the blocks compressed concurrently in PARALLEL_GZIP and AUTO modes.
+BLOCK_SIZE = 1024 * 1024
+# Members whose sampled byte entropy is above this many bits per byte are
+# stored instead of compressed in AUTO mode. Float32 weights sit around 7.3.
+AUTO_ENTROPY_THRESHOLD = 7.0
+AUTO_SAMPLE_SIZE = 64 * 1024
+AUTO_SAMPLES = 3
+
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class CompressionException(BaseException):
+    """ A simple exception for unsupported compression settings."""
+
+
+def gzip_member(data, level=DEFAULT_LEVEL):
+    """
+    Compresses data into a complete, reproducible gzip member.
+    Releases the GIL while compressing, so it can run in a thread pool.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data) & 0xFFFFFFFF)
+    return _GZIP_HEADER + body + trailer
+
+
+class GzipWriter:
+    """
+    A single threaded gzip writer, producing one gzip member.
+    """
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL):
+        self.fileobj = fileobj
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._crc = 0
+        self._size = 0
+        self.fileobj.write(_GZIP_HEADER)
+
+    def write(self, data):
+        """ Compresses data into the wrapped file. """
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self.fileobj.write(self._compressor.compress(data))
+        return len(data)
+
+    def set_level(self, level):  # pylint: disable=unused-argument
+        """ The level is fixed for single stream gzip. """
+
+    def close(self):
+        """ Finishes the gzip member. Does not close the wrapped file. """
+        self.fileobj.write(self._compressor.flush())
+        self.fileobj.write(
+            struct.pack("<II", self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF)
+        )
+
+
+class ParallelGzipWriter:
+    """
+    A gzip writer that compresses fixed sized blocks concurrently and writes
+    them, in order, as consecutive gzip members.
+    At most 2 * workers blocks are held in memory at a time.
+    """
+
+    def __init__(
+        self, fileobj, level=DEFAULT_LEVEL, block_size=BLOCK_SIZE, workers=None
+    ):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        workers = workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = 2 * workers
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """ Buffers data and compresses it in blocks. """
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def set_level(self, level):
+        """
+        Compresses everything written from now on at the passed level.
+        The current partial block is cut off so it keeps the previous level.
+        """
+        if level == self.level:
+            return
+        self._flush_block()
+        self.level = level
+
+    def _flush_block(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(gzip_member, block, self.level))
+        while len(self._pending) > self._max_pending:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        """ Writes the remaining blocks. Does not close the wrapped file. """
+        try:
+            self._flush_block()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+class ZstdWriter:
+    """
+    A zstandard writer using all available cores.
+    """
+
+    def __init__(self, fileobj, level=3):
+        try:
+            import zstandard  # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise CompressionException(
+                "zstd compression requires the zstandard package. "
+                "Install it with `pip install zstandard`."
+            ) from exc
+        compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+        self._writer = compressor.stream_writer(fileobj, closefd=False)
+
+    def write(self, data):
+        """ Compresses data into the wrapped file. """
+        return self._writer.write(data)
+
+    def set_level(self, level):  # pylint: disable=unused-argument
+        """ The level is fixed for zstd. """
+
+    def close(self):
+        """ Finishes the zstd frame. Does not close the wrapped file. """
+        self._writer.close()
+
+
+def open_compressor(fileobj, compression=Compression.GZIP):
+    """
+    Returns a writer that compresses everything written to it into fileobj
+    with the passed compression mode. The writer must be closed to finish the
+    compressed stream.
+    """
+    if not isinstance(compression, Compression):
+        compression = Compression(compression)
+    if compression == Compression.NONE:
+        return GzipWriter(fileobj, level=STORE_LEVEL)
+    if compression == Compression.GZIP:
+        return GzipWriter(fileobj)
+    if compression in (Compression.PARALLEL_GZIP, Compression.AUTO):
+        return ParallelGzipWriter(fileobj)
+    if compression == Compression.ZSTD:
+        return ZstdWriter(fileobj)
+    raise CompressionException("Unsupported compression {}".format(compression))
+
+
+def open_decompressor(fileobj):
+    """
+    Returns a reader of the decompressed content of fileobj, a seekable file
+    compressed in any of the supported modes, detected from its first bytes.
+    Uncompressed files are returned as is.
+    """
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+    if magic.startswith(_GZIP_MAGIC):
+        # reads every member of multi-member gzip files.
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if magic == _ZSTD_MAGIC:
+        try:
+            import zstandard  # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise CompressionException(
+                "Reading zstd archives requires the zstandard package. "
+                "Install it with `pip install zstandard`."
+            ) from exc
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+
+def byte_entropy(data):
+    """
+    Returns the Shannon entropy of data in bits per byte, between 0 and 8.
+    """
+    if not data:
+        return 0.0
+    total = len(data)
+    entropy = 0.0
+    for count in collections.Counter(data).values():
+        probability = count / total
+        entropy -= probability * math.log2(probability)
+    return entropy
+
+
+def sample_file(path, sample_size=AUTO_SAMPLE_SIZE, samples=AUTO_SAMPLES):
+    """
+    Returns up to `samples` evenly spaced chunks of the file, concatenated.
+    """
+    size = os.path.getsize(path)
+    if size <= sample_size * samples:
+        with open(path, "rb") as fin:
+            return fin.read()
+    step = (size - sample_size) // (samples - 1) if samples > 1 else 0
+    chunks = []
+    with open(path, "rb") as fin:
+        for index in range(samples):
+            fin.seek(index * step)
+            chunks.append(fin.read(sample_size))
+    return b"".join(chunks)
+
+
+def level_for_file(path):
+    """
+    Returns the compression level AUTO mode uses for the file at path.
+    """
+    entropy = byte_entropy(sample_file(path))
+    if entropy > AUTO_ENTROPY_THRESHOLD:
+        LOGGER.debug("Storing %s uncompressed (entropy %.2f)", path, entropy)
+        return STORE_LEVEL
+    return DEFAULT_LEVEL
@@ -1,29 +1,111 @@
 """
 A module for managing the configuration of the easytensor package.
+
+The config is cached in memory and only re-read from disk when the file's
+modification time, size or inode change. Writes are atomic (temporary file
+and rename) and serialized with an advisory file lock, so several worker
+processes can safely share one ~/.easytensor directory.
 """
 import os
 from pathlib import Path
 import json
+import tempfile
+import threading
+import contextlib
 import logging
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 LOGGER = logging.getLogger(__name__)
 
 _EASYTENSOR_PATH = os.path.join(str(Path.home()), ".easytensor")
 _CONFIG_PATH = os.path.join(_EASYTENSOR_PATH, "config.json")
+_LOCK_PATH = _CONFIG_PATH + ".lock"
+
+# The last config read from disk and the stat key it was read at.
+_CACHE = {"key": None, "config": None}
+_THREAD_LOCK = threading.RLock()
 
 
 class BadConfig(BaseException):
     """ A simple exception for errors during config management."""
 
 
+@contextlib.contextmanager
+def config_lock():
+    """
+    Holds an exclusive advisory lock on the config across threads and
+    processes. Where file locking is unavailable only threads are serialized.
+    """
+    with _THREAD_LOCK:
+        ensure_easytensor_path()
+        with open(_LOCK_PATH, "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            elif msvcrt is not None:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                elif msvcrt is not None:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _stat_key():
+    try:
+        stat = os.stat(_CONFIG_PATH)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def _read_config():
+    """
+    Reads and validates the config from disk. Raises BadConfig if the file is
+    missing or malformed.
+    """
+    try:
+        with open(_CONFIG_PATH) as fin:
+            config = json.load(fin)
+    except (OSError, json.decoder.JSONDecodeError) as exc:
+        raise BadConfig("config is malformed.") from exc
+    if not isinstance(config, dict):
+        raise BadConfig("config is malformed.")
+    return config
+
+
 def get_config():
     """
     Returns the config for the user.
     If no config object is stored, it will create a new one and return it.
+    Only touches the disk if the config changed since it was last read.
     """
+    key = _stat_key()
+    with _THREAD_LOCK:
+        if key is not None and key == _CACHE["key"]:
+            return dict(_CACHE["config"])
+        if key is not None:
+            try:
+                config = _read_config()
+            except BadConfig:
+                pass
+            else:
+                _CACHE["key"], _CACHE["config"] = key, config
+                return dict(config)
     ensure_easytensor_config()
-    with open(_CONFIG_PATH) as fin:
-        return json.load(fin)
+    with _THREAD_LOCK:
+        return dict(_CACHE["config"])
 
 
 def ensure_easytensor_path():
@@ -31,48 +113,73 @@ def ensure_easytensor_path():
     Creates the easytensor config path if it doesn't exist.
     """
     if not os.path.isdir(_EASYTENSOR_PATH):
-        os.mkdir(_EASYTENSOR_PATH)
+        os.makedirs(_EASYTENSOR_PATH, exist_ok=True)
 
 
 def ensure_easytensor_config():
     """
     Checks that there is a config file for the user and creates one if not.
     """
-    ensure_easytensor_path()
-    # ensure file exists
-    if not os.path.isfile(_CONFIG_PATH):
-        with open(_CONFIG_PATH, "w") as fout:
-            json.dump({}, fout, indent=2)
-        return
-
-    # if it exists, ensure that it's valid json
-    try:
-        with open(_CONFIG_PATH) as fin:
-            config = json.load(fin)
-            if not isinstance(config, dict):
-                raise BadConfig("config is malformed.")
-    except (OSError, json.decoder.JSONDecodeError):
-        LOGGER.warning(
-            "Config at %s is malformed. Repacing with an empty config.", _CONFIG_PATH
-        )
-        os.remove(_CONFIG_PATH)
-        with open(_CONFIG_PATH, "w") as fout:
-            json.dump({}, fout, indent=2)
+    with config_lock():
+        # another process may have fixed the config while we waited
+        try:
+            config = _read_config()
+        except BadConfig:
+            if os.path.isfile(_CONFIG_PATH):
+                LOGGER.warning(
+                    "Config at %s is malformed. Repacing with an empty config.",
+                    _CONFIG_PATH,
+                )
+            config = {}
+            _write_config(config)
+        else:
+            _CACHE["key"], _CACHE["config"] = _stat_key(), config
 
 
 def update_config(updates: dict):
     """
     Updates the config dictionary with the dictioanry that is passed.
+    The read-modify-write happens under the config lock, so concurrent
+    updates from other processes are not lost.
     """
-    current = get_config()
-    current.update(updates)
-    _store_config(current)
+    with config_lock():
+        try:
+            current = _read_config()
+        except BadConfig:
+            current = {}
+        current.update(updates)
+        _write_config(current)
 
 
 def _store_config(config: dict):
     """
     Stoers the config dictionary into the config path.
     """
-    ensure_easytensor_config()
-    with open(_CONFIG_PATH, "w") as fout:
-        json.dump(config, fout, indent=2)
+    with config_lock():
+        _write_config(config)
+
+
+def _write_config(config: dict):
+    """
+    Atomically writes the config and refreshes the cache. Expects the config
+    lock to be held.
+    """
+    write_json_atomic(_CONFIG_PATH, config)
+    _CACHE["key"], _CACHE["config"] = _stat_key(), dict(config)
+
+
+def write_json_atomic(path: str, obj):
+    """
+    Writes obj as json to path through a temporary file that is renamed over
+    the destination, so readers never see a partially written file.
+    """
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(file_descriptor, "w") as fout:
+            json.dump(obj, fout, indent=2)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
@@ -12,3 +12,51 @@ class Framework(Enum):
     TENSORFLOW = "TF"
     PYTORCH = "PT"
     TRANSFORMERS = "TR"
+
+
+class Compression(Enum):
+    """
+    An enum for the compression modes used when packaging model archives.
+    See easytensor/compression.py.
+    """
+
+    NONE = "none"
+    GZIP = "gzip"
+    PARALLEL_GZIP = "pgzip"
+    ZSTD = "zstd"
+    AUTO = "auto"
+
+
+class WeightsFormat(Enum):
+    """
+    An enum for the formats PyTorch weights are exported in.
+    TORCH: a torch.save pickle of the state_dict, stored as model.pt.
+    SAFETENSORS: a safetensors file, stored as model.safetensors. Tensors are
+    serialized one at a time straight into the archive, and the server can
+    memory-map the file instead of unpickling it.
+    """
+
+    TORCH = "torch"
+    SAFETENSORS = "safetensors"
+
+
+class Precision(Enum):
+    """
+    An enum for the reduced precisions PyTorch weights can be converted to
+    when they are exported. Only floating point tensors are converted.
+    """
+
+    FLOAT16 = "fp16"
+    BFLOAT16 = "bf16"
+
+
+class Priority(Enum):
+    """
+    An enum for the priority of uploads, see easytensor.scheduler.
+    Transfers of more urgent uploads are started first, and while they run,
+    less urgent transfers yield their share of a bandwidth budget.
+    """
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
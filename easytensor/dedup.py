@@ -0,0 +1,124 @@
+"""
+A module for skipping the upload of archives that were already uploaded.
+Archives are identified by the sha256 digest of their content. A local index
+under ~/.easytensor maps digests to the remote address they were uploaded
+to, and the backend is asked to confirm the content still exists before the
+transfer is skipped.
+"""
+import os
+import json
+import threading
+import logging
+import requests
+from easytensor.config import (
+    _EASYTENSOR_PATH,
+    ensure_easytensor_path,
+    write_json_atomic,
+)
+from easytensor.auth import get_auth_token
+from easytensor.client import get_client
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=import-outside-toplevel
+
+_INDEX_PATH = os.path.join(_EASYTENSOR_PATH, "content_index.json")
+# Maximum number of digests kept in the local index. Oldest entries are
+# dropped first.
+INDEX_MAX_ENTRIES = 10000
+
+_LOCK = threading.Lock()
+
+
+def _load_index():
+    try:
+        with open(_INDEX_PATH) as fin:
+            index = json.load(fin)
+    except (OSError, json.decoder.JSONDecodeError):
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def get_local_address(content_hash: str):
+    """
+    Returns the address the content was last uploaded to, or None.
+    """
+    with _LOCK:
+        return _load_index().get(content_hash)
+
+
+def get_content_hash(address: str):
+    """
+    Returns the digest of the content last uploaded to address, or None.
+    """
+    with _LOCK:
+        index = _load_index()
+    for content_hash, known_address in reversed(list(index.items())):
+        if known_address == address:
+            return content_hash
+    return None
+
+
+def record_upload(content_hash: str, address: str):
+    """
+    Records that the content with the passed digest was uploaded to address.
+    """
+    with _LOCK:
+        ensure_easytensor_path()
+        index = _load_index()
+        index.pop(content_hash, None)
+        index[content_hash] = address
+        while len(index) > INDEX_MAX_ENTRIES:
+            del index[next(iter(index))]
+        write_json_atomic(_INDEX_PATH, index)
+
+
+def forget_upload(content_hash: str):
+    """
+    Removes the content with the passed digest from the local index.
+    """
+    with _LOCK:
+        index = _load_index()
+        if index.pop(content_hash, None) is not None:
+            write_json_atomic(_INDEX_PATH, index)
+
+
+def lookup_remote(content_hash: str, address: str = None):
+    """
+    Asks the backend whether an upload with the passed digest exists.
+    Returns the address of the existing upload, or None.
+    """
+    # support hot reloading the URL endpoint
+    from easytensor.urls import UPLOAD_LOOKUP_URL
+
+    payload = {"hash": content_hash}
+    if address is not None:
+        payload["address"] = address
+    response = get_client().post(
+        UPLOAD_LOOKUP_URL,
+        json=payload,
+        headers={"Authorization": "Bearer {}".format(get_auth_token())},
+        retry=True,
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    res = response.json()
+    if not res.get("exists"):
+        return None
+    return res.get("address", address)
+
+
+def find_existing_upload(content_hash: str):
+    """
+    Returns the address of an existing upload of the content, or None if it
+    has to be uploaded. A stale local entry is removed from the index.
+    """
+    local_address = get_local_address(content_hash)
+    try:
+        address = lookup_remote(content_hash, local_address)
+    except requests.RequestException as exc:
+        LOGGER.debug("Could not look up existing upload: %s", exc)
+        return None
+    if address is None and local_address is not None:
+        forget_upload(content_hash)
+    return address
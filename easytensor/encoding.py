@@ -0,0 +1,290 @@
+"""
+A module for encoding query payloads.
+
+Three encodings are supported for the instances sent to a served model:
+json: every instance is sent as nested JSON lists (`array.tolist()`).
+    Works with any server, but formatting floats as text is slow and large.
+base64: instances are sent in JSON as {"b64": ..., "dtype": ..., "shape": ...}
+    objects holding the raw little-endian bytes of the array.
+binary: the request body is a tensor frame, see encode_frame. Contiguous
+    little-endian arrays are sent straight from their memory, without copies.
+
+numpy is only imported when arrays are encoded or decoded.
+"""
+import io
+import json
+import bisect
+import base64
+import struct
+import logging
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=import-outside-toplevel
+
+JSON = "json"
+BASE64 = "base64"
+BINARY = "binary"
+ENCODINGS = (JSON, BASE64, BINARY)
+
+FRAME_CONTENT_TYPE = "application/x-easytensor-tensor"
+FRAME_MAGIC = b"ETT\x01"
+# Tensors in a frame start at multiples of this many bytes, so the receiver
+# can map them without copying.
+FRAME_ALIGNMENT = 64
+
+
+class EncodingException(BaseException):
+    """ A simple exception for payloads that can't be encoded or decoded."""
+
+
+def _is_array(value):
+    return hasattr(value, "__array_interface__") or hasattr(value, "__array__")
+
+
+def little_endian(array):
+    """
+    Returns the array as a C contiguous little-endian numpy array. Arrays
+    that already are are returned as is, without a copy.
+    """
+    import numpy as np
+
+    array = np.asarray(array)
+    if array.dtype.byteorder == ">":
+        array = array.astype(array.dtype.newbyteorder("<"))
+    if not array.flags["C_CONTIGUOUS"]:
+        array = array.copy(order="C")
+    return array
+
+
+def _pad(size):
+    return -size % FRAME_ALIGNMENT
+
+
+class FrameReader(io.RawIOBase):
+    """
+    A seekable, file-like view over a tensor frame. Reading returns slices of
+    the original array buffers, so array data is never copied into a joined
+    request body. len() is the size of the frame, which lets requests send a
+    Content-Length instead of chunked encoding.
+    """
+
+    def __init__(self, buffers):
+        super().__init__()
+        self._buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+        # the position of the start of every buffer in the frame.
+        self._starts = []
+        self._size = 0
+        for buffer in self._buffers:
+            self._starts.append(self._size)
+            self._size += len(buffer)
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        if self._index >= len(self._buffers):
+            return self._size
+        return self._starts[self._index] + self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence == io.SEEK_END:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence {}.".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}.".format(offset))
+        if offset >= self._size:
+            self._index, self._offset = len(self._buffers), 0
+            return offset
+        # the last buffer starting at or before offset, skipping empty ones.
+        self._index = bisect.bisect_right(self._starts, offset) - 1
+        self._offset = offset - self._starts[self._index]
+        return offset
+
+    def read(self, size=-1):
+        while self._index < len(self._buffers):
+            buffer = self._buffers[self._index]
+            if self._offset < len(buffer):
+                end = len(buffer) if size < 0 else self._offset + size
+                chunk = buffer[self._offset : end]
+                self._offset += len(chunk)
+                return chunk
+            self._index += 1
+            self._offset = 0
+        return b""
+
+
+def encode_frame(arrays):
+    """
+    Encodes the arrays into a tensor frame and returns it as a FrameReader.
+
+    Layout:
+        4 bytes magic b"ETT\\x01"
+        4 bytes little-endian uint32 length of the header
+        header: utf-8 JSON {"tensors": [{"dtype", "shape", "offset", "nbytes"}]}
+        padding up to FRAME_ALIGNMENT
+        tensor data, each tensor padded to FRAME_ALIGNMENT. Offsets are
+        relative to the start of the data section.
+    """
+    arrays = [little_endian(array) for array in arrays]
+    tensors = []
+    offset = 0
+    for array in arrays:
+        if array.dtype.hasobject:
+            raise EncodingException(
+                "Can't encode arrays of dtype {} in a frame.".format(array.dtype)
+            )
+        tensors.append(
+            {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+                "nbytes": array.nbytes,
+            }
+        )
+        offset += array.nbytes + _pad(array.nbytes)
+    header = json.dumps({"tensors": tensors}).encode("utf-8")
+    prefix = FRAME_MAGIC + struct.pack("<I", len(header)) + header
+    buffers = [prefix, b"\x00" * _pad(len(prefix))]
+    for array in arrays:
+        buffers.append(array.reshape(-1).view("u1") if array.size else b"")
+        buffers.append(b"\x00" * _pad(array.nbytes))
+    return FrameReader(buffers)
+
+
+def decode_frame(data):
+    """
+    Decodes a tensor frame into a list of numpy arrays. The arrays are
+    read-only views into data, nothing is copied.
+    Raises EncodingException if the frame is truncated or corrupt.
+    """
+    data = memoryview(data).cast("B")
+    if bytes(data[:4]) != FRAME_MAGIC:
+        raise EncodingException("Not a tensor frame.")
+    if len(data) < 8:
+        raise EncodingException("Truncated tensor frame header.")
+    (header_size,) = struct.unpack("<I", data[4:8])
+    start = 8 + header_size
+    if start > len(data):
+        raise EncodingException("Truncated tensor frame header.")
+    try:
+        header = json.loads(bytes(data[8:start]).decode("utf-8"))
+        tensors = header["tensors"]
+    except (ValueError, TypeError, KeyError) as exc:
+        raise EncodingException("Corrupt tensor frame header: {}".format(exc)) from exc
+    start += _pad(start)
+    try:
+        return [_frame_tensor(data, start, tensor) for tensor in tensors]
+    except (ValueError, TypeError, KeyError) as exc:
+        raise EncodingException("Corrupt tensor frame: {}".format(exc)) from exc
+
+
+def _frame_tensor(data, start, tensor):
+    """ Returns the tensor of a frame header as a view into data. """
+    import numpy as np
+
+    dtype = np.dtype(tensor["dtype"])
+    shape = [int(dimension) for dimension in tensor["shape"]]
+    nbytes = int(tensor["nbytes"])
+    offset = start + int(tensor["offset"])
+    if (
+        dtype.hasobject
+        or any(dimension < 0 for dimension in shape)
+        or nbytes != dtype.itemsize * int(np.prod(shape))
+    ):
+        raise ValueError("bad dtype, shape or size in {}".format(tensor))
+    if offset < start or offset + nbytes > len(data):
+        raise EncodingException(
+            "Truncated tensor frame: a tensor ends at byte {} of {}.".format(
+                offset + nbytes, len(data)
+            )
+        )
+    array = np.frombuffer(data[offset : offset + nbytes], dtype=dtype)
+    return array.reshape(shape)
+
+
+def encode_base64(array):
+    """
+    Encodes the array into a {"b64", "dtype", "shape"} JSON object.
+    """
+    array = little_endian(array)
+    return {
+        "b64": base64.b64encode(memoryview(array).cast("B")).decode("ascii"),
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+    }
+
+
+def decode_base64(obj):
+    """
+    Decodes a {"b64", "dtype", "shape"} JSON object into a numpy array.
+    """
+    import numpy as np
+
+    array = np.frombuffer(base64.b64decode(obj["b64"]), dtype=np.dtype(obj["dtype"]))
+    return array.reshape(obj["shape"])
+
+
+def _to_json(instance):
+    if _is_array(instance) and hasattr(instance, "tolist"):
+        return instance.tolist()
+    return instance
+
+
+def encode_instances(instances, encoding=JSON):
+    """
+    Encodes the instances of a query and returns the keyword arguments of the
+    HTTP request: either {"json": ...} or {"data": ..., "headers": ...}.
+    """
+    if encoding == JSON:
+        return {"json": {"instances": [_to_json(instance) for instance in instances]}}
+    if encoding == BASE64:
+        return {
+            "json": {
+                "instances": [
+                    encode_base64(instance) if _is_array(instance) else instance
+                    for instance in instances
+                ]
+            }
+        }
+    if encoding == BINARY:
+        return {
+            "data": encode_frame(instances),
+            "headers": {"Content-Type": FRAME_CONTENT_TYPE},
+        }
+    raise EncodingException(
+        "Unknown encoding {}. Expected one of {}".format(encoding, ENCODINGS)
+    )
+
+
+def _decode_json_value(value):
+    if isinstance(value, dict) and "b64" in value and "dtype" in value:
+        return decode_base64(value)
+    return value
+
+
+def decode_response(response):
+    """
+    Decodes the body of a query response. Tensor frames are decoded into
+    numpy arrays, as are base64 encoded tensors in JSON responses. Anything
+    else is returned as parsed JSON.
+    """
+    content_type = response.headers.get("Content-Type", "")
+    if content_type.startswith(FRAME_CONTENT_TYPE):
+        return {"predictions": decode_frame(response.content)}
+    body = response.json()
+    if isinstance(body, dict) and isinstance(body.get("predictions"), list):
+        body["predictions"] = [
+            _decode_json_value(value) for value in body["predictions"]
+        ]
+    return body
@@ -0,0 +1,154 @@
+"""
+A module for keeping a local journal of in-flight multipart uploads.
+Each entry is keyed by the hash of the archive being uploaded and records
+the remote model address and the parts that were already committed, so an
+interrupted upload of the same archive can pick up where it stopped.
+Entries live under ~/.easytensor/uploads and are garbage-collected by age
+and total size.
+"""
+import os
+import json
+import time
+import threading
+import logging
+from easytensor.config import (
+    _EASYTENSOR_PATH,
+    ensure_easytensor_path,
+    write_json_atomic,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+_JOURNAL_PATH = os.path.join(_EASYTENSOR_PATH, "uploads")
+# Entries that haven't been updated for this many seconds are removed.
+JOURNAL_MAX_AGE = 7 * 24 * 60 * 60
+# Oldest entries are removed until the journal fits in this many bytes.
+JOURNAL_MAX_SIZE = 16 * 1024 * 1024
+
+_LOCK = threading.Lock()
+
+
+def ensure_journal_path():
+    """
+    Creates the journal directory if it doesn't exist.
+    """
+    ensure_easytensor_path()
+    if not os.path.isdir(_JOURNAL_PATH):
+        os.makedirs(_JOURNAL_PATH, exist_ok=True)
+
+
+def _entry_path(archive_hash: str):
+    return os.path.join(_JOURNAL_PATH, archive_hash + ".json")
+
+
+def _write_entry(entry: dict):
+    """
+    Atomically writes the entry, so a crash never leaves a partial entry.
+    """
+    ensure_journal_path()
+    entry["updated"] = time.time()
+    write_json_atomic(_entry_path(entry["hash"]), entry)
+
+
+def get_entry(archive_hash: str):
+    """
+    Returns the journal entry of the archive with the passed hash or None.
+    """
+    try:
+        with open(_entry_path(archive_hash)) as fin:
+            entry = json.load(fin)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+    if not isinstance(entry, dict) or entry.get("hash") != archive_hash:
+        return None
+    return entry
+
+
+def start_entry(archive_hash: str, address: str, size: int, chunk_size: int):
+    """
+    Records the start of a multipart upload and returns the new entry.
+    """
+    entry = {
+        "hash": archive_hash,
+        "address": address,
+        "size": size,
+        "chunk_size": chunk_size,
+        "upload_id": None,
+        "parts": {},
+        "created": time.time(),
+    }
+    with _LOCK:
+        _write_entry(entry)
+    return entry
+
+
+def set_upload_id(entry: dict, upload_id: str):
+    """
+    Records the ID the backend assigned to the multipart upload.
+    """
+    with _LOCK:
+        entry["upload_id"] = upload_id
+        _write_entry(entry)
+
+
+def commit_part(entry: dict, part_number: int, offset: int, length: int, etag: str):
+    """
+    Records that the byte range [offset, offset + length) was uploaded as
+    the passed part. Safe to call from multiple upload threads.
+    """
+    with _LOCK:
+        entry["parts"][str(part_number)] = {
+            "offset": offset,
+            "length": length,
+            "etag": etag,
+        }
+        _write_entry(entry)
+
+
+def committed_parts(entry: dict):
+    """
+    Returns a dict of part number to ETag for the parts already uploaded.
+    """
+    return {int(number): part["etag"] for number, part in entry["parts"].items()}
+
+
+def remove_entry(archive_hash: str):
+    """
+    Removes the entry of the archive with the passed hash, if any.
+    """
+    with _LOCK:
+        try:
+            os.remove(_entry_path(archive_hash))
+        except FileNotFoundError:
+            pass
+
+
+def collect_garbage(max_age=JOURNAL_MAX_AGE, max_size=JOURNAL_MAX_SIZE):
+    """
+    Removes entries older than max_age seconds, then removes the oldest
+    entries until the journal takes at most max_size bytes.
+    """
+    if not os.path.isdir(_JOURNAL_PATH):
+        return
+    now = time.time()
+    entries = []
+    with _LOCK:
+        for filename in os.listdir(_JOURNAL_PATH):
+            path = os.path.join(_JOURNAL_PATH, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > max_age:
+                LOGGER.debug("Removing stale upload journal entry %s", path)
+                os.remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+            LOGGER.debug("Removing upload journal entry %s to free space", path)
+            os.remove(path)
+            total_size -= size
@@ -0,0 +1,270 @@
+"""
+A module for building gzip archives incrementally from cached members.
+
+A gzip file can hold several consecutive members, and gunzip (and tarfile)
+read them as one stream. Archives built here compress every tar entry
+(header, data and padding) as its own gzip member, and cache the compressed
+members of regular files under ~/.easytensor/member_cache. Rebuilding the
+archive of a directory where only a few files changed, like a SavedModel
+whose variables were retrained, only compresses those files again; the
+other members are copied from the cache.
+
+Cached members are looked up by content: an index maps each file's path,
+size and mtime to its sha256 digest, so unchanged files aren't even read,
+and the member itself is stored under a key derived from the digest, the tar
+header and the compression level. Entries are sorted and normalized like in
+easytensor.archive, so identical inputs give byte-identical archives,
+whether or not their members came from the cache.
+"""
+import io
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from easytensor import tracing
+from easytensor.archive import (
+    _HashingWriter,
+    _normalize_member,
+    _record_digest,
+    _walk_members,
+    file_digest,
+)
+from easytensor.compression import (
+    DEFAULT_LEVEL,
+    STORE_LEVEL,
+    GzipWriter,
+    gzip_member,
+    level_for_file,
+)
+from easytensor.config import (
+    _EASYTENSOR_PATH,
+    ensure_easytensor_path,
+    write_json_atomic,
+)
+from easytensor.constants import Compression
+
+LOGGER = logging.getLogger(__name__)
+
+_CACHE_DIR = os.path.join(_EASYTENSOR_PATH, "member_cache")
+# Oldest members are removed once the cache grows past this many bytes.
+MEMBER_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# Compressions whose archives can be built from cached gzip members.
+CACHEABLE_COMPRESSIONS = (
+    Compression.NONE,
+    Compression.GZIP,
+    Compression.PARALLEL_GZIP,
+    Compression.AUTO,
+)
+
+_LOCK = threading.Lock()
+
+
+class MemberCache:
+    """
+    The on-disk cache of compressed tar members.
+    Counts the members reused (hits) and compressed (misses) by this
+    instance.
+    """
+
+    def __init__(self, directory=_CACHE_DIR, max_bytes=MEMBER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._index_changed = False
+        self._counter_lock = threading.Lock()
+
+    def _content_digest(self, path):
+        """
+        Returns the sha256 digest of the file, read from the index when its
+        size and mtime haven't changed.
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        known = self._index.get(key)
+        if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = file_digest(path)
+        self._index[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._index_changed = True
+        return digest
+
+    def _compress(self, path, header, size, level, location):
+        """
+        Writes the gzip member of the tar entry to location, atomically.
+        """
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(descriptor, "wb") as fout:
+                writer = GzipWriter(fout, level)
+                writer.write(header)
+                with open(path, "rb") as fin:
+                    for block in iter(lambda: fin.read(COPY_BUFFER_SIZE), b""):
+                        writer.write(block)
+                writer.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+                writer.close()
+            os.replace(temporary, location)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def member(self, path, header, size, level):
+        """
+        Returns the location of the compressed member of the file, with the
+        passed tar header, compressing it first if it isn't cached.
+        """
+        digest = self._content_digest(path)
+        key = hashlib.sha256(
+            header + digest.encode("ascii") + str(level).encode("ascii")
+        ).hexdigest()
+        location = os.path.join(self.directory, key + ".gz")
+        hit = os.path.isfile(location)
+        if hit:
+            # keep recently used members when the cache is trimmed.
+            os.utime(location)
+        else:
+            self._compress(path, header, size, level, location)
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return location
+
+    def __enter__(self):
+        _LOCK.acquire()
+        ensure_easytensor_path()
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path) as fin:
+                self._index = json.load(fin)
+        except (OSError, ValueError):
+            self._index = {}
+        self._index_changed = False
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if self._index_changed:
+                # drop files that were removed since they were cached.
+                self._index = {
+                    key: value
+                    for key, value in self._index.items()
+                    if os.path.exists(key)
+                }
+                write_json_atomic(self.index_path, self._index)
+            self.trim()
+        finally:
+            _LOCK.release()
+
+    def trim(self):
+        """
+        Removes the least recently used members until the cache fits in
+        max_bytes.
+        """
+        members = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".gz"):
+                stat = os.stat(os.path.join(self.directory, name))
+                members.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in members)
+        for _, size, name in sorted(members):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def _level(compression, path):
+    if compression == Compression.NONE:
+        return STORE_LEVEL
+    if compression == Compression.AUTO:
+        return level_for_file(path)
+    return DEFAULT_LEVEL
+
+
+def write_cached_archive(
+    fileobj, members, compression=Compression.GZIP, cache=None, workers=None
+):
+    """
+    Writes a multi-member gzip tar archive of the passed members into
+    fileobj, reusing the cached compressed members of unchanged files.
+    members: a list of (path, arcname) tuples.
+    compression: one of CACHEABLE_COMPRESSIONS.
+    cache: the MemberCache to use. Defaults to the one in ~/.easytensor.
+    workers: the number of files hashed and compressed concurrently.
+    Members are still written in order.
+    """
+    compression = Compression(compression)
+    if compression not in CACHEABLE_COMPRESSIONS:
+        raise ValueError(
+            "{} archives can't be built from cached members.".format(
+                compression.value
+            )
+        )
+    cache = cache or MemberCache()
+    # gettarinfo needs an archive, e.g. to detect hard links between members.
+    tarout = tarfile.open(fileobj=io.BytesIO(), mode="w")
+    offset = 0
+    span = tracing.current_span()
+    with cache, ThreadPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1,
+        thread_name_prefix="easytensor-member",
+    ) as executor:
+        entries = []
+        for path, arcname in _walk_members(members):
+            tarinfo = _normalize_member(tarout.gettarinfo(path, arcname))
+            header = tarinfo.tobuf(tarout.format, tarout.encoding, tarout.errors)
+            level = _level(compression, path) if tarinfo.isreg() else DEFAULT_LEVEL
+            if tarinfo.isreg():
+                member = executor.submit(
+                    cache.member, path, header, tarinfo.size, level
+                )
+                span.add("bytes_in", tarinfo.size)
+            else:
+                member = None
+            entries.append((tarinfo, header, level, member))
+        for tarinfo, header, level, member in entries:
+            offset += len(header)
+            if member is None:
+                fileobj.write(gzip_member(header, level))
+                continue
+            with open(member.result(), "rb") as fin:
+                shutil.copyfileobj(fin, fileobj, COPY_BUFFER_SIZE)
+            offset += tarinfo.size + (-tarinfo.size % tarfile.BLOCKSIZE)
+        # the end of archive marker, padded to a full record like tarfile's
+        # stream mode does.
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(offset + end) % tarfile.RECORDSIZE
+        fileobj.write(gzip_member(b"\0" * end, DEFAULT_LEVEL))
+    span.set("cached_members", cache.hits)
+    span.set("compressed_members", cache.misses)
+    LOGGER.debug(
+        "Reused %s cached members, compressed %s.", cache.hits, cache.misses
+    )
+
+
+@tracing.traced("easytensor.create_archive", member_cache=True)
+def create_cached_archive(members, compression=Compression.GZIP, cache=None):
+    """
+    Creates a temporary archive of the passed members from cached members
+    and returns its location. See write_cached_archive.
+    """
+    _, tar_location = tempfile.mkstemp()
+    with open(tar_location, "wb") as fout:
+        writer = _HashingWriter(fout)
+        write_cached_archive(writer, members, compression, cache)
+    stat = os.stat(tar_location)
+    span = tracing.current_span()
+    span.set("compression", Compression(compression).value)
+    span.set("bytes_out", stat.st_size)
+    _record_digest(tar_location, writer.digest.hexdigest())
+    return tar_location
@@ -1,4 +1,4 @@
 """
 PyTorch EasyTensor helper package.
 """
-from easytensor.pytorch.upload import upload_model
+from easytensor.pytorch.upload import upload_model, upload_model_async
@@ -12,129 +12,185 @@ output. You can think of the predict_single method as where the preprocess,
 predict, and postprocess happens.
 """
 import os
-import io
-import tarfile
 import tempfile
-import importlib
-import inspect
 import shutil
 import logging
-from torch import save as torch_save
-from pyflakes.api import checkRecursive
-from pyflakes.reporter import Reporter
-from easytensor.constants import Framework
+from easytensor.constants import Framework, Compression, WeightsFormat, Precision
+from easytensor import aio, tracing
 from easytensor.auth import needs_auth
+from easytensor.validation import (  # pylint: disable=unused-import
+    BadModelFile,
+    check_model_class_definition_file,
+)
+from easytensor.archive import create_archive, stream_archive
+from easytensor.pytorch.weights import (
+    SafetensorsFile,
+    WeightsException,
+    safetensors_file,
+    weights_metadata,
+)
 from easytensor.upload import (
     create_query_token,
     create_model_object,
     upload_archive,
+    upload_archive_stream,
 )
 
-# pylint: disable=protected-access
+# pylint: disable=protected-access,import-outside-toplevel
 LOGGER = logging.getLogger(__name__)
 
 
-def create_model_archive(model_weights_file, model_class_file):
+class BadModel(BaseException):
+    """ Exception for when a non-model object is passed. """
+
+
+def archive_members(model_weights_file, model_class_file):
+    """
+    Returns the (path, arcname) members of the archive for the weights and
+    class definition. Safetensors weights are stored as model.safetensors.
+    """
+    weights_name = "model.pt"
+    if isinstance(model_weights_file, SafetensorsFile) or str(
+        model_weights_file
+    ).endswith(".safetensors"):
+        weights_name = "model.safetensors"
+    return [(model_weights_file, weights_name), (model_class_file, "model.py")]
+
+
+def create_model_archive(
+    model_weights_file, model_class_file, compression=Compression.GZIP
+):
     """
     Creates a temporary archvie of the model using the weights and class
     definition.
     The created archive's location is returned.
+    compression: see easytensor.compression.
     """
-    _, tar_location = tempfile.mkstemp()
-    with tarfile.open(tar_location, "w:gz") as tarout:
-        tarout.add(model_weights_file, arcname="model.pt")
-        tarout.add(model_class_file, arcname="model.py")
-    return tar_location
+    return create_archive(
+        archive_members(model_weights_file, model_class_file), compression
+    )
 
 
-def check_model_class_definition_file(model_class_definition_file):
-    """
-    A function that checks the model class definition file exists and
-    is formatted correctly to be served.
+@tracing.traced("easytensor.export_weights", weights_format="torch")
+def export_pytorch_weights(model, temporary_directory: str):
     """
+    Stores the model passed to the passed temporary directory under
+    "model.py".
+    Returns the location where the weights have been stored.
 
-    class BadModelFile(BaseException):
-        """ An exception thrown for bad model files. """
+    Uses https://pytorch.org/docs/stable/generated/torch.save.html
+    """
 
-    if not os.path.isfile(model_class_definition_file):
-        raise FileNotFoundError(
-            "Could not find the model class definition file {}".format(
-                model_class_definition_file
-            )
+    if model is None or not hasattr(model, "state_dict"):
+        raise BadModel(
+            "The passed model object has no state_dict function. "
+            "Are you sure this is a pytorch model object?"
         )
+    # torch is only imported when weights are exported, so importing this
+    # module stays cheap.
+    from torch import save as torch_save
+
+    weights_location = os.path.join(temporary_directory, "model.pt")
+    torch_save(model.state_dict(), weights_location)
+    tracing.current_span().set("bytes_out", os.path.getsize(weights_location))
+    return weights_location
 
-    if (
-        len(model_class_definition_file) < 3
-        or model_class_definition_file[-3:] != ".py"
-    ):
-        raise BadModelFile(
-            "Model class definition file ({}) is not a .py file.".format(
-                model_class_definition_file
+
+def _weights_format(weights_format, precision):
+    """
+    Returns the format weights are exported in: safetensors when their
+    precision is changed, torch.save otherwise, unless chosen explicitly.
+    """
+    if weights_format is None:
+        if precision is None:
+            return WeightsFormat.TORCH
+        return WeightsFormat.SAFETENSORS
+    weights_format = WeightsFormat(weights_format)
+    if precision is not None and weights_format != WeightsFormat.SAFETENSORS:
+        raise WeightsException(
+            "Weights can only be converted to {} in the safetensors format.".format(
+                Precision(precision).value
             )
         )
+    return weights_format
 
-    warn_stream = io.StringIO("")
-    error_stream = io.StringIO("")
-    reporter = Reporter(warn_stream, error_stream)
-    num_errors = checkRecursive(["model.py"], reporter)
-    if num_errors > 0:
-        raise BadModelFile(
-            f"Found {num_errors} error(s) in model file. Please fix them and try again.\n"
-            + warn_stream.getvalue()
-        )
 
-    module = importlib.import_module(model_class_definition_file[:-3])
-    classes = [
-        clas[1]
-        for clas in inspect.getmembers(
-            module,
-            lambda member: inspect.isclass(member)
-            and member.__module__ == module.__name__,
+def export_model_files(
+    model,
+    model_class_definition_file,
+    model_weights_dir=None,
+    weights_format=None,
+    precision: Precision = None,
+):
+    """
+    Checks the model class definition file and exports the weights, unless
+    model_weights_dir is passed, to a temporary directory.
+    Returns the location of the weights and of the copied class definition.
+    With WeightsFormat.SAFETENSORS nothing is written for the weights: a
+    SafetensorsFile is returned in place of their location, and the tensors
+    are serialized when the archive is written.
+    precision: converts floating point weights while they are serialized,
+    one tensor at a time. Implies WeightsFormat.SAFETENSORS.
+    """
+    weights_format = _weights_format(weights_format, precision)
+    if precision is not None and model_weights_dir is not None:
+        raise WeightsException(
+            "The precision of an existing weights file can't be changed. "
+            "Pass the model instead of model_weights_dir."
         )
-    ]
-    if len(classes) > 1:
-        raise BadModelFile(
-            "Expected only one class definition in the model class file. "
-            "Found multiple: {}. Please include only your model's class definition.".format(
-                classes
-            )
+    if model_weights_dir is not None and not os.path.isfile(model_weights_dir):
+        raise FileNotFoundError(
+            "Could not find the model weights file {}".format(model_weights_dir)
         )
 
-    if len(classes) < 1:
-        raise BadModelFile(
-            "Expected at least one class definition in the model file but found none. "
-            "Please include the class definition of your model."
-        )
+    check_model_class_definition_file(model_class_definition_file)
+    temporary_directory = tempfile.mkdtemp()
+    if model_weights_dir is not None:
+        model_weight_file = model_weights_dir
+    elif weights_format == WeightsFormat.SAFETENSORS:
+        model_weight_file = safetensors_file(model, precision=precision)
+    else:
+        model_weight_file = export_pytorch_weights(model, temporary_directory)
+    model_class_file = os.path.join(temporary_directory, "model.py")
+    shutil.copy2(model_class_definition_file, model_class_file)
+    return model_weight_file, model_class_file
 
 
-def export_pytorch_weights(model, temporary_directory: str):
+def package_model(
+    model,
+    model_class_definition_file,
+    model_weights_dir=None,
+    compression=Compression.GZIP,
+    weights_format=None,
+    precision: Precision = None,
+):
     """
-    Stores the model passed to the passed temporary directory under
-    "model.py".
-    Returns the location where the weights have been stored.
-
-    Uses https://pytorch.org/docs/stable/generated/torch.save.html
+    Exports the model and packages it with its class definition into a
+    temporary archive. Returns the archive's location.
     """
-
-    class BadModel(BaseException):
-        """ Exception for when a non-model object is passed. """
-
-    if model is None or not hasattr(model, "state_dict"):
-        raise BadModel(
-            "The passed model object has no state_dict function. "
-            "Are you sure this is a pytorch model object?"
-        )
-    torch_save(model.state_dict(), os.path.join(temporary_directory, "model.pt"))
-    return os.path.join(temporary_directory, "model.pt")
+    model_weights, model_class_file = export_model_files(
+        model,
+        model_class_definition_file,
+        model_weights_dir,
+        weights_format,
+        precision,
+    )
+    return create_model_archive(model_weights, model_class_file, compression)
 
 
 @needs_auth
+@tracing.traced("easytensor.upload_model", framework=Framework.PYTORCH.value)
 def upload_model(
     model_name,
     model,
     model_class_definition_file,
     create_token=True,
     model_weights_dir=None,
+    stream=False,
+    multipart=False,
+    compression=Compression.GZIP,
+    weights_format=None,
+    precision: Precision = None,
 ):
     """
     Uploads the passed model and the model class definition to be served by EasyTensor.
@@ -142,27 +198,92 @@ def upload_model(
     If model_weights_dir is passed, the parameter will be used as the weights
     file and `model` will be ignored
 
+    If stream is True, the archive is uploaded while it is being packaged
+    instead of being written to a temporary file first.
+    If multipart is True, the archive is uploaded in concurrent parts. See
+    easytensor.upload.upload_archive.
+    compression selects how the archive is compressed, see
+    easytensor.compression. Compression.AUTO skips compressing weight files
+    that barely compress.
+    weights_format selects how the weights are exported, see
+    easytensor.constants.WeightsFormat. WeightsFormat.SAFETENSORS streams the
+    tensors one at a time into the archive; combined with stream=True, the
+    weights never touch the disk.
+    precision (easytensor.constants.Precision) converts the floating point
+    weights to fp16 or bf16 while they are exported, which implies
+    WeightsFormat.SAFETENSORS. The precision and the bytes saved are recorded
+    in the model's metadata.
+
     Returns the model ID and a query access token.
     Creates a query access token for the model by default.
     """
-    if model_weights_dir is not None and not os.path.isfile(model_weights_dir):
-        raise FileNotFoundError(
-            "Could not find the model weights file {}".format(model_weights_dir)
+    model_weights, model_class_file = export_model_files(
+        model,
+        model_class_definition_file,
+        model_weights_dir,
+        weights_format,
+        precision,
+    )
+    if stream:
+        model_address, model_size = upload_archive_stream(
+            stream_archive(
+                archive_members(model_weights, model_class_file), compression
+            )
         )
-
-    check_model_class_definition_file(model_class_definition_file)
-    temporary_directory = tempfile.mkdtemp()
-    if model_weights_dir is not None:
-        model_weight_file = model_weights_dir
     else:
-        model_weight_file = export_pytorch_weights(model, temporary_directory)
-    model_class_file = os.path.join(temporary_directory, "model.py")
-    shutil.copy2(model_class_definition_file, model_class_file)
-    archive_location = create_model_archive(model_weight_file, model_class_file)
-    model_address, model_size = upload_archive(archive_location)
+        archive_location = create_model_archive(
+            model_weights, model_class_file, compression
+        )
+        model_address, model_size = upload_archive(
+            archive_location, multipart=multipart
+        )
     model_id = create_model_object(
-        model_address, model_name, model_size, Framework.PYTORCH
+        model_address,
+        model_name,
+        model_size,
+        Framework.PYTORCH,
+        weights_metadata(model_weights),
     )
     if not create_token:
         return model_id, None
     return model_id, create_query_token(model_id)
+
+
+@tracing.traced("easytensor.upload_model", framework=Framework.PYTORCH.value)
+async def upload_model_async(
+    model_name,
+    model,
+    model_class_definition_file,
+    create_token=True,
+    model_weights_dir=None,
+    compression=Compression.GZIP,
+    multipart=False,
+    weights_format=None,
+    precision: Precision = None,
+):
+    """
+    An asyncio counterpart of upload_model. Packaging runs in a thread pool
+    and the network calls are bounded by the easytensor.aio concurrency limit,
+    so many models can be uploaded concurrently.
+
+    Returns the model ID and a query access token.
+    """
+    model_weights, model_class_file = await aio.run_blocking(
+        export_model_files,
+        model,
+        model_class_definition_file,
+        model_weights_dir,
+        weights_format,
+        precision,
+    )
+    archive_location = await aio.run_blocking(
+        create_model_archive, model_weights, model_class_file, compression
+    )
+    return await aio.upload_and_register(
+        archive_location,
+        model_name,
+        Framework.PYTORCH,
+        create_token,
+        weights_metadata(model_weights),
+        multipart=multipart,
+    )
@@ -0,0 +1,300 @@
+"""
+A module for exporting PyTorch weights in the safetensors format.
+
+https://github.com/huggingface/safetensors describes the layout:
+    8 bytes little-endian uint64 length of the header
+    header: utf-8 JSON {name: {"dtype", "shape", "data_offsets"}}, padded with
+        spaces to a multiple of 8 bytes
+    the raw little-endian bytes of every tensor, in header order
+
+The header only depends on the dtypes and shapes of the tensors, so the size
+of the file is known before any tensor is read. That lets SafetensorsFile be
+written straight into a tar archive: tensors are copied out one at a time
+(moved to the CPU if needed) and handed to the compressor without ever
+materializing the whole state_dict, a pickle or a temporary file.
+"""
+import json
+import struct
+import logging
+from easytensor import tracing
+from easytensor.archive import GeneratedFile
+from easytensor.constants import Precision, WeightsFormat
+from easytensor.compression import (
+    AUTO_ENTROPY_THRESHOLD,
+    AUTO_SAMPLE_SIZE,
+    DEFAULT_LEVEL,
+    STORE_LEVEL,
+    byte_entropy,
+)
+from easytensor.encoding import little_endian
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=import-outside-toplevel
+
+# torch dtype names to safetensors dtypes.
+SAFETENSORS_DTYPES = {
+    "float64": "F64",
+    "float32": "F32",
+    "float16": "F16",
+    "bfloat16": "BF16",
+    "int64": "I64",
+    "int32": "I32",
+    "int16": "I16",
+    "int8": "I8",
+    "uint8": "U8",
+    "bool": "BOOL",
+}
+SAFETENSORS_ALIGNMENT = 8
+# dtypes floating point tensors are cast to at reduced precision.
+_CAST_DTYPES = {Precision.FLOAT16: "float16", Precision.BFLOAT16: "bfloat16"}
+
+
+class WeightsException(BaseException):
+    """ A simple exception for weights that can't be exported."""
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace("torch.", "")
+
+
+def _tensor_bytes(tensor):
+    """
+    Returns a byte view of the tensor's little-endian data. Contiguous CPU
+    tensors are not copied.
+    """
+    import torch
+
+    tensor = tensor.detach()
+    if tensor.device.type != "cpu":
+        tensor = tensor.cpu()
+    tensor = tensor.contiguous()
+    if tensor.dtype == torch.bfloat16:
+        # numpy has no bfloat16, send the same bits as int16.
+        tensor = tensor.view(torch.int16)
+    array = little_endian(tensor.numpy())
+    return memoryview(array.reshape(-1)).cast("B")
+
+
+_ELEMENT_SIZES = {
+    "float64": 8,
+    "float32": 4,
+    "float16": 2,
+    "bfloat16": 2,
+    "int64": 8,
+    "int32": 4,
+    "int16": 2,
+    "int8": 1,
+    "uint8": 1,
+    "bool": 1,
+}
+
+
+class _Entry:
+    """ One tensor of a safetensors file, and how it is produced. """
+
+    def __init__(self, name, dtype, shape, source, kind):
+        self.name = name
+        self.dtype = dtype
+        self.shape = list(shape)
+        self.source = source
+        self.kind = kind
+        self.nbytes = _ELEMENT_SIZES[dtype]
+        for dim in self.shape:
+            self.nbytes *= dim
+
+
+def _plan(name, tensor, precision):
+    """
+    Returns the entry written for the tensor at the passed precision.
+    Only floating point tensors are converted.
+    """
+    dtype = _dtype_name(tensor.dtype)
+    if dtype not in SAFETENSORS_DTYPES:
+        raise WeightsException(
+            "Can't export {} tensor {} as safetensors.".format(dtype, name)
+        )
+    if precision is None or not tensor.is_floating_point():
+        return _Entry(name, dtype, tensor.shape, tensor, "copy")
+    return _Entry(name, _CAST_DTYPES[precision], tensor.shape, tensor, "cast")
+
+
+class SafetensorsFile(GeneratedFile):
+    """
+    The safetensors serialization of a state_dict, generated tensor by tensor
+    while it is written into an archive. Peak memory is roughly the largest
+    tensor that has to be copied (converted, non-contiguous or not on the
+    CPU), or nothing at all for contiguous CPU tensors.
+
+    precision: an easytensor.constants.Precision to convert floating point
+    tensors to, one tensor at a time, or None to keep their dtype.
+    source_bytes and size compare the weights before and after conversion.
+    """
+
+    def __init__(self, state_dict, metadata=None, precision=None):
+        self.precision = None if precision is None else Precision(precision)
+        self.entries = []
+        self.source_bytes = 0
+        for name, tensor in state_dict.items():
+            self.source_bytes += tensor.numel() * tensor.element_size()
+            self.entries.append(_plan(name, tensor, self.precision))
+        metadata = dict(metadata or {})
+        if self.precision is not None:
+            metadata["precision"] = self.precision.value
+        header = {}
+        if metadata:
+            header["__metadata__"] = {
+                str(key): str(value) for key, value in metadata.items()
+            }
+        offset = 0
+        for entry in self.entries:
+            header[entry.name] = {
+                "dtype": SAFETENSORS_DTYPES[entry.dtype],
+                "shape": entry.shape,
+                "data_offsets": [offset, offset + entry.nbytes],
+            }
+            offset += entry.nbytes
+        header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        header += b" " * (-len(header) % SAFETENSORS_ALIGNMENT)
+        self.header = struct.pack("<Q", len(header)) + header
+        self.data_bytes = offset
+        self.size = len(self.header) + offset
+
+    def _cast(self, tensor):
+        import torch
+
+        return tensor.detach().to(getattr(torch, _CAST_DTYPES[self.precision]))
+
+    def chunks(self):
+        """ Yields the header, then the bytes of every tensor in order. """
+        yield self.header
+        for entry in self.entries:
+            if entry.kind == "cast":
+                yield _tensor_bytes(self._cast(entry.source))
+            else:
+                yield _tensor_bytes(entry.source)
+
+    def compression_level(self):
+        """
+        Samples the largest floating point tensor, which dominates the file,
+        and skips compression when it looks incompressible.
+        """
+        floats = [entry for entry in self.entries if entry.source.is_floating_point()]
+        if not floats:
+            return DEFAULT_LEVEL
+        largest = max(floats, key=lambda entry: entry.nbytes)
+        count = AUTO_SAMPLE_SIZE // largest.source.element_size()
+        sample = largest.source.reshape(-1)[:count]
+        if largest.kind == "cast":
+            sample = self._cast(sample)
+        if byte_entropy(bytes(_tensor_bytes(sample))) > AUTO_ENTROPY_THRESHOLD:
+            return STORE_LEVEL
+        return DEFAULT_LEVEL
+
+    def report(self):
+        """
+        Returns the weights metadata recorded with the model: the format,
+        precision and the byte reduction achieved by the conversion.
+        """
+        return {
+            "weights_format": WeightsFormat.SAFETENSORS.value,
+            "precision": None if self.precision is None else self.precision.value,
+            "source_bytes": self.source_bytes,
+            "weights_bytes": self.data_bytes,
+        }
+
+
+# safetensors dtypes to little-endian numpy dtypes. bfloat16 is read as its
+# int16 bits.
+_NUMPY_DTYPES = {
+    "F64": "<f8",
+    "F32": "<f4",
+    "F16": "<f2",
+    "BF16": "<i2",
+    "I64": "<i8",
+    "I32": "<i4",
+    "I16": "<i2",
+    "I8": "i1",
+    "U8": "u1",
+    "BOOL": "?",
+}
+
+
+def load_safetensors(path: str):
+    """
+    Reads a safetensors file into a state_dict of CPU tensors and returns it
+    with the file's metadata. Tensors keep the dtype they were stored in.
+    """
+    import numpy as np
+    import torch
+
+    with open(path, "rb") as fin:
+        (header_size,) = struct.unpack("<Q", fin.read(8))
+        header = json.loads(fin.read(header_size))
+        data = fin.read()
+    metadata = header.pop("__metadata__", {})
+    tensors = {}
+    for name, info in header.items():
+        if info["dtype"] not in _NUMPY_DTYPES:
+            raise WeightsException(
+                "Can't read {} tensor {}.".format(info["dtype"], name)
+            )
+        start, end = info["data_offsets"]
+        array = np.frombuffer(
+            data[start:end], dtype=_NUMPY_DTYPES[info["dtype"]]
+        ).reshape(info["shape"])
+        # copied, torch can't wrap read-only buffers.
+        tensor = torch.from_numpy(array.astype(array.dtype.newbyteorder("=")))
+        if info["dtype"] == "BF16":
+            tensor = tensor.view(torch.bfloat16)
+        tensors[name] = tensor
+    return tensors, metadata
+
+
+def log_reduction(weights):
+    """
+    Logs the number of bytes saved by converting the weights' precision.
+    """
+    if weights.precision is None or not weights.source_bytes:
+        return
+    LOGGER.info(
+        "Converted the weights to %s: %s -> %s bytes (%.1f%% smaller)",
+        weights.precision.value,
+        weights.source_bytes,
+        weights.data_bytes,
+        100.0 * (1 - weights.data_bytes / weights.source_bytes),
+    )
+
+
+def weights_metadata(model_weights):
+    """
+    Returns the metadata of exported weights to register with the model, or
+    None for weights exported as files.
+    """
+    if isinstance(model_weights, tuple):
+        model_weights = model_weights[-1]
+    if isinstance(model_weights, SafetensorsFile):
+        return model_weights.report()
+    return None
+
+
+@tracing.traced("easytensor.export_weights", weights_format="safetensors")
+def safetensors_file(model, metadata=None, precision=None):
+    """
+    Returns a SafetensorsFile of the model's state_dict, converted to the
+    passed precision.
+    """
+    if model is None or not hasattr(model, "state_dict"):
+        raise WeightsException(
+            "The passed model object has no state_dict function. "
+            "Are you sure this is a pytorch model object?"
+        )
+    # the metadata transformers expects in safetensors checkpoints.
+    metadata = dict({"format": "pt"}, **(metadata or {}))
+    weights = SafetensorsFile(model.state_dict(), metadata, precision)
+    # the tensors are only serialized when the archive is written.
+    span = tracing.current_span()
+    span.set("precision", None if precision is None else weights.precision.value)
+    span.set("bytes_in", weights.source_bytes)
+    span.set("bytes_out", weights.size)
+    log_reduction(weights)
+    return weights
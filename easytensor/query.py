@@ -0,0 +1,371 @@
+"""
+A module for running predictions against models served by EasyTensor.
+
+A QueryClient is built around the query access token returned by
+easytensor.upload.create_query_token (and the framework upload_model
+functions). It sends requests over the shared pooled HTTP client, and
+merges concurrent single-instance `predict` calls into batched requests:
+the first waiting instance opens a batch that is sent once it holds
+max_batch_size instances or max_wait seconds have passed, whichever comes
+first. Each caller gets back the prediction of its own instance.
+
+For bulk inference over large datasets, predict_stream sends fixed-size
+batches from a lazy iterable with a bounded number of requests in flight,
+and yields the predictions in input order.
+
+Clients can also cache predictions, so repeated instances are answered
+without a request. See easytensor.cache.
+"""
+import time
+import queue
+import itertools
+import threading
+import collections
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+from easytensor.client import get_client
+from easytensor.cache import PredictionCache, instance_hash, model_key
+from easytensor.encoding import JSON, encode_instances, decode_response
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=import-outside-toplevel
+
+DEFAULT_MAX_BATCH_SIZE = 32
+# Seconds a batch waits for more instances after its first one arrived.
+DEFAULT_MAX_WAIT = 0.005
+# Maximum number of batch requests in flight at a time.
+DEFAULT_MAX_IN_FLIGHT = 4
+# Retries of a failed batch in predict_stream. Its batches are sent without the
+# HTTP client's own retries, so a batch is sent at most 1 + retries times.
+DEFAULT_BATCH_RETRIES = 3
+BATCH_RETRY_BACKOFF = 0.5
+
+
+class QueryException(BaseException):
+    """ A simple exception for failed prediction requests."""
+
+
+class QueryClient:
+    """
+    A client for querying one served model.
+    query_token: the query access token of the model.
+    url: the query endpoint. Defaults to the /query/ endpoint of the
+    configured base URL.
+    max_batch_size, max_wait: the micro-batching policy, see the module doc.
+    max_in_flight: the maximum number of batch requests sent at a time.
+    encoding: how instances are sent, see easytensor.encoding. The binary and
+    base64 encodings send numpy arrays as raw buffers instead of JSON lists,
+    and tensors in responses are decoded straight into numpy arrays.
+    cache: True, or an easytensor.cache.PredictionCache, to cache the
+    predictions of this model. Disabled by default.
+    model_id: the id the model's predictions are cached under. Defaults to an
+    id derived from the query token.
+    """
+
+    def __init__(
+        self,
+        query_token,
+        url=None,
+        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+        max_wait=DEFAULT_MAX_WAIT,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        client=None,
+        encoding=JSON,
+        cache=None,
+        model_id=None,
+    ):
+        if url is None:
+            # support hot reloading the URL endpoint
+            from easytensor.urls import QUERY_URL
+
+            url = QUERY_URL
+        self.query_token = query_token
+        self.url = url
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self.client = client or get_client()
+        self.encoding = encoding
+        if cache is True:
+            cache = PredictionCache()
+        self.cache = cache if cache not in (None, False) else None
+        self.model_id = model_id or model_key(query_token)
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._closed = False
+
+    def predict_batch(self, instances):
+        """
+        Returns the predictions of the instances, in order. Instances that
+        aren't cached are sent in a single request.
+        """
+        return self._predict_batch(instances, retry=True)
+
+    def _predict_batch(self, instances, retry):
+        """
+        See predict_batch. retry: whether the HTTP client retries the request.
+        """
+        instances = list(instances)
+        if self.cache is None:
+            return self._request(instances, retry)
+        predictions = [None] * len(instances)
+        missing = []
+        for index, instance in enumerate(instances):
+            digest = self._cached(instance, predictions, index)
+            if digest is not False:
+                missing.append((index, digest))
+        if missing:
+            fetched = self._request(
+                [instances[index] for index, _ in missing], retry
+            )
+            for (index, digest), prediction in zip(missing, fetched):
+                predictions[index] = prediction
+                self._cache_put(digest, prediction)
+        return predictions
+
+    def _cached(self, instance, predictions, index):
+        """
+        Looks the instance up in the cache and stores a hit in
+        predictions[index]. Returns False on a hit, otherwise the digest to
+        cache the prediction under (None for instances that can't be hashed).
+        """
+        try:
+            digest = instance_hash(instance)
+        except (TypeError, ValueError):
+            return None
+        hit, prediction = self.cache.get(self.model_id, digest)
+        if hit:
+            predictions[index] = prediction
+            return False
+        return digest
+
+    def _cache_put(self, digest, prediction):
+        if self.cache is not None and digest is not None:
+            self.cache.put(self.model_id, digest, prediction)
+
+    def _request(self, instances, retry=True):
+        """
+        Sends the instances in a single request and returns their
+        predictions, in order.
+        """
+        request = encode_instances(instances, self.encoding)
+        headers = dict(request.pop("headers", {}))
+        headers["accessToken"] = self.query_token
+        response = self.client.post(self.url, headers=headers, retry=retry, **request)
+        response.raise_for_status()
+        return _predictions(decode_response(response), len(instances))
+
+    def _predict_batch_with_retries(self, instances, max_retries):
+        """
+        Returns the predictions of the instances, retrying the batch up to
+        max_retries times. The only retry layer of the request.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._predict_batch(instances, retry=False)
+            except (requests.RequestException, QueryException) as exc:
+                attempt += 1
+                if attempt > max_retries or _is_client_error(exc):
+                    raise
+                LOGGER.debug("Retrying batch (attempt %s): %s", attempt, exc)
+                time.sleep(BATCH_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    def predict_stream(
+        self,
+        instances,
+        batch_size=DEFAULT_MAX_BATCH_SIZE,
+        max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        max_retries=DEFAULT_BATCH_RETRIES,
+    ):
+        """
+        Yields the predictions of the instances, in order.
+
+        instances can be any iterable, including a lazy generator over a
+        dataset that doesn't fit in memory. It is consumed batch_size
+        instances at a time, and at most max_in_flight batches are sent or
+        waiting to be yielded at once, so memory use stays flat no matter
+        how many instances there are. A failed batch is retried on its own
+        up to max_retries times before the error is raised.
+        """
+        iterator = iter(instances)
+        in_flight = collections.deque()
+        executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="easytensor-stream"
+        )
+        try:
+            while True:
+                batch = list(itertools.islice(iterator, batch_size))
+                if batch:
+                    in_flight.append(
+                        executor.submit(
+                            self._predict_batch_with_retries, batch, max_retries
+                        )
+                    )
+                # backpressure: wait for the oldest batch when all slots are
+                # taken, or when the input is exhausted.
+                if in_flight and (len(in_flight) >= max_in_flight or not batch):
+                    yield from in_flight.popleft().result()
+                if not batch and not in_flight:
+                    return
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def predict(self, instance):
+        """
+        Returns the prediction for a single instance. Concurrent calls are
+        merged into batched requests.
+        """
+        return self.submit(instance).result()
+
+    def submit(self, instance):
+        """
+        Queues the instance for the next batch and returns a
+        concurrent.futures.Future of its prediction.
+        """
+        future = Future()
+        digest = None
+        if self.cache is not None:
+            found = [None]
+            digest = self._cached(instance, found, 0)
+            if digest is False:
+                future.set_result(found[0])
+                return future
+        with self._lock:
+            if self._closed:
+                raise QueryException("The query client is closed.")
+            self._ensure_dispatcher()
+            self._pending.put((instance, digest, future))
+        return future
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight, thread_name_prefix="easytensor-query"
+            )
+            self._dispatcher = threading.Thread(
+                target=self._dispatch, name="easytensor-batcher", daemon=True
+            )
+            self._dispatcher.start()
+
+    def _next_batch(self):
+        """
+        Blocks for the first instance, then collects more until the batch is
+        full or max_wait has passed. Returns None once the client is closed.
+        """
+        first = self._pending.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._pending.get(timeout=remaining)
+                else:
+                    item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # put the sentinel back, so the loop stops after this batch.
+                self._pending.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _dispatch(self):
+        while True:
+            # wait for a free request slot before opening the next batch, so
+            # instances pile up into fuller batches while the server is busy.
+            self._slots.acquire()
+            batch = self._next_batch()
+            if batch is None:
+                self._slots.release()
+                return
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        futures = [future for _, _, future in batch]
+        try:
+            predictions = self._request([instance for instance, _, _ in batch])
+        except BaseException as exc:  # pylint: disable=broad-except
+            for future in futures:
+                future.set_exception(exc)
+            return
+        finally:
+            self._slots.release()
+        for (_, digest, future), prediction in zip(batch, predictions):
+            self._cache_put(digest, prediction)
+            future.set_result(prediction)
+
+    def close(self):
+        """
+        Sends the queued instances, stops the background threads and saves
+        the prediction cache if it is persisted.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            dispatcher = self._dispatcher
+            if dispatcher is not None:
+                self._pending.put(None)
+        if dispatcher is not None:
+            dispatcher.join()
+            self._executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _is_client_error(exc):
+    """
+    Returns True for 4xx responses, which fail the same way when retried,
+    except 429 Too Many Requests.
+    """
+    response = getattr(exc, "response", None)
+    return (
+        response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code != 429
+    )
+
+
+def _predictions(response, expected):
+    """
+    Returns the list of predictions from a query response.
+    """
+    predictions = response
+    if isinstance(response, dict):
+        predictions = response.get("predictions")
+    if not isinstance(predictions, list) or len(predictions) != expected:
+        raise QueryException(
+            "Expected {} predictions in the response, got: {}".format(
+                expected, response
+            )
+        )
+    return predictions
+
+
+def predict_stream(query_token, instances, **kwargs):
+    """
+    Yields the predictions of the instances from the model with the passed
+    query token, in order. See QueryClient.predict_stream for the options.
+    """
+    client = QueryClient(query_token)
+    try:
+        yield from client.predict_stream(instances, **kwargs)
+    finally:
+        client.close()
@@ -0,0 +1,256 @@
+"""
+A module for the local registry of the models uploaded from this machine.
+
+Every model registered with easytensor.upload.create_model_object is
+recorded under ~/.easytensor with its name, address, size, framework, the
+sha256 digest of its archive when it is known, and the query tokens minted
+for it. Deploy scripts can then find the ID and token of a model by name or
+by archive content instead of querying the backend or uploading it again.
+
+The registry is cached in memory, indexed by model ID, name and content
+hash, and only re-read from disk when the file changes, so lookups don't
+touch the disk. Writes hold the config lock across processes, re-read the
+file and replace it atomically, so concurrent deploy jobs don't lose each
+other's models.
+
+    from easytensor.registry import get_registry
+
+    model = get_registry().latest("my model")
+    print(model["model_id"], model["query_token"])
+"""
+import os
+import json
+import time
+import threading
+import logging
+from easytensor.config import (
+    _EASYTENSOR_PATH,
+    config_lock,
+    write_json_atomic,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+_REGISTRY_PATH = os.path.join(_EASYTENSOR_PATH, "registry.json")
+_FORMAT_VERSION = 1
+# Models are stored as rows of these fields to keep the file compact.
+_FIELDS = (
+    "model_id",
+    "name",
+    "address",
+    "size",
+    "framework",
+    "content_hash",
+    "registered_at",
+)
+# Maximum number of models kept. The oldest registrations are dropped first.
+REGISTRY_MAX_ENTRIES = 10000
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class ModelRegistry:
+    """
+    The models registered from this machine, see the module docstring.
+    Entries are dicts with the keys in _FIELDS and the model's query_token.
+    Lookups return copies, newest registration first. Query tokens are kept
+    apart from the models, so tokens minted for models registered elsewhere
+    can be cached without adding them to the lookups.
+    path: the file the registry is stored in.
+    max_entries: the number of most recent registrations kept.
+    """
+
+    def __init__(self, path=_REGISTRY_PATH, max_entries=REGISTRY_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._key = None
+        self._models = {}
+        self._tokens = {}
+        self._by_name = {}
+        self._by_hash = {}
+
+    def _read(self):
+        """
+        Returns the models stored on disk, in registration order, and the
+        query tokens by model ID.
+        """
+        try:
+            with open(self.path) as fin:
+                stored = json.load(fin)
+            if stored.get("version") != _FORMAT_VERSION:
+                return {}, {}
+            models = [dict(zip(_FIELDS, row)) for row in stored["models"]]
+            tokens = dict(stored.get("tokens", {}))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}, {}
+        return {model["model_id"]: model for model in models}, tokens
+
+    def _index(self, models, tokens):
+        self._models = models
+        self._tokens = tokens
+        self._by_name = {}
+        self._by_hash = {}
+        for model_id, model in models.items():
+            self._by_name.setdefault(model["name"], []).append(model_id)
+            if model["content_hash"] is not None:
+                self._by_hash.setdefault(model["content_hash"], []).append(model_id)
+
+    def _refresh(self):
+        """ Re-reads the registry if the file changed. Expects the lock. """
+        key = _stat_key(self.path)
+        if key != self._key:
+            self._index(*self._read())
+            self._key = key
+
+    def _update(self, func):
+        """
+        Applies func to the models and tokens read from disk and writes them
+        back, holding the config lock so other processes can't interleave.
+        Failing to write the registry is logged: it must never fail an upload.
+        """
+        with self._lock:
+            try:
+                with config_lock():
+                    models, tokens = self._read()
+                    func(models, tokens)
+                    while len(models) > self.max_entries:
+                        del models[next(iter(models))]
+                    while len(tokens) > self.max_entries:
+                        del tokens[next(iter(tokens))]
+                    rows = [
+                        [model[field] for field in _FIELDS]
+                        for model in models.values()
+                    ]
+                    write_json_atomic(
+                        self.path,
+                        {"version": _FORMAT_VERSION, "models": rows, "tokens": tokens},
+                    )
+                    self._index(models, tokens)
+                    self._key = _stat_key(self.path)
+            except (OSError, TypeError, ValueError) as exc:
+                LOGGER.warning("Could not save the model registry: %s", exc)
+
+    def _entry(self, model_id):
+        entry = dict(self._models[model_id])
+        entry["query_token"] = self._tokens.get(model_id)
+        return entry
+
+    def _lookup(self, model_ids):
+        return [self._entry(model_id) for model_id in reversed(model_ids)]
+
+    def get(self, model_id: str):
+        """ Returns the model with the passed ID, or None. """
+        with self._lock:
+            self._refresh()
+            return self._entry(model_id) if model_id in self._models else None
+
+    def find(self, name: str = None, content_hash: str = None):
+        """
+        Returns the models with the passed name and/or archive digest, newest
+        first. Without arguments, returns every model.
+        """
+        with self._lock:
+            self._refresh()
+            if name is None and content_hash is None:
+                return self._lookup(list(self._models))
+            model_ids = None
+            if name is not None:
+                model_ids = self._by_name.get(name, [])
+            if content_hash is not None:
+                with_hash = self._by_hash.get(content_hash, [])
+                if model_ids is None:
+                    model_ids = with_hash
+                else:
+                    with_hash = set(with_hash)
+                    model_ids = [
+                        model_id for model_id in model_ids if model_id in with_hash
+                    ]
+            return self._lookup(model_ids)
+
+    def latest(self, name: str):
+        """ Returns the last model registered with the passed name, or None. """
+        with self._lock:
+            self._refresh()
+            model_ids = self._by_name.get(name)
+            return self._entry(model_ids[-1]) if model_ids else None
+
+    def query_token(self, model_id: str):
+        """ Returns the last query token minted for the model, or None. """
+        with self._lock:
+            self._refresh()
+            return self._tokens.get(model_id)
+
+    def record_model(
+        self,
+        model_id: str,
+        name: str,
+        address: str,
+        size: int,
+        framework: str,
+        content_hash: str = None,
+    ):
+        """ Records a model registered in the backend. """
+
+        def _record(models, _):
+            models.pop(model_id, None)
+            models[model_id] = {
+                "model_id": model_id,
+                "name": name,
+                "address": address,
+                "size": size,
+                "framework": framework,
+                "content_hash": content_hash,
+                "registered_at": time.time(),
+            }
+
+        self._update(_record)
+
+    def record_tokens(self, tokens: dict):
+        """
+        Records the query tokens minted for models, a dict of model ID to
+        token. Models that aren't in the registry only get their token cached.
+        """
+
+        def _record(_, known_tokens):
+            for model_id, token in tokens.items():
+                known_tokens.pop(model_id, None)
+                known_tokens[model_id] = token
+
+        self._update(_record)
+
+    def forget(self, model_id: str):
+        """ Removes the model from the registry, e.g. after deleting it. """
+
+        def _forget(models, tokens):
+            models.pop(model_id, None)
+            tokens.pop(model_id, None)
+
+        self._update(_forget)
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._models)
+
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_registry():
+    """
+    Returns the registry of ~/.easytensor, creating it on first use.
+    """
+    global _REGISTRY  # pylint: disable=global-statement
+    if _REGISTRY is None:
+        with _REGISTRY_LOCK:
+            if _REGISTRY is None:
+                _REGISTRY = ModelRegistry()
+    return _REGISTRY
@@ -0,0 +1,374 @@
+"""
+A module for scheduling upload transfers process-wide.
+
+Every transfer of archive data (a single upload request, a multipart part, a
+streamed upload) runs in a slot of the process-wide TransferScheduler:
+- the number of transfers in flight is bounded, and the bound adapts to the
+  observed throughput: it keeps moving by one in the direction that improved
+  the aggregate throughput, turns around when throughput drops, and halves
+  on connection errors and server errors;
+- waiting transfers get their slots by priority, then in arrival order, so
+  urgent uploads go ahead of bulk backfills;
+- with a rate limit, the bytes sent by all transfers are paced by a token
+  bucket. Less urgent transfers pause between chunks while a more urgent
+  transfer is in flight, and give up their slot while they pause, so
+  paused transfers never keep urgent ones waiting.
+
+    from easytensor.constants import Priority
+    from easytensor.scheduler import configure_scheduler, transfer_priority
+
+    configure_scheduler(rate_limit=50 * 1024 * 1024)  # 50 MB/s for uploads
+    with transfer_priority(Priority.HIGH):
+        easytensor.pytorch.upload_model("urgent fix", model, "model.py")
+"""
+import io
+import time
+import heapq
+import itertools
+import threading
+import contextlib
+import contextvars
+import collections
+import logging
+from easytensor.constants import Priority
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=protected-access
+
+DEFAULT_INITIAL_CONCURRENCY = 8
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_MIN_CONCURRENCY = 1
+# Throughput is compared over windows of at least this many seconds.
+ADAPT_INTERVAL = 2.0
+# Relative throughput change treated as an improvement or a drop.
+ADAPT_THRESHOLD = 0.05
+# Longest a transfer pauses for more urgent ones before sending its next
+# chunk anyway, so its connection doesn't sit idle long enough to time out.
+MAX_YIELD_SECONDS = 10.0
+# Smallest bucket capacity, so small rate limits don't stall large chunks.
+MIN_BURST_BYTES = 64 * 1024
+
+_PRIORITY = contextvars.ContextVar("easytensor_priority", default=Priority.NORMAL)
+
+
+@contextlib.contextmanager
+def transfer_priority(priority: Priority):
+    """
+    A context manager setting the priority of the uploads started within it,
+    in this thread or task, that don't pass a priority themselves.
+    """
+    token = _PRIORITY.set(Priority(priority))
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+def current_priority():
+    """ Returns the priority set by transfer_priority, NORMAL by default. """
+    return _PRIORITY.get()
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket pacing bytes to rate per second, with bursts
+    of up to capacity bytes. Callers reserve tokens and sleep off their debt,
+    so concurrent callers share the rate in the order they asked.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("The rate must be positive.")
+        self.rate = rate
+        self.capacity = capacity or max(rate, MIN_BURST_BYTES)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """ Takes amount tokens, sleeping until they are available. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            debt = -self._tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+class _ThrottledReader:
+    """
+    A file-like reader that paces the reads of a request body through a
+    transfer. requests sends file-like bodies in small blocks, so the bytes
+    on the wire follow the bucket closely.
+    """
+
+    def __init__(self, fileobj, transfer, size):
+        self._fileobj = fileobj
+        self._transfer = transfer
+        self._size = size
+
+    def read(self, size=-1):
+        """ Reads from the wrapped file once the transfer may send the bytes. """
+        data = self._fileobj.read(size)
+        self._transfer.throttle(len(data))
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """ Seeks the wrapped file, e.g. to rewind the body before a retry. """
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self):
+        """ Returns the position in the wrapped file. """
+        return self._fileobj.tell()
+
+    def __len__(self):
+        return self._size
+
+
+class Transfer:
+    """
+    A transfer holding a slot of the scheduler. See TransferScheduler.transfer.
+    """
+
+    def __init__(self, scheduler, priority: Priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        # False while the transfer yields its slot to more urgent ones.
+        self.holding = True
+
+    def throttle(self, amount: int):
+        """
+        Waits until amount more bytes may be sent: for more urgent transfers
+        to finish, then for the bandwidth budget.
+        """
+        self.scheduler._throttle(self, amount)
+
+    def reader(self, data, size=None):
+        """
+        Returns the request body to send for data, bytes or a readable file
+        of size bytes, paced by the scheduler when it has a rate limit.
+        """
+        if self.scheduler.bucket is None:
+            return data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+            data = io.BytesIO(data)
+        return _ThrottledReader(data, self, size)
+
+    def done(self, amount: int):
+        """ Records that the transfer sent amount bytes successfully. """
+        self.scheduler._record(amount)
+
+    def failed(self):
+        """ Records a connection or server error, a sign of congestion. """
+        self.scheduler._record_error()
+
+
+class TransferScheduler:
+    """
+    Bounds, orders and paces the upload transfers of the process.
+    rate_limit: the bytes per second all transfers may send together, or
+    None for no limit.
+    initial_concurrency, min_concurrency and max_concurrency: the bounds of
+    the number of transfers in flight, which adapts to the throughput.
+    """
+
+    def __init__(
+        self,
+        rate_limit: float = None,
+        initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+        min_concurrency=DEFAULT_MIN_CONCURRENCY,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+    ):
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError(
+                "Expected 1 <= min_concurrency <= max_concurrency, "
+                "got {} and {}.".format(min_concurrency, max_concurrency)
+            )
+        self.rate_limit = rate_limit
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = max(min_concurrency, min(initial_concurrency, max_concurrency))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._running = collections.Counter()
+        self._waiting = []
+        self._order = itertools.count()
+        self.bytes_sent = 0
+        self.errors = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_saturated = False
+        self._last_rate = None
+        self._direction = 1
+
+    @contextlib.contextmanager
+    def transfer(self, priority: Priority = None):
+        """
+        A context manager that waits for a slot and yields a Transfer.
+        priority: defaults to the current transfer_priority.
+        """
+        priority = Priority(priority) if priority is not None else current_priority()
+        with self._cond:
+            self._acquire(priority)
+        transfer = Transfer(self, priority)
+        try:
+            yield transfer
+        finally:
+            with self._cond:
+                if transfer.holding:
+                    self._release(priority)
+
+    def _acquire(self, priority: Priority):
+        """ Waits for a slot, in priority order. Expects the condition held. """
+        ticket = (priority.value, next(self._order))
+        heapq.heappush(self._waiting, ticket)
+        try:
+            while self._waiting[0] != ticket or self._active >= self.limit:
+                if self._active >= self.limit:
+                    self._window_saturated = True
+                self._cond.wait()
+        except BaseException:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._cond.notify_all()
+            raise
+        heapq.heappop(self._waiting)
+        self._active += 1
+        self._running[priority.value] += 1
+        # the next waiter may fit in a free slot too.
+        self._cond.notify_all()
+
+    def _release(self, priority: Priority):
+        """ Frees a slot. Expects the condition held. """
+        self._active -= 1
+        self._running[priority.value] -= 1
+        self._cond.notify_all()
+
+    def _more_urgent_running(self, priority: Priority):
+        return any(
+            count > 0 and value < priority.value
+            for value, count in self._running.items()
+        )
+
+    def _throttle(self, transfer: Transfer, amount: int):
+        if self.bucket is None:
+            return
+        priority = transfer.priority
+        deadline = time.monotonic() + MAX_YIELD_SECONDS
+        with self._cond:
+            if self._more_urgent_running(priority):
+                # let queued urgent transfers have the slot while pausing.
+                self._release(priority)
+                transfer.holding = False
+                while self._more_urgent_running(priority):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._acquire(priority)
+                transfer.holding = True
+        self.bucket.consume(amount)
+
+    def _record(self, amount: int):
+        with self._cond:
+            self.bytes_sent += amount
+            self._window_bytes += amount
+            elapsed = time.monotonic() - self._window_start
+            if elapsed < ADAPT_INTERVAL:
+                return
+            rate = self._window_bytes / elapsed
+            # only a saturated window says something about the limit.
+            if self._window_saturated:
+                self._adapt(rate)
+            self._last_rate = rate
+            self._reset_window()
+
+    def _adapt(self, rate):
+        previous = self.limit
+        if self._last_rate is None:
+            step = 1
+        elif rate > self._last_rate * (1 + ADAPT_THRESHOLD):
+            # the last move helped, keep going.
+            step = self._direction
+        elif rate < self._last_rate * (1 - ADAPT_THRESHOLD):
+            step = -self._direction
+        else:
+            step = 0
+        if step:
+            self._direction = step
+            self.limit = max(
+                self.min_concurrency, min(self.max_concurrency, self.limit + step)
+            )
+        if self.limit != previous:
+            LOGGER.debug(
+                "Upload concurrency %s -> %s at %.0f B/s", previous, self.limit, rate
+            )
+            self._cond.notify_all()
+
+    def _record_error(self):
+        with self._cond:
+            self.errors += 1
+            previous = self.limit
+            self.limit = max(self.min_concurrency, self.limit // 2)
+            if self.limit != previous:
+                LOGGER.debug(
+                    "Upload concurrency %s -> %s after an error", previous, self.limit
+                )
+            self._last_rate = None
+            self._direction = 1
+            self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_saturated = False
+
+    def stats(self):
+        """
+        Returns the current concurrency limit, the transfers in flight and
+        waiting, the bytes sent, the errors seen and the last measured rate.
+        """
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "bytes_sent": self.bytes_sent,
+                "errors": self.errors,
+                "bytes_per_second": self._last_rate,
+            }
+
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Returns the process-wide transfer scheduler, creating it on first use.
+    """
+    global _SCHEDULER  # pylint: disable=global-statement
+    if _SCHEDULER is None:
+        with _SCHEDULER_LOCK:
+            if _SCHEDULER is None:
+                _SCHEDULER = TransferScheduler()
+    return _SCHEDULER
+
+
+def configure_scheduler(**kwargs):
+    """
+    Replaces the process-wide transfer scheduler with one created with the
+    passed settings, e.g. rate_limit in bytes per second. See
+    TransferScheduler for the available settings. Transfers already in
+    flight finish under the previous scheduler.
+    """
+    global _SCHEDULER  # pylint: disable=global-statement
+    with _SCHEDULER_LOCK:
+        _SCHEDULER = TransferScheduler(**kwargs)
+    return _SCHEDULER
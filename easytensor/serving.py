@@ -0,0 +1,433 @@
+"""
+A module for loading and profiling packaged models locally, before they are
+uploaded.
+
+profile_archive takes the archive built by create_model_archive, or by
+package_model which exports and packages a model exactly like upload_model
+without uploading it, and unpacks it the way the server does. It then loads
+the model class from model.py and its weights like the server, with
+load_state_dict or from_pretrained, and runs predict_single over sample
+instances, one at a time and in batches. Everything runs on the CPU,
+without any network call. The report has the cold start time (unpacking,
+importing model.py and loading the weights), the latency percentiles and
+throughput of both runs, and the peak memory of the process.
+
+    from easytensor.pytorch.upload import package_model
+    from easytensor.serving import profile_archive
+
+    archive = package_model(model, "model.py")
+    print(profile_archive(archive, ["first sample", "second sample"]))
+
+Or from the command line, in a fresh process so the peak memory is the
+model's, with one JSON instance per line of samples.jsonl:
+
+    python -m easytensor.serving archive.tar.gz samples.jsonl
+"""
+import os
+import sys
+import ast
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import argparse
+import importlib.util
+import contextlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from easytensor.compression import open_decompressor
+from easytensor.constants import Framework
+from easytensor.validation import _class_definitions
+
+LOGGER = logging.getLogger(__name__)
+# pylint: disable=import-outside-toplevel
+
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_WARMUP = 1
+# The method models may define to predict a list of instances at once.
+BATCH_METHOD = "predict_batch"
+PERCENTILES = (50, 90, 99)
+
+
+class ServingException(BaseException):
+    """ A simple exception for archives that can't be loaded or served. """
+
+
+def _safe_member(member, directory):
+    """
+    Returns True if the member extracts inside directory: regular files and
+    directories only, with no absolute or parent paths.
+    """
+    if not (member.isfile() or member.isdir()):
+        return False
+    target = os.path.realpath(os.path.join(directory, member.name))
+    return target == directory or target.startswith(directory + os.sep)
+
+
+def extract_archive(archive_location: str, directory: str = None):
+    """
+    Unpacks a model archive, in any of the supported compressions, into
+    directory, a new temporary directory by default, and returns it.
+    Links and paths leaving the directory are skipped.
+    """
+    directory = os.path.realpath(directory or tempfile.mkdtemp())
+    with open(archive_location, "rb") as fin:
+        with tarfile.open(fileobj=open_decompressor(fin), mode="r|") as tarin:
+            if hasattr(tarfile, "data_filter"):
+                tarin.extraction_filter = tarfile.data_filter
+            for member in tarin:
+                if not _safe_member(member, directory):
+                    LOGGER.warning("Skipping archive member %s.", member.name)
+                    continue
+                tarin.extract(member, directory, set_attrs=False)
+    return directory
+
+
+def detect_framework(directory: str):
+    """
+    Returns the Framework of an unpacked model archive.
+    """
+    if os.path.isfile(os.path.join(directory, "model.py")):
+        if os.path.isdir(os.path.join(directory, "model_weights")):
+            return Framework.TRANSFORMERS
+        for name in ("model.pt", "model.safetensors"):
+            if os.path.isfile(os.path.join(directory, name)):
+                return Framework.PYTORCH
+    if os.path.isfile(os.path.join(directory, "saved_model.pb")):
+        return Framework.TENSORFLOW
+    raise ServingException(
+        "{} doesn't look like an EasyTensor model archive.".format(directory)
+    )
+
+
+def load_model_class(model_file: str):
+    """
+    Imports the model class definition file and returns its model class.
+    The file's directory is importable while it is loaded, like on the server.
+    """
+    with open(model_file, "rb") as fin:
+        classes = _class_definitions(ast.parse(fin.read(), model_file))
+    if len(classes) != 1:
+        raise ServingException(
+            "Expected one class definition in {}, found {}.".format(
+                model_file, len(classes)
+            )
+        )
+    module_name = "easytensor_model_{}".format(abs(hash(model_file)))
+    spec = importlib.util.spec_from_file_location(module_name, model_file)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(model_file))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(os.path.dirname(model_file))
+    return getattr(module, classes[0].name)
+
+
+def _load_pytorch(directory, model_class):
+    import torch
+    from easytensor.pytorch.weights import load_safetensors
+
+    model = model_class()
+    safetensors_location = os.path.join(directory, "model.safetensors")
+    if os.path.isfile(safetensors_location):
+        state_dict, _ = load_safetensors(safetensors_location)
+    else:
+        state_dict = torch.load(
+            os.path.join(directory, "model.pt"), map_location="cpu"
+        )
+    model.load_state_dict(state_dict)
+    return model
+
+
+def _load_transformers(directory, model_class):
+    from easytensor.shards import MANIFEST_NAME
+
+    checkpoint = os.path.join(directory, "model_weights")
+    if os.path.isfile(os.path.join(checkpoint, MANIFEST_NAME)):
+        raise ServingException(
+            "The archive of a sharded checkpoint only lists its shards, "
+            "which are fetched by the server. Package the model without "
+            "sharded=True to profile it."
+        )
+    return model_class.from_pretrained(checkpoint)
+
+
+def _peak_rss():
+    """ Returns the peak resident memory of the process in bytes, if known. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class LoadedModel:
+    """
+    A model loaded from an unpacked archive, ready to predict.
+    timings holds the seconds spent unpacking (extract), importing model.py
+    (import) and constructing the model and loading its weights (load).
+    Close it to remove the unpacked archive if it was unpacked to a
+    temporary directory.
+    """
+
+    def __init__(self, model, framework, directory, timings, owns_directory):
+        self.model = model
+        self.framework = framework
+        self.directory = directory
+        self.timings = timings
+        self._owns_directory = owns_directory
+
+    @property
+    def cold_start(self):
+        """ The seconds it took from the archive to a model ready to predict. """
+        return sum(self.timings.values())
+
+    def inference(self):
+        """
+        A context manager disabling torch gradients, like the server does
+        while predicting.
+        """
+        try:
+            import torch
+        except ImportError:
+            return contextlib.nullcontext()
+        return torch.no_grad()
+
+    def predict_single(self, instance):
+        """ Predicts one instance with the model's predict_single. """
+        with self.inference():
+            return self.model.predict_single(instance)
+
+    def close(self):
+        """ Removes the unpacked archive if it is temporary. """
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_archive(archive_location: str, directory: str = None):
+    """
+    Unpacks the archive, to directory or a temporary directory, and loads its
+    model. Returns a LoadedModel.
+    PyTorch models are constructed without arguments and their weights are
+    loaded with load_state_dict; transformers models are loaded with
+    from_pretrained. TensorFlow SavedModels are served by TensorFlow Serving
+    and can't be loaded this way.
+    """
+    timings = {}
+    start = time.perf_counter()
+    owns_directory = directory is None
+    directory = extract_archive(archive_location, directory)
+    timings["extract"] = time.perf_counter() - start
+    try:
+        framework = detect_framework(directory)
+        if framework == Framework.TENSORFLOW:
+            raise ServingException(
+                "TensorFlow archives are SavedModels without a model class; "
+                "check them with `saved_model_cli run` instead."
+            )
+        start = time.perf_counter()
+        model_class = load_model_class(os.path.join(directory, "model.py"))
+        timings["import"] = time.perf_counter() - start
+        start = time.perf_counter()
+        if framework == Framework.PYTORCH:
+            model = _load_pytorch(directory, model_class)
+        else:
+            model = _load_transformers(directory, model_class)
+        if hasattr(model, "eval"):
+            model.eval()
+        timings["load"] = time.perf_counter() - start
+    except BaseException:
+        if owns_directory:
+            shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return LoadedModel(model, framework, directory, timings, owns_directory)
+
+
+def _percentile(ordered, percent):
+    """ Nearest-rank percentile of a sorted list. """
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def latency_stats(durations, instances):
+    """
+    Returns the latency percentiles, mean and max of the calls that took
+    durations seconds, and the throughput of the instances they predicted.
+    """
+    ordered = sorted(durations)
+    total = sum(durations)
+    stats = {"calls": len(durations), "instances": instances}
+    if not ordered:
+        return stats
+    for percent in PERCENTILES:
+        stats["p{}_s".format(percent)] = _percentile(ordered, percent)
+    stats["mean_s"] = total / len(ordered)
+    stats["max_s"] = ordered[-1]
+    stats["instances_per_s"] = instances / total if total > 0 else None
+    return stats
+
+
+class ServingReport:
+    """
+    The profile of a model archive served locally.
+    cold_start: the seconds spent unpacking, importing and loading, also
+    broken down in timings.
+    sequential and batch: latency_stats of predict_single one instance at a
+    time, and of batches of batch_size instances. Batches go through the
+    model's predict_batch method if it defines one, otherwise their
+    instances are predicted concurrently, like concurrent requests.
+    peak_rss_bytes: the peak resident memory of the process.
+    """
+
+    def __init__(self, framework, timings):
+        self.framework = framework
+        self.timings = dict(timings)
+        self.cold_start = sum(timings.values())
+        self.sequential = None
+        self.batch = None
+        self.batch_mode = None
+        self.batch_size = None
+        self.peak_rss_bytes = None
+
+    def as_dict(self):
+        """ Returns the report as a json serializable dict. """
+        return {
+            "framework": self.framework.value,
+            "cold_start_s": self.cold_start,
+            "timings": self.timings,
+            "sequential": self.sequential,
+            "batch": self.batch,
+            "batch_mode": self.batch_mode,
+            "batch_size": self.batch_size,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+    def __repr__(self):
+        return "ServingReport({})".format(self.as_dict())
+
+
+def _run_sequential(loaded, instances):
+    durations = []
+    with loaded.inference():
+        for index, instance in enumerate(instances):
+            start = time.perf_counter()
+            try:
+                loaded.model.predict_single(instance)
+            except Exception as exc:
+                raise ServingException(
+                    "predict_single failed on instance {}: {!r}".format(index, exc)
+                ) from exc
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _run_batches(loaded, instances, batch_size):
+    batches = [
+        instances[offset : offset + batch_size]
+        for offset in range(0, len(instances), batch_size)
+    ]
+    predict_batch = getattr(loaded.model, BATCH_METHOD, None)
+    durations = []
+    if predict_batch is not None:
+        with loaded.inference():
+            for batch in batches:
+                start = time.perf_counter()
+                predict_batch(batch)
+                durations.append(time.perf_counter() - start)
+        return BATCH_METHOD, durations
+
+    # gradient mode is thread local, every worker disables it.
+    def predict(instance):
+        with loaded.inference():
+            return loaded.model.predict_single(instance)
+
+    with ThreadPoolExecutor(
+        max_workers=batch_size, thread_name_prefix="easytensor-serving"
+    ) as executor:
+        for batch in batches:
+            start = time.perf_counter()
+            list(executor.map(predict, batch))
+            durations.append(time.perf_counter() - start)
+    return "concurrent", durations
+
+
+def profile_loaded(loaded, instances, batch_size=DEFAULT_BATCH_SIZE, warmup=None):
+    """
+    Profiles a LoadedModel over the instances and returns a ServingReport.
+    warmup: the number of instances predicted, unmeasured, before the runs.
+    Defaults to DEFAULT_WARMUP.
+    """
+    instances = list(instances)
+    if not instances:
+        raise ServingException("At least one sample instance is needed.")
+    warmup = DEFAULT_WARMUP if warmup is None else warmup
+    report = ServingReport(loaded.framework, loaded.timings)
+    _run_sequential(loaded, instances[:warmup])
+    report.sequential = latency_stats(
+        _run_sequential(loaded, instances), len(instances)
+    )
+    report.batch_mode, durations = _run_batches(loaded, instances, batch_size)
+    report.batch = latency_stats(durations, len(instances))
+    report.batch_size = batch_size
+    report.peak_rss_bytes = _peak_rss()
+    return report
+
+
+def profile_archive(
+    archive_location: str,
+    instances,
+    batch_size=DEFAULT_BATCH_SIZE,
+    warmup=DEFAULT_WARMUP,
+):
+    """
+    Loads the model archive like the server does and profiles it over the
+    sample instances. Returns a ServingReport, see profile_loaded.
+    """
+    with load_archive(archive_location) as loaded:
+        return profile_loaded(loaded, instances, batch_size, warmup)
+
+
+def read_instances(path: str):
+    """
+    Reads sample instances from a JSON file holding a list of instances, or
+    a JSON lines file with one instance per line.
+    """
+    with open(path) as fin:
+        content = fin.read()
+    try:
+        instances = json.loads(content)
+    except ValueError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    if not isinstance(instances, list):
+        return [instances]
+    return instances
+
+
+def main(argv=None):
+    """ Profiles an archive from the command line and prints the report. """
+    parser = argparse.ArgumentParser(
+        description="Load a packaged EasyTensor model archive and profile it."
+    )
+    parser.add_argument("archive", help="the archive built by package_model")
+    parser.add_argument("samples", help="a JSON or JSON lines file of instances")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP)
+    args = parser.parse_args(argv)
+    report = profile_archive(
+        args.archive, read_instances(args.samples), args.batch_size, args.warmup
+    )
+    print(json.dumps(report.as_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+A module for uploading sharded checkpoints.
+
+Large transformers checkpoints are saved as several weight shards, e.g.
+pytorch_model-00001-of-00004.bin, listed in an index file. Instead of
+packing every shard into one archive, each shard is uploaded as its own
+transfer unit, concurrently, and skipped when the backend already has a
+shard with the same content (see easytensor.dedup). The model archive then
+only holds the small files of the checkpoint and a manifest, MANIFEST_NAME,
+mapping every shard to the address it was uploaded to:
+
+    {"version": 1, "shards": [{"path", "address", "sha256", "size"}]}
+
+The server downloads the shards listed in the manifest into the checkpoint
+directory next to it to reassemble the checkpoint.
+"""
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from easytensor import tracing
+from easytensor.archive import archive_digest
+from easytensor.dedup import find_existing_upload
+from easytensor.upload import upload_archive
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = "easytensor_shards.json"
+MANIFEST_VERSION = 1
+DEFAULT_SHARD_WORKERS = 4
+# Weight files of checkpoints that are saved without an index.
+WEIGHT_FILE_NAMES = ("pytorch_model.bin", "model.safetensors", "tf_model.h5")
+
+
+def checkpoint_shards(model_directory: str):
+    """
+    Returns the file names of the weight shards of the checkpoint, as listed
+    in its *.index.json files, or its single weights file if it has no index.
+    """
+    shards = set()
+    for name in sorted(os.listdir(model_directory)):
+        if not name.endswith(".index.json"):
+            continue
+        with open(os.path.join(model_directory, name)) as fin:
+            shards.update(json.load(fin).get("weight_map", {}).values())
+    if not shards:
+        shards.update(
+            name
+            for name in WEIGHT_FILE_NAMES
+            if os.path.isfile(os.path.join(model_directory, name))
+        )
+    return sorted(shards)
+
+
+def _upload_shard(model_directory, name, upload_kwargs):
+    path = os.path.join(model_directory, name)
+    content_hash = archive_digest(path)
+    shard = {
+        "path": name,
+        "sha256": content_hash,
+        "size": os.path.getsize(path),
+    }
+    address = find_existing_upload(content_hash)
+    if address is not None:
+        LOGGER.info("Shard %s is unchanged, skipping upload.", name)
+        shard["address"] = address
+        return shard, True
+    shard["address"], _ = upload_archive(
+        path, dedup=False, content_hash=content_hash, **upload_kwargs
+    )
+    return shard, False
+
+
+def upload_shards(
+    model_directory: str,
+    shards,
+    max_workers=DEFAULT_SHARD_WORKERS,
+    **upload_kwargs
+):
+    """
+    Uploads the shard files of model_directory concurrently, skipping the
+    ones already uploaded. Returns the manifest of the shards and the
+    number of shards that were skipped.
+    Extra keyword arguments are passed to easytensor.upload.upload_archive,
+    e.g. multipart=True to also split each shard into concurrent parts.
+    """
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="easytensor-shard"
+    ) as executor:
+        futures = [
+            executor.submit(
+                tracing.in_context(_upload_shard), model_directory, name, upload_kwargs
+            )
+            for name in shards
+        ]
+        results = [future.result() for future in futures]
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "shards": [shard for shard, _ in results],
+    }
+    return manifest, sum(1 for _, skipped in results if skipped)
+
+
+def sharded_members(
+    model_directory: str, shards, manifest: dict, arcname: str, manifest_location
+):
+    """
+    Returns the (path, arcname) members of the model archive for a sharded
+    checkpoint: every file of model_directory except the shards, and the
+    manifest, written to manifest_location.
+    """
+    with open(manifest_location, "w") as fout:
+        json.dump(manifest, fout, indent=2, sort_keys=True)
+    members = [
+        (os.path.join(model_directory, name), os.path.join(arcname, name))
+        for name in sorted(os.listdir(model_directory))
+        if name not in shards
+    ]
+    members.append((manifest_location, os.path.join(arcname, MANIFEST_NAME)))
+    return members
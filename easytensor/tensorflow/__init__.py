@@ -1,4 +1,4 @@
 """
 Tensorflow EasyTensor helper package.
 """
-from easytensor.tensorflow.upload import upload_model
+from easytensor.tensorflow.upload import upload_model, upload_model_async
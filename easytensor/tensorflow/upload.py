@@ -3,39 +3,112 @@ A module that helps upload tensorflow models to EasyTensor.
 The only requirement for a model is that it is exported to disk.
 Tensorflow models are packaged in a tar file and uploaded directly.
 """
-import tarfile
-import tempfile
 import logging
+from easytensor import aio, tracing
+from easytensor.archive import create_archive, stream_archive
+from easytensor.member_cache import CACHEABLE_COMPRESSIONS, create_cached_archive
 from easytensor.upload import (
     create_query_token,
     create_model_object,
     upload_archive,
+    upload_archive_stream,
 )
-from easytensor.constants import Framework
+from easytensor.constants import Framework, Compression
 
 LOGGER = logging.getLogger(__name__)
 
 
-def create_model_archive(model_location):
+def archive_members(model_location):
+    """
+    Returns the (path, arcname) members of the archive for the exported model.
+    """
+    return [(model_location, "")]
+
+
+def create_model_archive(
+    model_location, compression=Compression.GZIP, member_cache=False
+):
     """
     Creates a temporary archvie of the model and returns its location.
+    compression: see easytensor.compression.
+    member_cache: reuse the compressed files of previous archives that didn't
+    change, see easytensor.member_cache. Only applies to gzip compressions.
+    Off by default: the cache keeps up to MEMBER_CACHE_MAX_BYTES of
+    compressed files under ~/.easytensor.
     """
-    _, tar_location = tempfile.mkstemp()
-    with tarfile.open(tar_location, "w:gz") as tarout:
-        tarout.add(model_location, arcname="")
-    return tar_location
+    members = archive_members(model_location)
+    if member_cache and Compression(compression) in CACHEABLE_COMPRESSIONS:
+        return create_cached_archive(members, compression)
+    return create_archive(members, compression)
 
 
-def upload_model(model_name, model_location, create_token=True):
+@tracing.traced("easytensor.upload_model", framework=Framework.TENSORFLOW.value)
+def upload_model(
+    model_name,
+    model_location,
+    create_token=True,
+    stream=False,
+    multipart=False,
+    compression=Compression.GZIP,
+    member_cache=False,
+):
     """
     Returns the model ID and a query access token.
     Creates a query access token for the model by default.
+
+    If stream is True, the archive is uploaded while it is being packaged
+    instead of being written to a temporary file first.
+    If multipart is True, the archive is uploaded in concurrent parts. See
+    easytensor.upload.upload_archive.
+    compression selects how the archive is compressed, see
+    easytensor.compression. Compression.AUTO skips compressing weight files
+    that barely compress.
+    If member_cache is True, files that didn't change since a previous upload
+    aren't compressed again, see easytensor.member_cache. The cache is opt-in,
+    it keeps up to MEMBER_CACHE_MAX_BYTES of compressed files on disk.
     """
-    archive_lcoation = create_model_archive(model_location)
-    model_address, model_size = upload_archive(archive_lcoation)
+    if stream:
+        model_address, model_size = upload_archive_stream(
+            stream_archive(archive_members(model_location), compression)
+        )
+    else:
+        archive_lcoation = create_model_archive(
+            model_location, compression, member_cache
+        )
+        model_address, model_size = upload_archive(
+            archive_lcoation, multipart=multipart
+        )
     model_id = create_model_object(
         model_address, model_name, model_size, Framework.TENSORFLOW
     )
     if not create_token:
         return model_id, None
     return model_id, create_query_token(model_id)
+
+
+@tracing.traced("easytensor.upload_model", framework=Framework.TENSORFLOW.value)
+async def upload_model_async(
+    model_name,
+    model_location,
+    create_token=True,
+    compression=Compression.GZIP,
+    multipart=False,
+    member_cache=False,
+):
+    """
+    An asyncio counterpart of upload_model. Packaging runs in a thread pool
+    and the network calls are bounded by the easytensor.aio concurrency limit,
+    so many models can be uploaded concurrently.
+
+    Returns the model ID and a query access token.
+    """
+    archive_location = await aio.run_blocking(
+        create_model_archive, model_location, compression, member_cache
+    )
+    return await aio.upload_and_register(
+        archive_location,
+        model_name,
+        Framework.TENSORFLOW,
+        create_token,
+        multipart=multipart,
+    )
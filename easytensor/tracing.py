@@ -0,0 +1,352 @@
+"""
+A module for tracing the stages of model uploads.
+
+Every stage of an upload (validating the model file, exporting the weights,
+packaging the archive, transferring it and registering the model) runs in a
+span, which records its duration and attributes such as the bytes in and
+out, the compression ratio, the transfer rate and the number of HTTP
+retries. The spans of one upload_model call nest under its root span and
+share its trace_id.
+
+Spans are handed to the sinks registered with add_sink. A sink is either a
+callable, called with every finished Span, or an object with on_start(span)
+and/or on_end(span) methods, like OpenTelemetrySink which forwards the spans
+to an OpenTelemetry tracer. When no sink is registered, span() returns a
+shared no-op span and nothing is measured, so the instrumentation costs next
+to nothing.
+
+    from easytensor import tracing
+
+    recorder = tracing.MetricsRecorder()
+    tracing.add_sink(recorder)
+    easytensor.tensorflow.upload_model("my model", "saved_model/")
+    print(recorder.summary())
+"""
+import time
+import uuid
+import asyncio
+import functools
+import threading
+import contextvars
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Registered sinks. Replaced, never mutated, so it can be read without a lock.
+_SINKS = ()
+_SINKS_LOCK = threading.Lock()
+_CURRENT_SPAN = contextvars.ContextVar("easytensor_span", default=None)
+# Attributes computed from the others when a span ends.
+_DERIVED = ("compression_ratio", "bytes_per_second")
+
+
+class TracingException(BaseException):
+    """ A simple exception for tracing misconfigurations."""
+
+
+class Span:
+    """
+    A timed stage of an upload.
+    name: the stage, e.g. "easytensor.upload_archive".
+    attributes: what the stage measured. Spans with bytes_in and bytes_out
+    also get their compression_ratio, and spans with bytes_sent their
+    bytes_per_second, when they end. The rate is computed over the
+    transfer_seconds attribute when the stage sets it, so the work around
+    the transfer doesn't count, and over the whole span otherwise.
+    start_time and end_time are unix timestamps, duration is in seconds.
+    error is the repr of the exception the stage failed with, if any.
+    """
+
+    recording = True
+
+    def __init__(self, name: str, attributes: dict = None, parent=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start_time = None
+        self.end_time = None
+        self.duration = None
+        self.error = None
+        self._started = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def set(self, key: str, value):
+        """ Sets an attribute of the span. """
+        self.attributes[key] = value
+
+    def add(self, key: str, amount=1):
+        """ Adds amount to a counter attribute. Safe to call from any thread. """
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self._token = _CURRENT_SPAN.set(self)
+        _dispatch("on_start", self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._started
+        self.end_time = self.start_time + self.duration
+        _CURRENT_SPAN.reset(self._token)
+        if exc_value is not None:
+            self.error = repr(exc_value)
+        attributes = self.attributes
+        if attributes.get("bytes_in") and "bytes_out" in attributes:
+            attributes["compression_ratio"] = (
+                attributes["bytes_out"] / attributes["bytes_in"]
+            )
+        transfer_seconds = attributes.get("transfer_seconds", self.duration)
+        if "bytes_sent" in attributes and transfer_seconds > 0:
+            attributes["bytes_per_second"] = attributes["bytes_sent"] / transfer_seconds
+        _dispatch("on_end", self)
+        return False
+
+    def as_dict(self):
+        """ Returns the span as a json serializable dict. """
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": None if self.parent is None else self.parent.span_id,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": dict(self.attributes),
+        }
+
+    def __repr__(self):
+        return "Span({})".format(self.as_dict())
+
+
+class _NoopSpan:
+    """ The span used when no sink is registered. Records nothing. """
+
+    recording = False
+    name = None
+    attributes = {}
+
+    def set(self, key, value):
+        """ Does nothing. """
+
+    def add(self, key, amount=1):
+        """ Does nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _dispatch(method: str, started_or_ended: Span):
+    for sink in _SINKS:
+        handler = getattr(sink, method, None)
+        if handler is None:
+            if method != "on_end" or not callable(sink):
+                continue
+            handler = sink
+        try:
+            handler(started_or_ended)
+        except Exception:  # pylint: disable=broad-except
+            # a broken sink must never fail an upload.
+            LOGGER.warning("Tracing sink %r failed.", sink, exc_info=True)
+
+
+def add_sink(sink):
+    """
+    Registers a sink for the spans of every thread. Returns the sink.
+    """
+    global _SINKS  # pylint: disable=global-statement
+    with _SINKS_LOCK:
+        _SINKS = _SINKS + (sink,)
+    return sink
+
+
+def remove_sink(sink):
+    """ Unregisters the sink. Does nothing if it isn't registered. """
+    global _SINKS  # pylint: disable=global-statement
+    with _SINKS_LOCK:
+        _SINKS = tuple(known for known in _SINKS if known is not sink)
+
+
+def enabled():
+    """ True if spans are recorded, i.e. a sink is registered. """
+    return bool(_SINKS)
+
+
+def span(name: str, **attributes):
+    """
+    Returns a span for the stage, to be used as a context manager, nested
+    under the current span. Returns NOOP_SPAN when no sink is registered.
+    """
+    if not _SINKS:
+        return NOOP_SPAN
+    return Span(name, attributes, _CURRENT_SPAN.get())
+
+
+def current_span():
+    """
+    Returns the innermost span in progress, or NOOP_SPAN. Used to add
+    measurements, like retries, to whatever stage is running.
+    """
+    current = _CURRENT_SPAN.get()
+    return NOOP_SPAN if current is None else current
+
+
+def traced(name: str, **attributes):
+    """
+    A decorator that runs every call of the function, or coroutine function,
+    in a span. See span.
+    """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **attributes):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _SINKS:
+                return func(*args, **kwargs)
+            with span(name, **attributes):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def in_context(func):
+    """
+    Returns func bound to a copy of the current context, so spans started
+    by it in another thread (e.g. a thread pool) nest under the current span.
+    Call it once per submitted task: a context can't run in two threads.
+    """
+    if not _SINKS:
+        return func
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+class MetricsRecorder:
+    """
+    A sink that keeps the finished spans in memory, e.g. to report the
+    stages of an upload after it finished.
+    max_spans: the number of most recent spans kept.
+    """
+
+    def __init__(self, max_spans=10000):
+        self.max_spans = max_spans
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __call__(self, finished: Span):
+        with self._lock:
+            self.spans.append(finished)
+            del self.spans[: -self.max_spans]
+
+    def clear(self):
+        """ Drops the recorded spans. """
+        with self._lock:
+            self.spans = []
+
+    def summary(self):
+        """
+        Returns, for every stage, the number of spans, their total and
+        maximum duration, the number that failed, the sums of their numeric
+        attributes and the overall compression ratio and transfer rate.
+        """
+        stages = {}
+        with self._lock:
+            spans = list(self.spans)
+        for finished in spans:
+            stage = stages.setdefault(
+                finished.name, {"count": 0, "total_s": 0.0, "max_s": 0.0, "errors": 0}
+            )
+            stage["count"] += 1
+            stage["total_s"] += finished.duration
+            stage["max_s"] = max(stage["max_s"], finished.duration)
+            stage["errors"] += finished.error is not None
+            for key, value in finished.attributes.items():
+                if key in _DERIVED:
+                    continue
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stage[key] = stage.get(key, 0) + value
+        for stage in stages.values():
+            if stage.get("bytes_in") and "bytes_out" in stage:
+                stage["compression_ratio"] = stage["bytes_out"] / stage["bytes_in"]
+            transfer_seconds = stage.get("transfer_seconds", stage["total_s"])
+            if "bytes_sent" in stage and transfer_seconds > 0:
+                stage["bytes_per_second"] = stage["bytes_sent"] / transfer_seconds
+        return stages
+
+
+class OpenTelemetrySink:
+    """
+    A sink that mirrors the spans as OpenTelemetry spans, with the same
+    names, timings, attributes and nesting. Root spans nest under the
+    OpenTelemetry span current when they start.
+    tracer: the OpenTelemetry tracer to use. Defaults to the global tracer
+    provider's "easytensor" tracer.
+    Requires the opentelemetry-api package.
+    """
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace  # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise TracingException(
+                "OpenTelemetrySink requires the opentelemetry-api package. "
+                "Install it with `pip install opentelemetry-api`."
+            ) from exc
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("easytensor")
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, started: Span):
+        """ Starts the OpenTelemetry span of the span. """
+        context = None
+        if started.parent is not None:
+            with self._lock:
+                parent = self._spans.get(started.parent.span_id)
+            if parent is not None:
+                context = self._trace.set_span_in_context(parent)
+        otel_span = self.tracer.start_span(
+            started.name,
+            context=context,
+            start_time=int(started.start_time * 1e9),
+        )
+        with self._lock:
+            self._spans[started.span_id] = otel_span
+
+    def on_end(self, finished: Span):
+        """ Ends the OpenTelemetry span of the span. """
+        with self._lock:
+            otel_span = self._spans.pop(finished.span_id, None)
+        if otel_span is None:
+            return
+        for key, value in finished.attributes.items():
+            if not isinstance(value, (str, bool, int, float)):
+                value = str(value)
+            otel_span.set_attribute(key, value)
+        if finished.error is not None:
+            from opentelemetry.trace import (  # pylint: disable=import-outside-toplevel
+                Status,
+                StatusCode,
+            )
+
+            otel_span.set_status(Status(StatusCode.ERROR, finished.error))
+        otel_span.end(end_time=int(finished.end_time * 1e9))
@@ -1,4 +1,4 @@
 """
 PyTorch EasyTensor helper package.
 """
-from easytensor.transformers.upload import upload_model
+from easytensor.transformers.upload import upload_model, upload_model_async
@@ -12,107 +12,222 @@ output. You can think of the predict_single method as where the preprocess,
 predict, and postprocess happens.
 """
 import os
-import io
-import tarfile
+import copy
 import tempfile
-import importlib
-import inspect
 import shutil
 import logging
-from pyflakes.api import checkRecursive
-from pyflakes.reporter import Reporter
 
+from easytensor import aio, tracing
 from easytensor.auth import needs_auth
-from easytensor.constants import Framework
+from easytensor.validation import (  # pylint: disable=unused-import
+    BadModelFile,
+    check_model_class_definition_file,
+)
+from easytensor.constants import Framework, Compression, Precision
+from easytensor.archive import create_archive, stream_archive
+from easytensor.pytorch.weights import (
+    WeightsException,
+    safetensors_file,
+    weights_metadata,
+)
 from easytensor.upload import (
     create_query_token,
     create_model_object,
     upload_archive,
+    upload_archive_stream,
+)
+from easytensor.shards import (
+    DEFAULT_SHARD_WORKERS,
+    MANIFEST_NAME,
+    checkpoint_shards,
+    sharded_members,
+    upload_shards,
 )
 
 # pylint: disable=protected-access
 LOGGER = logging.getLogger(__name__)
 
 
-def create_model_archive(model_weights_file, model_class_file):
+def archive_members(model_weights_file, model_class_file):
+    """
+    Returns the (path, arcname) members of the archive for the weights and
+    class definition.
+    model_weights_file is either the checkpoint directory, or a
+    (directory, SafetensorsFile) pair for weights converted on export, whose
+    weights are added to the directory as model.safetensors.
+    """
+    if isinstance(model_weights_file, tuple):
+        model_directory, weights = model_weights_file
+        return [
+            (model_directory, "model_weights"),
+            (weights, "model_weights/model.safetensors"),
+            (model_class_file, "model.py"),
+        ]
+    return [(model_weights_file, "model_weights"), (model_class_file, "model.py")]
+
+
+def create_model_archive(
+    model_weights_file, model_class_file, compression=Compression.GZIP
+):
     """
     Creates a temporary archvie of the model using the weights and class
     definition.
     The created archive's location is returned.
+    compression: see easytensor.compression.
     """
-    _, tar_location = tempfile.mkstemp()
-    with tarfile.open(tar_location, "w:gz") as tarout:
-        tarout.add(model_weights_file, arcname="model_weights")
-        tarout.add(model_class_file, arcname="model.py")
-    return tar_location
+    return create_archive(
+        archive_members(model_weights_file, model_class_file), compression
+    )
+
+
+def _directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
 
 
-def check_model_class_definition_file(model_class_definition_file):
+def _save_converted(model, model_directory, precision):
     """
-    A function that checks the model class definition file exists and
-    is formatted correctly to be served.
+    Saves the model's config to model_directory and returns the weights,
+    converted to the passed precision, as a SafetensorsFile to add next to it.
     """
+    precision = Precision(precision)
+    config = copy.deepcopy(model.config)
+    # lets from_pretrained(torch_dtype="auto") load the weights as is.
+    config.torch_dtype = {
+        Precision.FLOAT16: "float16",
+        Precision.BFLOAT16: "bfloat16",
+    }[precision]
+    config.save_pretrained(model_directory)
+    return safetensors_file(model, precision=precision)
 
-    class BadModelFile(BaseException):
-        """ An exception thrown for bad model files. """
 
-    if not os.path.isfile(model_class_definition_file):
+def export_model_files(
+    model,
+    model_class_definition_file,
+    checkpoint_dir=None,
+    precision: Precision = None,
+    max_shard_size=None,
+):
+    """
+    Checks the model class definition file and saves the pretrained model,
+    unless checkpoint_dir is passed, to a temporary directory.
+    Returns the location of the weights and of the copied class definition.
+    With a precision, only the config is saved: the weights are converted
+    one tensor at a time while the archive is written, see archive_members.
+    max_shard_size is passed to save_pretrained, e.g. "2GB".
+    """
+    if precision is not None and checkpoint_dir is not None:
+        raise WeightsException(
+            "The precision of an existing checkpoint can't be changed. "
+            "Pass the model instead of checkpoint_dir."
+        )
+    if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
         raise FileNotFoundError(
-            "Could not find the model class definition file {}".format(
-                model_class_definition_file
-            )
+            "Could not find the model weights file {}".format(checkpoint_dir)
         )
 
-    if (
-        len(model_class_definition_file) < 3
-        or model_class_definition_file[-3:] != ".py"
-    ):
-        raise BadModelFile(
-            "Model class definition file ({}) is not a .py file.".format(
-                model_class_definition_file
-            )
-        )
-    warn_stream = io.StringIO("")
-    error_stream = io.StringIO("")
-    reporter = Reporter(warn_stream, error_stream)
-    num_errors = checkRecursive(["model.py"], reporter)
-    if num_errors > 0:
-        raise BadModelFile(
-            f"Found {num_errors} error(s) in model file. Please fix them and try again.\n"
-            + warn_stream.getvalue()
+    check_model_class_definition_file(model_class_definition_file)
+    temporary_directory = tempfile.mkdtemp()
+    if checkpoint_dir is not None:
+        model_weights = checkpoint_dir
+    elif precision is not None:
+        model_directory = os.path.join(temporary_directory, "model_weights")
+        model_weights = (
+            model_directory,
+            _save_converted(model, model_directory, precision),
         )
+    else:
+        model_weights = os.path.join(temporary_directory, "model_weights")
+        with tracing.span(
+            "easytensor.export_weights", weights_format="save_pretrained"
+        ) as span:
+            if max_shard_size is not None:
+                model.save_pretrained(model_weights, max_shard_size=max_shard_size)
+            else:
+                model.save_pretrained(model_weights)
+            if span.recording:
+                span.set("bytes_out", _directory_size(model_weights))
+    model_class_file = os.path.join(temporary_directory, "model.py")
+    shutil.copy2(model_class_definition_file, model_class_file)
+    return model_weights, model_class_file
 
-    module = importlib.import_module(model_class_definition_file[:-3])
-    classes = [
-        clas[1]
-        for clas in inspect.getmembers(
-            module,
-            lambda member: inspect.isclass(member)
-            and member.__module__ == module.__name__,
-        )
-    ]
-    if len(classes) > 1:
-        raise BadModelFile(
-            "Expected only one class definition in the model class file. "
-            "Found multiple: {}. Please include only your model's class definition.".format(
-                classes
-            )
-        )
 
-    if len(classes) < 1:
-        raise BadModelFile(
-            "Expected at least one class definition in the model file but found none. "
-            "Please include the class definition of your model."
+def upload_sharded_checkpoint(
+    model_weights,
+    model_class_file,
+    compression=Compression.GZIP,
+    multipart=False,
+    shard_workers=DEFAULT_SHARD_WORKERS,
+):
+    """
+    Uploads the weight shards of the checkpoint concurrently, skipping the
+    unchanged ones, then uploads an archive of the rest of the checkpoint,
+    the shard manifest and the class definition. See easytensor.shards.
+    Returns the address of the archive, the total size of the model and the
+    sharding metadata to register with it.
+    """
+    if not isinstance(model_weights, str):
+        raise WeightsException(
+            "Weights converted to another precision can't be uploaded sharded."
         )
+    shards = checkpoint_shards(model_weights)
+    manifest, skipped = upload_shards(
+        model_weights, shards, shard_workers, multipart=multipart
+    )
+    members = sharded_members(
+        model_weights,
+        shards,
+        manifest,
+        "model_weights",
+        os.path.join(os.path.dirname(model_class_file), MANIFEST_NAME),
+    )
+    members.append((model_class_file, "model.py"))
+    archive_location = create_archive(members, compression)
+    model_address, archive_size = upload_archive(archive_location, multipart=multipart)
+    shard_bytes = sum(shard["size"] for shard in manifest["shards"])
+    metadata = {
+        "shards": len(shards),
+        "skipped_shards": skipped,
+        "shard_bytes": shard_bytes,
+    }
+    return model_address, archive_size + shard_bytes, metadata
+
+
+def package_model(
+    model,
+    model_class_definition_file,
+    checkpoint_dir=None,
+    compression=Compression.GZIP,
+    precision: Precision = None,
+):
+    """
+    Exports the model and packages it with its class definition into a
+    temporary archive. Returns the archive's location.
+    """
+    model_weights, model_class_file = export_model_files(
+        model, model_class_definition_file, checkpoint_dir, precision
+    )
+    return create_model_archive(model_weights, model_class_file, compression)
 
 
 @needs_auth
+@tracing.traced("easytensor.upload_model", framework=Framework.TRANSFORMERS.value)
 def upload_model(
     model_name,
     model,
     model_class_definition_file,
     create_token=True,
     checkpoint_dir=None,
+    stream=False,
+    multipart=False,
+    compression=Compression.GZIP,
+    precision: Precision = None,
+    sharded=False,
+    max_shard_size=None,
+    shard_workers=DEFAULT_SHARD_WORKERS,
 ):
     """
     Uploads the passed model and the model class definition to be served by EasyTensor.
@@ -120,29 +235,98 @@ def upload_model(
     If checkpoint_dir is passed, the parameter will be used as the weights
     file and `model` will be ignored.
 
+    If stream is True, the archive is uploaded while it is being packaged
+    instead of being written to a temporary file first.
+    If multipart is True, the archive is uploaded in concurrent parts. See
+    easytensor.upload.upload_archive.
+    compression selects how the archive is compressed, see
+    easytensor.compression. Compression.AUTO skips compressing weight files
+    that barely compress.
+    precision (easytensor.constants.Precision) converts the floating point
+    weights to fp16 or bf16 while they are exported. The checkpoint is
+    then uploaded as the model's config and a model.safetensors file, and the
+    precision and the bytes saved are recorded in the model's metadata.
+
+    If sharded is True, every weight shard of the checkpoint is uploaded on
+    its own, shard_workers at a time, and shards that were uploaded before
+    are skipped. The model archive then holds a manifest of the shards, see
+    easytensor.shards. max_shard_size sets the size of the shards
+    save_pretrained writes, e.g. "2GB".
+
     Returns the model ID and a query access token.
     Creates a query access token for the model by default.
     """
-    if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
-        raise FileNotFoundError(
-            "Could not find the model weights file {}".format(checkpoint_dir)
+    model_weights, model_class_file = export_model_files(
+        model,
+        model_class_definition_file,
+        checkpoint_dir,
+        precision,
+        max_shard_size,
+    )
+    metadata = weights_metadata(model_weights)
+    if sharded:
+        model_address, model_size, metadata = upload_sharded_checkpoint(
+            model_weights, model_class_file, compression, multipart, shard_workers
+        )
+    elif stream:
+        model_address, model_size = upload_archive_stream(
+            stream_archive(
+                archive_members(model_weights, model_class_file), compression
+            )
         )
-
-    check_model_class_definition_file(model_class_definition_file)
-    temporary_directory = tempfile.mkdtemp()
-    if checkpoint_dir is not None:
-        model_directory = checkpoint_dir
     else:
-        model_directory = os.path.join(temporary_directory, "model_weights")
-        model.save_pretrained(model_directory)
-    model_class_file = os.path.join(temporary_directory, "model.py")
-    shutil.copy2(model_class_definition_file, model_class_file)
-    archive_location = create_model_archive(model_directory, model_class_file)
-    model_address, model_size = upload_archive(archive_location)
+        archive_location = create_model_archive(
+            model_weights, model_class_file, compression
+        )
+        model_address, model_size = upload_archive(
+            archive_location, multipart=multipart
+        )
     model_id = create_model_object(
-        model_address, model_name, model_size, Framework.TRANSFORMERS
+        model_address,
+        model_name,
+        model_size,
+        Framework.TRANSFORMERS,
+        metadata,
     )
     if not create_token:
         return model_id, None
     return model_id, create_query_token(model_id)
     # return archive_location
+
+
+@tracing.traced("easytensor.upload_model", framework=Framework.TRANSFORMERS.value)
+async def upload_model_async(
+    model_name,
+    model,
+    model_class_definition_file,
+    create_token=True,
+    checkpoint_dir=None,
+    compression=Compression.GZIP,
+    multipart=False,
+    precision: Precision = None,
+):
+    """
+    An asyncio counterpart of upload_model. Packaging runs in a thread pool
+    and the network calls are bounded by the easytensor.aio concurrency limit,
+    so many models can be uploaded concurrently.
+
+    Returns the model ID and a query access token.
+    """
+    model_weights, model_class_file = await aio.run_blocking(
+        export_model_files,
+        model,
+        model_class_definition_file,
+        checkpoint_dir,
+        precision,
+    )
+    archive_location = await aio.run_blocking(
+        create_model_archive, model_weights, model_class_file, compression
+    )
+    return await aio.upload_and_register(
+        archive_location,
+        model_name,
+        Framework.TRANSFORMERS,
+        create_token,
+        weights_metadata(model_weights),
+        multipart=multipart,
+    )
@@ -4,49 +4,280 @@ Since each framework has its own upload requirements, these are managed separate
 See easytensor/[framework]/upload.py for specific framework upload functions.
 """
 import os
+import time
 import uuid
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from tqdm import tqdm
 from easytensor.urls import UPLOAD_URL_REQUEST_URL, MODELS_URL, QUERY_TOKEN_URL
 from easytensor.auth import get_auth_token, needs_auth
-from easytensor.constants import Framework
+from easytensor.client import get_client
+from easytensor.scheduler import get_scheduler, current_priority
+from easytensor.archive import archive_digest
+from easytensor.dedup import find_existing_upload, get_content_hash, record_upload
+from easytensor.registry import get_registry
+from easytensor import journal, tracing
+from easytensor.constants import Framework, Priority
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Defaults for multipart uploads. Each worker holds one part in memory.
+MULTIPART_CHUNK_SIZE = 64 * 1024 * 1024
+MULTIPART_MAX_WORKERS = 4
+MULTIPART_MAX_RETRIES = 3
+MULTIPART_RETRY_BACKOFF = 0.5
+# Concurrent requests when minting query tokens in bulk.
+QUERY_TOKEN_MAX_WORKERS = 8
+
 
 class UploadException(BaseException):
     """ A simple exception for failures during upload."""
 
 
 @needs_auth
-def get_upload_url(model_name: str):
+def get_upload_url(
+    model_name: str, parts: int = None, upload_id: str = None, content_hash=None
+):
     """
     Requests a valid upload URL to uplaod the model to.
+    Returns the URL and the HTTP method to use.
+
+    If parts is passed, a multipart upload is started instead, and a dict is
+    returned with the upload ID, the per-part URLs and the URL used to
+    complete the upload:
+    {
+        "uploadId": str,
+        "parts": [{"partNumber": int, "url": str, "method": str}, ...],
+        "completeUrl": str,
+        "completeMethod": str,
+    }
+    Passing the upload_id of an unfinished multipart upload asks the backend
+    to resume it. The backend returns a new uploadId if it can't.
+    content_hash, the sha256 digest of the archive, lets the backend find the
+    upload by content later on. See easytensor.dedup.
     """
     auth_token = get_auth_token()
-    response = requests.post(
+    payload = {"filename": model_name, "contentType": "tar"}
+    if parts is not None:
+        payload["parts"] = parts
+    if upload_id is not None:
+        payload["uploadId"] = upload_id
+    if content_hash is not None:
+        payload["contentHash"] = content_hash
+    # requesting a single upload URL, or resuming an existing multipart
+    # upload, has no side effects, so it is safe to retry. Starting a new
+    # multipart upload creates an upload ID on the server, and a retry after a
+    # lost response would leave an orphaned upload behind.
+    response = get_client().post(
         UPLOAD_URL_REQUEST_URL,
-        json={"filename": model_name, "contentType": "tar"},
+        json=payload,
         headers={"Authorization": "Bearer {}".format(auth_token)},
+        retry=parts is None or upload_id is not None,
     )
     response.raise_for_status()
     res = response.json()
+    if parts is not None:
+        return res
     return res["url"], res["method"]
 
 
-@needs_auth
-def upload_archive(filename):
+def _read_part(filename, offset, length):
+    with open(filename, "rb") as fin:
+        fin.seek(offset)
+        return fin.read(length)
+
+
+def upload_part(
+    part,
+    filename,
+    offset,
+    length,
+    max_retries=MULTIPART_MAX_RETRIES,
+    priority: Priority = None,
+):
     """
-    Uplaods the archive and returns the ID of the model that was uploaded.
+    Uploads length bytes of the file starting at offset to the passed part
+    URL, retrying with exponential backoff on connection errors and server
+    errors.
+    Every attempt runs in a slot of the transfer scheduler, see
+    easytensor.scheduler.
+    Returns the ETag the storage backend assigned to the part.
     """
-    if not os.path.isfile(filename):
-        raise UploadException("Can not find file {}".format(filename))
-    model_address = str(uuid.uuid4())
-    upload_url, upload_method = get_upload_url(model_address)
-    size = os.path.getsize(filename)
-    with open(filename, "rb") as in_file:
+    data = _read_part(filename, offset, length)
+    attempt = 0
+    while True:
+        with get_scheduler().transfer(priority) as transfer:
+            try:
+                # retries are handled here, so that any server error is retried
+                response = get_client().request(
+                    method=part["method"],
+                    url=part["url"],
+                    data=transfer.reader(data),
+                    headers={"Content-Type": "application/octet-stream"},
+                    retry=False,
+                )
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                transfer.failed()
+                error = exc
+            else:
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    transfer.done(length)
+                    return response.headers.get("ETag", "")
+                transfer.failed()
+                error = UploadException(
+                    "Part {} failed with status {}".format(
+                        part["partNumber"], response.status_code
+                    )
+                )
+        attempt += 1
+        if attempt > max_retries:
+            raise error
+        tracing.current_span().add("part_retries")
+        LOGGER.debug(
+            "Retrying part %s (attempt %s): %s", part["partNumber"], attempt, error
+        )
+        time.sleep(MULTIPART_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+def _upload_journaled_part(
+    entry, part, filename, offset, length, max_retries, priority
+):
+    """
+    Uploads a part and records it in the journal entry, if any, as soon as it
+    is committed, so it survives a failure of any other part.
+    """
+    etag = upload_part(part, filename, offset, length, max_retries, priority)
+    tracing.current_span().add("bytes_sent", length)
+    if entry is not None:
+        journal.commit_part(entry, part["partNumber"], offset, length, etag)
+    return etag
+
+
+def _upload_multipart(
+    filename,
+    model_address,
+    size,
+    chunk_size,
+    max_workers,
+    max_retries,
+    entry=None,
+    content_hash=None,
+    priority: Priority = None,
+):
+    """
+    Uploads the file in parts. If a journal entry is passed, the parts it
+    records as committed are skipped and newly uploaded parts are recorded.
+    """
+    num_parts = max(1, -(-size // chunk_size))
+    upload_id = entry["upload_id"] if entry is not None else None
+    upload = get_upload_url(
+        model_address, parts=num_parts, upload_id=upload_id, content_hash=content_hash
+    )
+    if len(upload["parts"]) != num_parts:
+        raise UploadException(
+            "Requested {} part URLs, received {}".format(
+                num_parts, len(upload["parts"])
+            )
+        )
+    etags = {}
+    if entry is not None:
+        if upload["uploadId"] != upload_id:
+            # the backend couldn't resume the upload, start from scratch.
+            entry["parts"] = {}
+            journal.set_upload_id(entry, upload["uploadId"])
+        etags = journal.committed_parts(entry)
+    with tqdm(
+        total=size,
+        unit="B",
+        unit_scale=True,
+        miniters=1,
+        desc="Uploading to EasyTensor",
+    ) as progress:
+        if entry is not None:
+            progress.update(sum(part["length"] for part in entry["parts"].values()))
+        # the transfer rate of the span is measured over the part uploads
+        # alone, not the digest, dedup lookup and upload URL request before.
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for index, part in enumerate(upload["parts"]):
+                if part["partNumber"] in etags:
+                    continue
+                offset = index * chunk_size
+                length = min(chunk_size, size - offset)
+                future = executor.submit(
+                    tracing.in_context(_upload_journaled_part),
+                    entry,
+                    part,
+                    filename,
+                    offset,
+                    length,
+                    max_retries,
+                    priority,
+                )
+                futures[future] = (part["partNumber"], length)
+            try:
+                for future in as_completed(futures):
+                    part_number, length = futures[future]
+                    etags[part_number] = future.result()
+                    progress.update(length)
+            except BaseException:
+                # the upload failed, don't send the parts that haven't started.
+                for future in futures:
+                    future.cancel()
+                raise
+        tracing.current_span().set("transfer_seconds", time.perf_counter() - started)
+
+    auth_token = get_auth_token()
+    response = get_client().request(
+        method=upload.get("completeMethod", "POST"),
+        url=upload["completeUrl"],
+        retry=True,
+        json={
+            "uploadId": upload["uploadId"],
+            "parts": [
+                {"partNumber": number, "etag": etags[number]}
+                for number in sorted(etags)
+            ],
+        },
+        headers={"Authorization": "Bearer {}".format(auth_token)},
+    )
+    response.raise_for_status()
+
+
+def _resumable_entry(archive_hash, size, chunk_size):
+    """
+    Returns the journal entry for the archive, creating a new one unless an
+    earlier upload of the same archive with the same part size was interrupted.
+    """
+    journal.collect_garbage()
+    entry = journal.get_entry(archive_hash)
+    if (
+        entry is not None
+        and entry["size"] == size
+        and entry["chunk_size"] == chunk_size
+        and entry["upload_id"] is not None
+    ):
+        LOGGER.info(
+            "Resuming upload of %s, %s part(s) already uploaded.",
+            entry["address"],
+            len(entry["parts"]),
+        )
+        return entry
+    return journal.start_entry(archive_hash, str(uuid.uuid4()), size, chunk_size)
+
+
+def _upload_single(filename, model_address, content_hash=None, priority=None):
+    upload_url, upload_method = get_upload_url(
+        model_address, content_hash=content_hash
+    )
+    started = time.perf_counter()
+    with open(filename, "rb") as in_file, get_scheduler().transfer(
+        priority
+    ) as transfer:
         total_bytes = os.fstat(in_file.fileno()).st_size
         with tqdm.wrapattr(
             in_file,
@@ -55,50 +286,207 @@ def upload_archive(filename):
             miniters=1,
             desc="Uploading to EasyTensor",
         ) as file_obj:
-            response = requests.request(
+            try:
+                response = get_client().request(
+                    method=upload_method,
+                    url=upload_url,
+                    data=transfer.reader(file_obj, total_bytes),
+                    headers={"Content-Type": "application/octet-stream"},
+                    retry=False,
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                transfer.failed()
+                raise
+            if response.status_code >= 500:
+                transfer.failed()
+            response.raise_for_status()
+            transfer.done(total_bytes)
+    tracing.current_span().set("transfer_seconds", time.perf_counter() - started)
+
+
+@needs_auth
+@tracing.traced("easytensor.upload_archive")
+def upload_archive(
+    filename,
+    multipart=False,
+    chunk_size=MULTIPART_CHUNK_SIZE,
+    max_workers=MULTIPART_MAX_WORKERS,
+    max_retries=MULTIPART_MAX_RETRIES,
+    resume=True,
+    dedup=True,
+    content_hash=None,
+    priority: Priority = None,
+):
+    """
+    Uplaods the archive and returns the ID of the model that was uploaded.
+
+    If multipart is True, the archive is split into chunk_size parts that are
+    uploaded concurrently by max_workers threads. Each part is retried up to
+    max_retries times before the upload fails.
+    Multipart uploads are recorded in the local upload journal unless resume
+    is False, so uploading the same archive again after a failure only sends
+    the parts that are missing.
+    If dedup is True and the backend already has an archive with the same
+    content, the transfer is skipped and the existing address is returned.
+    content_hash: the sha256 digest of the archive, if the caller already
+    computed it. It is sent with the upload and recorded in the local index.
+    priority: the easytensor.constants.Priority of the transfers, defaults to
+    the current easytensor.scheduler.transfer_priority. Transfers are
+    bounded, ordered and paced process-wide, see easytensor.scheduler.
+    """
+    if not os.path.isfile(filename):
+        raise UploadException("Can not find file {}".format(filename))
+    size = os.path.getsize(filename)
+    # resolved here, part uploads run in other threads.
+    priority = priority if priority is not None else current_priority()
+    span = tracing.current_span()
+    span.set("multipart", multipart)
+    if content_hash is None and (dedup or (multipart and resume)):
+        content_hash = archive_digest(filename)
+    if dedup:
+        existing_address = find_existing_upload(content_hash)
+        if existing_address is not None:
+            LOGGER.info(
+                "Archive was already uploaded to %s, skipping upload.",
+                existing_address,
+            )
+            span.set("deduplicated", True)
+            return existing_address, size
+
+    if multipart:
+        entry = None
+        if resume:
+            entry = _resumable_entry(content_hash, size, chunk_size)
+        model_address = entry["address"] if entry else str(uuid.uuid4())
+        _upload_multipart(
+            filename,
+            model_address,
+            size,
+            chunk_size,
+            max_workers,
+            max_retries,
+            entry=entry,
+            content_hash=content_hash,
+            priority=priority,
+        )
+        if entry is not None:
+            journal.remove_entry(entry["hash"])
+    else:
+        model_address = str(uuid.uuid4())
+        _upload_single(filename, model_address, content_hash, priority)
+        span.set("bytes_sent", size)
+
+    if content_hash is not None:
+        record_upload(content_hash, model_address)
+    return model_address, size
+
+
+@needs_auth
+@tracing.traced("easytensor.upload_archive", streamed=True)
+def upload_archive_stream(stream, priority: Priority = None):
+    """
+    Uploads an archive while it is being built and returns the ID of the model
+    that was uploaded along with the number of bytes sent.
+    stream: an easytensor.archive.ArchiveStream. The archive is sent with
+    chunked transfer encoding, so no intermediate file is written to disk.
+    priority: see upload_archive.
+    """
+    model_address = str(uuid.uuid4())
+    upload_url, upload_method = get_upload_url(model_address)
+    started = time.perf_counter()
+
+    def _chunks(progress, transfer):
+        for chunk in stream:
+            transfer.throttle(len(chunk))
+            progress.update(len(chunk))
+            yield chunk
+
+    with tqdm(
+        unit="B",
+        unit_scale=True,
+        miniters=1,
+        desc="Uploading to EasyTensor",
+    ) as progress, get_scheduler().transfer(priority) as transfer:
+        try:
+            response = get_client().request(
                 method=upload_method,
                 url=upload_url,
-                data=file_obj,
+                data=_chunks(progress, transfer),
                 headers={"Content-Type": "application/octet-stream"},
+                retry=False,
             )
-            response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout):
+            transfer.failed()
+            raise
+        finally:
+            stream.close()
+        if response.status_code >= 500:
+            transfer.failed()
+        response.raise_for_status()
+        transfer.done(stream.size)
 
-    return model_address, size
+    span = tracing.current_span()
+    span.set("bytes_out", stream.size)
+    span.set("bytes_sent", stream.size)
+    span.set("transfer_seconds", time.perf_counter() - started)
+    record_upload(stream.digest, model_address)
+    return model_address, stream.size
 
 
 @needs_auth
-def create_model_object(address: str, name: str, size: int, framework: Framework):
+@tracing.traced("easytensor.create_model_object")
+def create_model_object(
+    address: str, name: str, size: int, framework: Framework, metadata: dict = None
+):
     """
     Creates a model object in EasyTensor backend.
     address: the remote address of the model.
     name: the display name of the model.
     size: the size of the file on disk.
+    metadata: optional details of the model, e.g. the format and precision
+    of its weights.
     """
     assert isinstance(framework, Framework)
     auth_token = get_auth_token()
-    response = requests.post(
+    body = {
+        "address": address,
+        "name": name,
+        "size": size,
+        "framework": framework.value,
+    }
+    if metadata:
+        body["metadata"] = metadata
+    response = get_client().post(
         MODELS_URL,
-        json={
-            "address": address,
-            "name": name,
-            "size": size,
-            "framework": framework.value,
-        },
+        json=body,
         headers={"Authorization": "Bearer {}".format(auth_token)},
     )
 
     response.raise_for_status()
     res = response.json()
+    span = tracing.current_span()
+    span.set("model_name", name)
+    span.set("model_id", res["id"])
+    get_registry().record_model(
+        res["id"], name, address, size, framework.value, get_content_hash(address)
+    )
     return res["id"]
 
 
 @needs_auth
+@tracing.traced("easytensor.create_query_token")
 def create_query_token(model_id):
     """
     Creates a query token for the model with the passed model id.
+    The token is recorded in the local registry, see easytensor.registry.
     """
-    auth_token = get_auth_token()
-    response = requests.post(
+    token = _mint_query_token(model_id, get_auth_token())
+    get_registry().record_tokens({model_id: token})
+    return token
+
+
+def _mint_query_token(model_id, auth_token):
+    response = get_client().post(
         QUERY_TOKEN_URL,
         json={"model": model_id},
         headers={"Authorization": "Bearer {}".format(auth_token)},
@@ -106,3 +494,59 @@ def create_query_token(model_id):
     response.raise_for_status()
     res = response.json()
     return res["id"]
+
+
+@needs_auth
+@tracing.traced("easytensor.create_query_tokens")
+def create_query_tokens(
+    model_ids, refresh=False, max_workers=QUERY_TOKEN_MAX_WORKERS
+):
+    """
+    Returns a dict of query tokens for the models with the passed ids.
+    Tokens recorded in the local registry are reused unless refresh is True.
+    The others are minted concurrently by max_workers threads over the pooled
+    client and recorded in the registry. If minting fails for a model, the
+    tokens minted for the others are still recorded before the error is
+    raised.
+    """
+    model_ids = list(dict.fromkeys(model_ids))
+    registry = get_registry()
+    tokens = {}
+    if not refresh:
+        for model_id in model_ids:
+            token = registry.query_token(model_id)
+            if token is not None:
+                tokens[model_id] = token
+    missing = [model_id for model_id in model_ids if model_id not in tokens]
+    span = tracing.current_span()
+    span.set("models", len(model_ids))
+    span.set("cached", len(tokens))
+    if not missing:
+        return tokens
+    auth_token = get_auth_token()
+    minted = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                tracing.in_context(_mint_query_token), model_id, auth_token
+            ): model_id
+            for model_id in missing
+        }
+        for future in as_completed(futures):
+            try:
+                minted[futures[future]] = future.result()
+            except (requests.RequestException, KeyError, ValueError) as exc:
+                LOGGER.warning(
+                    "Could not create a query token for model %s: %s",
+                    futures[future],
+                    exc,
+                )
+                error = error or exc
+    span.set("minted", len(minted))
+    if minted:
+        registry.record_tokens(minted)
+    if error is not None:
+        raise error
+    tokens.update(minted)
+    return {model_id: tokens[model_id] for model_id in model_ids}
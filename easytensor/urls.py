@@ -7,8 +7,10 @@ BASE_URL = ""
 AUTHENTICATION_URL = ""
 REFRESH_TOKEN_URL = ""
 UPLOAD_URL_REQUEST_URL = ""
+UPLOAD_LOOKUP_URL = ""
 MODELS_URL = ""
 QUERY_TOKEN_URL = ""
+QUERY_URL = ""
 
 # pylint: disable=global-statement
 
@@ -20,16 +22,20 @@ def reload_urls():
     global BASE_URL
     global AUTHENTICATION_URL
     global UPLOAD_URL_REQUEST_URL
+    global UPLOAD_LOOKUP_URL
     global REFRESH_TOKEN_URL
     global MODELS_URL
     global QUERY_TOKEN_URL
+    global QUERY_URL
     config = get_config()
     BASE_URL = config.get("base_url", "https://app.easytensor.com")
     AUTHENTICATION_URL = BASE_URL + "/v1/dj-rest-auth/login/"
     REFRESH_TOKEN_URL = BASE_URL + "/v1/dj-rest-auth/token/refresh/"
     UPLOAD_URL_REQUEST_URL = BASE_URL + "/v1/model-uploads/"
+    UPLOAD_LOOKUP_URL = BASE_URL + "/v1/model-uploads/lookup/"
     MODELS_URL = BASE_URL + "/v1/models/"
     QUERY_TOKEN_URL = BASE_URL + "/v1/query-access-token/"
+    QUERY_URL = BASE_URL + "/query/"
 
 
 reload_urls()
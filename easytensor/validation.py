@@ -0,0 +1,127 @@
+"""
+A module for validating model class definition files before they are
+uploaded.
+
+The file is never imported: pyflakes checks its source and the class
+definitions are counted on its syntax tree, so validating a model file
+doesn't run it, or its imports (e.g. torch), in the uploading process.
+Results are memoized by the sha256 digest of the file's content, so
+uploading several models defined by the same file only checks it once.
+"""
+import os
+import io
+import ast
+import hashlib
+import threading
+import collections
+import logging
+from pyflakes.api import check
+from pyflakes.reporter import Reporter
+from easytensor import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+# The method served models must define.
+PREDICT_METHOD = "predict_single"
+
+# error message (or None for valid files) by content digest, least recently
+# used first.
+_RESULTS = collections.OrderedDict()
+_LOCK = threading.Lock()
+# Maximum number of validation results remembered.
+RESULTS_MAX_ENTRIES = 256
+
+
+class BadModelFile(BaseException):
+    """ An exception thrown for bad model files. """
+
+
+def _class_definitions(tree):
+    """ Returns the classes defined at the top level of the module. """
+    return [node for node in tree.body if isinstance(node, ast.ClassDef)]
+
+
+def _defines_method(class_node, name):
+    return any(
+        isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == name
+        for node in class_node.body
+    )
+
+
+def _validate_source(source, filename):
+    """
+    Returns the error message of the source, or None if it is valid.
+    """
+    warn_stream = io.StringIO("")
+    error_stream = io.StringIO("")
+    reporter = Reporter(warn_stream, error_stream)
+    num_errors = check(source, filename, reporter)
+    if num_errors > 0:
+        return (
+            "Found {} error(s) in model file. Please fix them and try again.\n".format(
+                num_errors
+            )
+            + warn_stream.getvalue()
+            + error_stream.getvalue()
+        )
+
+    # the source compiled for pyflakes, so it parses.
+    classes = _class_definitions(ast.parse(source, filename))
+    if len(classes) > 1:
+        return (
+            "Expected only one class definition in the model class file. "
+            "Found multiple: {}. Please include only your model's class "
+            "definition.".format([node.name for node in classes])
+        )
+    if len(classes) < 1:
+        return (
+            "Expected at least one class definition in the model file but found "
+            "none. Please include the class definition of your model."
+        )
+    if not _defines_method(classes[0], PREDICT_METHOD):
+        LOGGER.warning(
+            "The model class %s doesn't define a %s method.",
+            classes[0].name,
+            PREDICT_METHOD,
+        )
+    return None
+
+
+@tracing.traced("easytensor.validate_model_file")
+def check_model_class_definition_file(model_class_definition_file):
+    """
+    A function that checks the model class definition file exists and
+    is formatted correctly to be served.
+    Raises BadModelFile if it isn't.
+    """
+    if not os.path.isfile(model_class_definition_file):
+        raise FileNotFoundError(
+            "Could not find the model class definition file {}".format(
+                model_class_definition_file
+            )
+        )
+
+    if not model_class_definition_file.endswith(".py"):
+        raise BadModelFile(
+            "Model class definition file ({}) is not a .py file.".format(
+                model_class_definition_file
+            )
+        )
+
+    with open(model_class_definition_file, "rb") as fin:
+        source = fin.read()
+    digest = hashlib.sha256(source).hexdigest()
+    with _LOCK:
+        known = digest in _RESULTS
+        if known:
+            _RESULTS.move_to_end(digest)
+        error = _RESULTS.get(digest)
+    tracing.current_span().set("cached", known)
+    if not known:
+        error = _validate_source(source, model_class_definition_file)
+        with _LOCK:
+            _RESULTS[digest] = error
+            while len(_RESULTS) > RESULTS_MAX_ENTRIES:
+                _RESULTS.popitem(last=False)
+    if error is not None:
+        raise BadModelFile(error)
@@ -0,0 +1,58 @@
+"""
+Shared test setup. The tests run in a temporary HOME, so they never read or
+change the real ~/.easytensor config, against the fake API server of the
+benchmarks (benchmarks/fake_server.py).
+"""
+import os
+import sys
+import time
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# before easytensor is imported, it reads the config location from HOME.
+HOME = tempfile.mkdtemp(prefix="easytensor-tests-")
+os.environ["HOME"] = HOME
+os.environ["USERPROFILE"] = HOME
+
+# pylint: disable=wrong-import-position
+from benchmarks.fake_server import FakeServer, make_jwt
+import easytensor
+from easytensor.auth import TOKEN_MANAGER
+
+# the upload module binds the URLs when it is first imported, so the server
+# is started and the base URL set before any test module imports it.
+SERVER = FakeServer().start()
+easytensor.set_base_url(SERVER.url)
+TOKEN_MANAGER.set_tokens(make_jwt(time.time() + 24 * 60 * 60), "refresh")
+
+
+def pytest_unconfigure(config):  # pylint: disable=unused-argument
+    """ Stops the fake server. """
+    SERVER.stop()
+
+
+@pytest.fixture
+def server():
+    """
+    The fake API server, with its counters, injected failures and latency
+    reset.
+    """
+    SERVER.state.reset()
+    yield SERVER
+    SERVER.state.reset()
+    SERVER.state.latency = 0.0
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """ Returns a function writing a file of random bytes of the passed size. """
+
+    def _archive(size, name="archive.tar.gz"):
+        path = tmp_path / name
+        path.write_bytes(os.urandom(size))
+        return str(path)
+
+    return _archive
@@ -0,0 +1,111 @@
+"""
+Tests for the asyncio wrappers of easytensor.aio against the fake API server.
+"""
+import time
+import asyncio
+import threading
+import pytest
+from easytensor import aio, upload
+from easytensor.auth import TOKEN_MANAGER
+from easytensor.constants import Framework, Priority
+from easytensor.scheduler import current_priority, transfer_priority
+from easytensor.tensorflow import upload_model_async
+from benchmarks.fake_server import make_jwt
+
+
+@pytest.fixture
+def concurrency_limit():
+    """ Restores the default concurrency limit after the test. """
+    yield aio.set_concurrency_limit
+    aio.set_concurrency_limit(aio.DEFAULT_CONCURRENCY)
+
+
+def test_upload_and_register(server, archive):
+    location = archive(1024)
+    model_id, token = asyncio.run(
+        aio.upload_and_register(location, "aio model", Framework.PYTORCH)
+    )
+    assert model_id and token
+    assert server.state.models[-1]["name"] == "aio model"
+    assert server.state.models[-1]["framework"] == Framework.PYTORCH.value
+
+
+def test_upload_and_register_without_token(server, archive):
+    location = archive(1024)
+    model_id, token = asyncio.run(
+        aio.upload_and_register(
+            location, "no token", Framework.PYTORCH, create_token=False
+        )
+    )
+    assert model_id and token is None
+    assert server.state.requests["/v1/query-access-token/"] == 0
+
+
+def test_concurrent_uploads_respect_the_limit(
+    server, archive, monkeypatch, concurrency_limit
+):
+    concurrency_limit(2)
+    lock = threading.Lock()
+    counts = {"active": 0, "peak": 0}
+    upload_archive = upload.upload_archive
+
+    def counting_upload(*args, **kwargs):
+        with lock:
+            counts["active"] += 1
+            counts["peak"] = max(counts["peak"], counts["active"])
+        try:
+            time.sleep(0.05)
+            return upload_archive(*args, **kwargs)
+        finally:
+            with lock:
+                counts["active"] -= 1
+
+    monkeypatch.setattr(upload, "upload_archive", counting_upload)
+    locations = [archive(1024, "{}.tar.gz".format(index)) for index in range(6)]
+
+    async def upload_all():
+        return await asyncio.gather(
+            *(aio.upload_archive(location, dedup=False) for location in locations)
+        )
+
+    results = asyncio.run(upload_all())
+    assert len({address for address, _ in results}) == 6
+    assert counts["peak"] == 2
+
+
+def test_run_blocking_keeps_the_callers_context():
+    async def run():
+        with transfer_priority(Priority.HIGH):
+            return await aio.run_blocking(current_priority)
+
+    assert asyncio.run(run()) == Priority.HIGH
+
+
+def test_expired_token_is_refreshed_once(server):
+    TOKEN_MANAGER.set_tokens(make_jwt(time.time() - 60), "refresh")
+
+    async def mint():
+        return await asyncio.gather(
+            *(aio.create_query_token(str(index)) for index in range(5))
+        )
+
+    tokens = asyncio.run(mint())
+    assert len(set(tokens)) == 5
+    assert server.state.requests["/v1/dj-rest-auth/token/refresh/"] == 1
+    assert TOKEN_MANAGER.is_valid()
+
+
+def test_create_query_tokens(server):
+    tokens = asyncio.run(aio.create_query_tokens(["1", "2", "3"], refresh=True))
+    assert set(tokens) == {"1", "2", "3"}
+    assert server.state.requests["/v1/query-access-token/"] == 3
+
+
+def test_tensorflow_upload_model_async(server, tmp_path):
+    saved_model = tmp_path / "saved_model"
+    (saved_model / "variables").mkdir(parents=True)
+    (saved_model / "saved_model.pb").write_bytes(b"graph")
+    (saved_model / "variables" / "variables.index").write_bytes(b"index")
+    model_id, token = asyncio.run(upload_model_async("tf model", str(saved_model)))
+    assert model_id and token
+    assert server.state.models[-1]["framework"] == Framework.TENSORFLOW.value
@@ -0,0 +1,45 @@
+"""
+Tests for the digests easytensor.archive remembers for the archives it
+creates.
+"""
+import os
+from easytensor import archive
+from easytensor.archive import archive_digest, create_archive, file_digest
+
+
+def _create(tmp_path, content):
+    member = tmp_path / "member"
+    member.write_bytes(content)
+    return create_archive([(str(member), "member")])
+
+
+def test_digest_of_created_archive_is_remembered(tmp_path, monkeypatch):
+    location = _create(tmp_path, b"weights")
+    expected = file_digest(location)
+    monkeypatch.setattr(archive, "file_digest", None)
+    try:
+        assert archive_digest(location) == expected
+    finally:
+        os.remove(location)
+
+
+def test_changed_archive_is_hashed_again(tmp_path):
+    location = _create(tmp_path, b"weights")
+    try:
+        with open(location, "ab") as fout:
+            fout.write(b"appended")
+        assert archive_digest(location) == file_digest(location)
+        assert location not in archive._KNOWN_DIGESTS
+    finally:
+        os.remove(location)
+
+
+def test_remembered_digests_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "KNOWN_DIGESTS_MAX_ENTRIES", 2)
+    locations = [_create(tmp_path, bytes([index])) for index in range(3)]
+    try:
+        archive_digest(locations[1])
+        assert list(archive._KNOWN_DIGESTS) == [locations[2], locations[1]]
+    finally:
+        for location in locations:
+            os.remove(location)
@@ -0,0 +1,114 @@
+"""
+Tests for the token refresh timing of easytensor.auth.TokenManager, against
+the fake API server.
+"""
+import time
+import threading
+import pytest
+from benchmarks.fake_server import make_jwt
+from easytensor.auth import (
+    REFRESH_MARGIN,
+    TOKEN_MANAGER,
+    TokenManager,
+    jwt_expiry,
+    jwt_lifetime,
+)
+
+REFRESH = "/v1/dj-rest-auth/token/refresh/"
+
+
+@pytest.fixture
+def manager():
+    """
+    A fresh TokenManager. Its tokens are written to the shared test config,
+    so the long lived token of the other tests is restored afterwards.
+    """
+    fresh = TokenManager()
+    yield fresh
+    fresh.stop_background_refresh()
+    TOKEN_MANAGER.set_tokens(make_jwt(time.time() + 24 * 60 * 60), "refresh")
+
+
+def test_jwt_claims():
+    token = make_jwt(2000, issued_at=1000)
+    assert jwt_expiry(token) == 2000
+    assert jwt_lifetime(token) == 1000
+    assert jwt_lifetime(make_jwt(2000)) is None
+    assert jwt_expiry("not a jwt") is None
+
+
+def test_long_lived_token_uses_the_refresh_margin(manager):
+    now = time.time()
+    manager.set_tokens(make_jwt(now + 3600, issued_at=now))
+    assert manager.margin() == REFRESH_MARGIN
+    assert manager.is_valid(REFRESH_MARGIN - 5)
+    manager.set_tokens(make_jwt(now + REFRESH_MARGIN - 5, issued_at=now - 3600))
+    assert manager.is_valid()
+    assert not manager.is_valid(manager.margin())
+
+
+def test_short_lived_token_uses_a_quarter_of_its_lifetime(manager):
+    now = time.time()
+    manager.set_tokens(make_jwt(now + 120, issued_at=now))
+    assert manager.margin() == 30
+    assert manager.is_valid(manager.margin())
+    manager.set_tokens(make_jwt(now + 20, issued_at=now - 100))
+    assert manager.margin() == 30
+    assert not manager.is_valid(manager.margin())
+
+
+def test_token_without_iat_counts_its_lifetime_from_now(manager):
+    manager.set_tokens(make_jwt(time.time() + 60))
+    assert manager.margin() == pytest.approx(15, abs=1)
+    assert manager.is_valid(manager.margin())
+
+
+def test_expired_token_is_not_valid(manager):
+    manager.set_tokens(make_jwt(time.time() - 1))
+    assert not manager.is_valid()
+
+
+def test_concurrent_callers_share_one_refresh(server, manager):
+    now = time.time()
+    manager.set_tokens(make_jwt(now + 10, issued_at=now - 3600), "refresh")
+    expiring = manager._access_token
+    server.state.latency = 0.05
+    count = 16
+    barrier = threading.Barrier(count)
+    tokens = []
+
+    def _access():
+        barrier.wait()
+        tokens.append(manager.access_token())
+
+    threads = [threading.Thread(target=_access) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.state.requests[REFRESH] == 1
+    assert len(set(tokens)) == 1
+    assert tokens[0] != expiring
+    assert manager.is_valid(manager.margin())
+
+
+def test_valid_token_is_not_refreshed(server, manager):
+    manager.set_tokens(make_jwt(time.time() + 3600), "refresh")
+    assert manager.access_token() is not None
+    assert server.state.requests[REFRESH] == 0
+
+
+def test_background_thread_refreshes_before_expiry(server, manager):
+    now = time.time()
+    # a margin of half a second, so the refresh is due in 1.5 seconds.
+    manager.set_tokens(make_jwt(now + 2, issued_at=now), "refresh")
+    expiring = manager._access_token
+    manager.start_background_refresh()
+    deadline = time.time() + 5
+    while manager._access_token == expiring and time.time() < deadline:
+        time.sleep(0.05)
+    assert server.state.requests[REFRESH] == 1
+    assert manager._access_token != expiring
+    assert manager.is_valid(manager.margin())
+    manager.stop_background_refresh()
+    assert manager._thread is None
@@ -0,0 +1,50 @@
+"""
+Tests for easytensor.batch against the fake API server: a failing model
+only fails its own result, while interrupts stop the whole batch.
+"""
+import pytest
+from easytensor import batch
+from easytensor.constants import Framework
+from easytensor.upload import UploadException
+
+
+@pytest.fixture
+def saved_models(tmp_path):
+    """ Returns the batch items of three TensorFlow models. """
+    items = []
+    for name in ("first", "second", "third"):
+        location = tmp_path / name
+        location.mkdir()
+        (location / "saved_model.pb").write_bytes(name.encode())
+        items.append((name, str(location), {}))
+    return items
+
+
+def _failing_on(name, error, create_model_object):
+    def _create(address, model_name, *args):
+        if model_name == name:
+            raise error
+        return create_model_object(address, model_name, *args)
+
+    return _create
+
+
+def test_failed_model_does_not_fail_the_batch(server, saved_models, monkeypatch):
+    monkeypatch.setattr(
+        batch,
+        "create_model_object",
+        _failing_on("second", UploadException("rejected"), batch.create_model_object),
+    )
+    results = batch.upload_models(saved_models, Framework.TENSORFLOW)
+    assert [result.ok for result in results] == [True, False, True]
+    assert isinstance(results[1].error, UploadException)
+
+
+def test_interrupt_stops_the_batch(server, saved_models, monkeypatch):
+    monkeypatch.setattr(
+        batch,
+        "create_model_object",
+        _failing_on("second", KeyboardInterrupt(), batch.create_model_object),
+    )
+    with pytest.raises(KeyboardInterrupt):
+        batch.upload_models(saved_models, Framework.TENSORFLOW)
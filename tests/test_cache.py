@@ -0,0 +1,139 @@
+"""
+Tests for easytensor.cache.PredictionCache: LRU eviction, expiry,
+persistence and the stats counters.
+"""
+import os
+import pytest
+import numpy as np
+from easytensor import cache
+from easytensor.cache import PredictionCache, instance_hash
+from easytensor.query import QueryClient
+
+
+class FakeClock:
+    """ Stands in for the time module, only moves when told to. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(cache, "time", fake)
+    return fake
+
+
+def test_least_recently_used_entries_are_evicted():
+    predictions = PredictionCache(max_entries=2)
+    predictions.put("model", "a", [1])
+    predictions.put("model", "b", [2])
+    assert predictions.get("model", "a") == (True, [1])
+    predictions.put("model", "c", [3])
+    assert predictions.get("model", "b") == (False, None)
+    assert predictions.get("model", "a") == (True, [1])
+    assert predictions.get("model", "c") == (True, [3])
+    assert predictions.stats() == {
+        "hits": 3,
+        "misses": 1,
+        "evictions": 1,
+        "entries": 2,
+    }
+
+
+def test_entries_are_keyed_by_model():
+    predictions = PredictionCache()
+    predictions.put("first", "a", [1])
+    assert predictions.get("second", "a") == (False, None)
+    predictions.invalidate("first")
+    assert len(predictions) == 0
+
+
+def test_entries_expire_after_ttl(clock):
+    predictions = PredictionCache(ttl=10)
+    predictions.put("model", "a", [1])
+    clock.now += 9.9
+    assert predictions.get("model", "a") == (True, [1])
+    clock.now += 0.1
+    assert predictions.get("model", "a") == (False, None)
+    assert len(predictions) == 0
+
+
+def test_entries_without_ttl_never_expire(clock):
+    predictions = PredictionCache(ttl=None)
+    predictions.put("model", "a", [1])
+    clock.now += 10 ** 9
+    assert predictions.get("model", "a") == (True, [1])
+
+
+def test_results_are_copies():
+    predictions = PredictionCache()
+    prediction = {"scores": [0.1, 0.9]}
+    predictions.put("model", "a", prediction)
+    prediction["scores"].append(1)
+    _, cached = predictions.get("model", "a")
+    cached["scores"].clear()
+    assert predictions.get("model", "a") == (True, {"scores": [0.1, 0.9]})
+
+
+def test_saved_entries_are_reloaded(clock):
+    predictions = PredictionCache(ttl=10, name="test-reload")
+    predictions.put("model", "a", {"label": "cat", "scores": np.arange(3.0)})
+    predictions.put("model", "b", [2])
+    clock.now += 5
+    predictions.put("model", "c", [3])
+    predictions.save()
+    assert os.path.isfile(predictions.path)
+
+    clock.now += 6
+    reloaded = PredictionCache(ttl=10, name="test-reload")
+    assert reloaded.get("model", "a") == (False, None)
+    assert reloaded.get("model", "c") == (True, [3])
+    assert len(reloaded) == 1
+
+
+def test_reload_keeps_the_most_recent_entries():
+    predictions = PredictionCache(name="test-trim")
+    for index in range(5):
+        predictions.put("model", str(index), [index])
+    predictions.save()
+    reloaded = PredictionCache(max_entries=2, name="test-trim")
+    assert reloaded.get("model", "3") == (True, [3])
+    assert reloaded.get("model", "4") == (True, [4])
+    assert len(reloaded) == 2
+
+
+def test_arrays_survive_a_reload():
+    predictions = PredictionCache(name="test-arrays")
+    predictions.put("model", "a", {"scores": np.arange(4, dtype="float32")})
+    predictions.save()
+    _, prediction = PredictionCache(name="test-arrays").get("model", "a")
+    np.testing.assert_array_equal(prediction["scores"], np.arange(4))
+    assert prediction["scores"].dtype == np.float32
+
+
+def test_unreadable_cache_file_is_ignored():
+    predictions = PredictionCache(name="test-corrupt")
+    os.makedirs(os.path.dirname(predictions.path), exist_ok=True)
+    with open(predictions.path, "w") as fout:
+        fout.write("{not json")
+    assert len(PredictionCache(name="test-corrupt")) == 0
+
+
+def test_instance_hash_ignores_key_order_and_hashes_arrays_by_value():
+    assert instance_hash({"a": 1, "b": [2]}) == instance_hash({"b": [2], "a": 1})
+    first = np.arange(4, dtype="<i4")
+    assert instance_hash(first) == instance_hash(first.astype(">i4"))
+    assert instance_hash(first) != instance_hash(first.astype("float32"))
+
+
+def test_client_answers_repeated_instances_from_the_cache(server):
+    with QueryClient("token", cache=True) as client:
+        assert client.predict_batch([[1, 2], [3, 4]]) == [[3], [7]]
+        assert client.predict_batch([[3, 4], [5, 6]]) == [[7], [11]]
+        assert client.predict([1, 2]) == [3]
+    assert server.state.query_sizes == [2, 1]
+    assert client.cache.stats()["hits"] == 2
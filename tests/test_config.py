@@ -0,0 +1,138 @@
+"""
+Tests for the cached, atomically written config of easytensor.config.
+"""
+import os
+import sys
+import json
+import subprocess
+import threading
+import pytest
+from conftest import HOME, ROOT
+from easytensor import config
+from easytensor.config import get_config, update_config, write_json_atomic
+
+
+@pytest.fixture
+def stored():
+    """ Restores the config the other tests use afterwards. """
+    original = get_config()
+    yield original
+    config._store_config(original)
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """ Counts the reads of the config file. """
+    counts = [0]
+    read_config = config._read_config
+
+    def _counting_read():
+        counts[0] += 1
+        return read_config()
+
+    monkeypatch.setattr(config, "_read_config", _counting_read)
+    return counts
+
+
+def _write_externally(obj, mtime_ns=None, replace=False):
+    """
+    Writes the config file behind the cache's back, in place or by
+    replacing it, and optionally sets its modification time.
+    """
+    path = config._CONFIG_PATH
+    target = path + ".external" if replace else path
+    with open(target, "w") as fout:
+        json.dump(obj, fout, indent=2)
+    if mtime_ns is not None:
+        os.utime(target, ns=(mtime_ns, mtime_ns))
+    if replace:
+        os.replace(target, path)
+
+
+def test_second_read_does_not_open_the_file(stored, reads):
+    update_config({"setting": "value"})
+    reads[0] = 0
+    assert get_config()["setting"] == "value"
+    assert get_config()["setting"] == "value"
+    assert reads[0] == 0
+
+
+def test_external_write_with_a_new_size_is_picked_up(stored, reads):
+    get_config()
+    _write_externally(dict(stored, setting="longer value"))
+    assert get_config()["setting"] == "longer value"
+    assert reads[0] == 1
+
+
+def test_external_write_with_a_new_mtime_is_picked_up(stored, reads):
+    update_config({"setting": "aaaa"})
+    reads[0] = 0
+    before = os.stat(config._CONFIG_PATH)
+    _write_externally(dict(stored, setting="bbbb"), before.st_mtime_ns + 10 ** 9)
+    assert os.stat(config._CONFIG_PATH).st_size == before.st_size
+    assert get_config()["setting"] == "bbbb"
+    assert reads[0] == 1
+
+
+def test_replaced_file_with_the_same_size_and_mtime_is_picked_up(stored, reads):
+    update_config({"setting": "aaaa"})
+    reads[0] = 0
+    before = os.stat(config._CONFIG_PATH)
+    _write_externally(dict(stored, setting="bbbb"), before.st_mtime_ns, replace=True)
+    after = os.stat(config._CONFIG_PATH)
+    assert (after.st_size, after.st_mtime_ns) == (before.st_size, before.st_mtime_ns)
+    assert after.st_ino != before.st_ino
+    assert get_config()["setting"] == "bbbb"
+    assert reads[0] == 1
+
+
+def test_write_json_atomic_leaves_no_temporary_files(tmp_path):
+    path = tmp_path / "file.json"
+    write_json_atomic(str(path), {"a": 1})
+    with pytest.raises(TypeError):
+        write_json_atomic(str(path), {"a": object()})
+    assert json.loads(path.read_text()) == {"a": 1}
+    assert os.listdir(tmp_path) == ["file.json"]
+
+
+def test_concurrent_thread_updates_keep_every_key(stored):
+    def _update(thread):
+        for index in range(20):
+            update_config({"thread-{}-{}".format(thread, index): index})
+
+    threads = [threading.Thread(target=_update, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    current = get_config()
+    for thread in range(8):
+        for index in range(20):
+            assert current["thread-{}-{}".format(thread, index)] == index
+    assert current["access_token"] == stored["access_token"]
+
+
+_PROCESS_UPDATES = """
+import sys
+sys.path.insert(0, {root!r})
+from easytensor.config import update_config
+for index in range(20):
+    update_config({{"process-{process}-" + str(index): index}})
+"""
+
+
+def test_concurrent_process_updates_keep_every_key(stored):
+    env = dict(os.environ, HOME=HOME, USERPROFILE=HOME)
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", _PROCESS_UPDATES.format(root=ROOT, process=n)],
+            env=env,
+        )
+        for n in range(4)
+    ]
+    assert [process.wait() for process in processes] == [0] * 4
+    current = get_config()
+    for process in range(4):
+        for index in range(20):
+            assert current["process-{}-{}".format(process, index)] == index
+    assert current["access_token"] == stored["access_token"]
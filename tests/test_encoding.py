@@ -0,0 +1,131 @@
+"""
+Tests for the tensor frames and base64 tensors of easytensor.encoding.
+"""
+import io
+import struct
+import json
+import pytest
+import numpy as np
+from easytensor.encoding import (
+    FRAME_ALIGNMENT,
+    FRAME_MAGIC,
+    EncodingException,
+    decode_base64,
+    decode_frame,
+    encode_base64,
+    encode_frame,
+    little_endian,
+)
+
+DTYPES = ["bool", "int8", "uint8", "int16", "int32", "int64", "float16"]
+DTYPES += ["float32", "float64", "complex64"]
+
+
+def _frame_bytes(arrays):
+    return b"".join(iter(encode_frame(arrays).read, b""))
+
+
+def _assert_equal(decoded, arrays):
+    assert len(decoded) == len(arrays)
+    for result, array in zip(decoded, arrays):
+        assert result.shape == array.shape
+        assert result.dtype == array.dtype.newbyteorder("<")
+        np.testing.assert_array_equal(result, array)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_frame_round_trips_every_dtype(dtype):
+    array = (np.arange(24) % 7).astype(dtype).reshape(2, 3, 4)
+    _assert_equal(decode_frame(_frame_bytes([array])), [array])
+
+
+def test_frame_round_trips_mixed_shapes_and_empty_arrays():
+    arrays = [
+        np.float32(1.5).reshape(()),
+        np.arange(5, dtype="int64"),
+        np.ones((3, 0, 2), dtype="float32"),
+        np.zeros(0, dtype="uint8"),
+        np.arange(6, dtype="float64").reshape(2, 3).T,
+    ]
+    frame = _frame_bytes(arrays)
+    _assert_equal(decode_frame(frame), arrays)
+    assert len(frame) % FRAME_ALIGNMENT == 0
+
+
+def test_frame_of_no_arrays():
+    assert decode_frame(_frame_bytes([])) == []
+
+
+def test_big_endian_arrays_are_sent_little_endian():
+    array = np.arange(4, dtype=">i4")
+    converted = little_endian(array)
+    assert converted.dtype == np.dtype("<i4")
+    np.testing.assert_array_equal(converted, array)
+    frame = _frame_bytes([array])
+    assert struct.pack("<4i", 0, 1, 2, 3) in frame
+    _assert_equal(decode_frame(frame), [array])
+
+
+def test_little_endian_contiguous_arrays_are_not_copied():
+    array = np.arange(4, dtype="<f4")
+    assert little_endian(array) is array
+
+
+def test_frame_reader_reports_its_length_and_seeks():
+    arrays = [np.arange(10, dtype="float32"), np.arange(3, dtype="int8")]
+    reader = encode_frame(arrays)
+    frame = _frame_bytes(arrays)
+    assert len(reader) == len(frame)
+    assert reader.seek(0, io.SEEK_END) == len(frame)
+    assert reader.read() == b""
+    reader.seek(5)
+    assert reader.tell() == 5
+    assert b"".join(iter(reader.read, b"")) == frame[5:]
+
+
+@pytest.mark.parametrize("cut", [3, 6, 20, -100])
+def test_truncated_frames_raise(cut):
+    frame = _frame_bytes([np.arange(100, dtype="float32")])
+    with pytest.raises(EncodingException):
+        decode_frame(frame[:cut])
+
+
+def _with_header(header, data=b""):
+    raw = json.dumps(header).encode("utf-8")
+    return FRAME_MAGIC + struct.pack("<I", len(raw)) + raw + data
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        b"NOPE" + b"\x00" * 60,
+        FRAME_MAGIC + struct.pack("<I", 4) + b"{{{{",
+        _with_header({"arrays": []}),
+        _with_header({"tensors": [{"dtype": "float32"}]}),
+        _with_header(
+            {"tensors": [{"dtype": "float32", "shape": [4], "offset": 0, "nbytes": 8}]}
+        ),
+        _with_header(
+            {"tensors": [{"dtype": "O", "shape": [1], "offset": 0, "nbytes": 8}]}
+        ),
+        _with_header(
+            {"tensors": [{"dtype": "int8", "shape": [2], "offset": -64, "nbytes": 2}]},
+            b"\x00" * 64,
+        ),
+    ],
+)
+def test_corrupt_frames_raise(frame):
+    with pytest.raises(EncodingException):
+        decode_frame(frame)
+
+
+def test_object_arrays_are_rejected():
+    with pytest.raises(EncodingException):
+        encode_frame([np.array(["a", None], dtype=object)])
+
+
+def test_base64_round_trip():
+    array = np.arange(12, dtype=">f8").reshape(3, 4)
+    encoded = json.loads(json.dumps(encode_base64(array)))
+    assert encoded["dtype"] == "<f8"
+    _assert_equal([decode_base64(encoded)], [array])
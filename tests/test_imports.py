@@ -0,0 +1,42 @@
+"""
+Tests that importing easytensor and its framework helpers doesn't load any
+machine learning framework. Each import runs in a fresh interpreter.
+"""
+import sys
+import json
+import subprocess
+import pytest
+from conftest import ROOT
+
+FRAMEWORKS = ("torch", "tensorflow", "transformers")
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "easytensor",
+        "easytensor.tensorflow",
+        "easytensor.pytorch",
+        "easytensor.transformers",
+        "easytensor.serving",
+    ],
+)
+def test_import_loads_no_framework(module):
+    code = "import sys, json; import {}; print(json.dumps(sorted(sys.modules)))"
+    output = subprocess.run(
+        [sys.executable, "-c", code.format(module)],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+    ).stdout
+    loaded = set(json.loads(output))
+    assert not loaded & set(FRAMEWORKS)
+
+
+def test_framework_subpackages_load_on_first_access():
+    code = (
+        "import sys, easytensor; assert 'easytensor.pytorch' not in sys.modules; "
+        "easytensor.pytorch; assert 'easytensor.pytorch' in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT)
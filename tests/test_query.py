@@ -0,0 +1,119 @@
+"""
+Tests for the micro-batching and streaming of easytensor.query.QueryClient
+against the fake API server.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from easytensor import query
+from easytensor.query import QueryClient
+
+
+def test_concurrent_predictions_are_merged(server):
+    count = 20
+    with QueryClient("token", max_wait=0.05) as client:
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            predictions = list(
+                executor.map(lambda value: client.predict([value, 1]), range(count))
+            )
+    assert predictions == [[value + 1] for value in range(count)]
+    assert server.state.requests["/query/"] < count
+    assert sum(server.state.query_sizes) == count
+
+
+def test_batches_hold_at_most_max_batch_size_instances(server):
+    with QueryClient("token", max_batch_size=4, max_wait=0.2) as client:
+        futures = [client.submit([value]) for value in range(10)]
+        assert [future.result() for future in futures] == [[v] for v in range(10)]
+    assert server.state.query_sizes == [4, 4, 2]
+
+
+def test_batch_is_sent_after_max_wait(server):
+    with QueryClient("token", max_wait=0.2) as client:
+        start = time.perf_counter()
+        assert client.predict([1, 2]) == [3]
+        elapsed = time.perf_counter() - start
+    assert 0.2 <= elapsed < 1
+    assert server.state.query_sizes == [1]
+
+
+def test_failed_batch_fails_only_its_callers(server):
+    server.state.fail_queries.append(500)
+    with QueryClient("token", max_batch_size=2, max_wait=1) as client:
+        futures = [client.submit([value]) for value in range(4)]
+        failed = [future for future in futures if future.exception() is not None]
+        assert failed in (futures[:2], futures[2:])
+        for future in failed:
+            with pytest.raises(requests.HTTPError):
+                future.result()
+        succeeded = [future.result() for future in futures if future not in failed]
+    assert len(succeeded) == 2
+    assert server.state.requests["/query/"] == 2
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    """ Retries batches right away. """
+    monkeypatch.setattr(query, "BATCH_RETRY_BACKOFF", 0)
+
+
+def test_stream_keeps_order_and_caps_batches_in_flight(server):
+    batch_size, max_in_flight = 3, 2
+    pulled = [0]
+    active = [0, 0]
+    lock = threading.Lock()
+
+    def _instances():
+        for value in range(50):
+            pulled[0] += 1
+            yield [value]
+
+    with QueryClient("token") as client:
+        predict_batch = client._predict_batch
+
+        def _slow_batch(instances, retry):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            try:
+                return predict_batch(instances, retry)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+        client._predict_batch = _slow_batch
+        predictions = []
+        for prediction in client.predict_stream(
+            _instances(), batch_size=batch_size, max_in_flight=max_in_flight
+        ):
+            assert pulled[0] - len(predictions) <= batch_size * max_in_flight
+            predictions.append(prediction)
+    assert predictions == [[value] for value in range(50)]
+    assert active[1] == max_in_flight
+    assert server.state.query_sizes.count(batch_size) == 16
+
+
+def test_stream_sends_a_failing_batch_once_per_retry(server, no_backoff):
+    server.state.fail_queries.extend([503] * 20)
+    with QueryClient("token") as client:
+        with pytest.raises(requests.HTTPError):
+            list(client.predict_stream([[1]], max_retries=2))
+    assert server.state.requests["/query/"] == 3
+
+
+def test_stream_retries_a_failed_batch(server, no_backoff):
+    server.state.fail_queries.extend([503, 429])
+    with QueryClient("token") as client:
+        assert list(client.predict_stream([[1], [2]])) == [[1], [2]]
+    assert server.state.requests["/query/"] == 3
+
+
+def test_stream_does_not_retry_client_errors(server, no_backoff):
+    server.state.fail_queries.append(400)
+    with QueryClient("token") as client:
+        with pytest.raises(requests.HTTPError):
+            list(client.predict_stream([[1]]))
+    assert server.state.requests["/query/"] == 1
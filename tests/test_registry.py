@@ -0,0 +1,116 @@
+"""
+Tests for the local model registry of easytensor.registry.
+"""
+import sys
+import subprocess
+import pytest
+from conftest import ROOT
+from easytensor import upload
+from easytensor.registry import ModelRegistry, get_registry
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(path=str(tmp_path / "registry.json"))
+
+
+def _record(registry, model_id, name, content_hash=None):
+    registry.record_model(model_id, name, "address-" + model_id, 10, "tf", content_hash)
+
+
+def _ids(models):
+    return [model["model_id"] for model in models]
+
+
+def test_find_by_name_hash_or_both(registry):
+    _record(registry, "1", "model", "hash-a")
+    _record(registry, "2", "model", "hash-b")
+    _record(registry, "3", "other", "hash-a")
+    _record(registry, "4", "model")
+    assert _ids(registry.find(name="model")) == ["4", "2", "1"]
+    assert _ids(registry.find(content_hash="hash-a")) == ["3", "1"]
+    assert _ids(registry.find(name="model", content_hash="hash-a")) == ["1"]
+    assert _ids(registry.find(name="other", content_hash="hash-b")) == []
+    assert _ids(registry.find(name="missing")) == []
+    assert _ids(registry.find()) == ["4", "3", "2", "1"]
+    model = registry.get("2")
+    assert model["address"] == "address-2"
+    assert model["content_hash"] == "hash-b"
+    assert model["query_token"] is None
+
+
+def test_latest_is_the_last_registration(registry):
+    _record(registry, "1", "model")
+    _record(registry, "2", "model")
+    assert registry.latest("model")["model_id"] == "2"
+    # registering a model again makes it the latest.
+    _record(registry, "1", "model")
+    assert registry.latest("model")["model_id"] == "1"
+    assert registry.latest("missing") is None
+
+
+def test_oldest_registrations_are_trimmed(tmp_path):
+    registry = ModelRegistry(path=str(tmp_path / "registry.json"), max_entries=3)
+    for index in range(5):
+        _record(registry, str(index), "model")
+    assert _ids(registry.find()) == ["4", "3", "2"]
+    assert registry.get("0") is None
+    reloaded = ModelRegistry(path=registry.path, max_entries=3)
+    assert len(reloaded) == 3
+
+
+def test_tokens_of_unknown_models_are_cached_apart(registry):
+    registry.record_tokens({"unknown": "token-1"})
+    assert registry.query_token("unknown") == "token-1"
+    assert registry.get("unknown") is None
+    assert len(registry) == 0
+    _record(registry, "unknown", "model")
+    assert registry.get("unknown")["query_token"] == "token-1"
+    registry.forget("unknown")
+    assert registry.query_token("unknown") is None
+    assert len(registry) == 0
+
+
+def test_unreadable_registry_is_empty(registry):
+    with open(registry.path, "w") as fout:
+        fout.write("{broken")
+    assert len(registry) == 0
+    _record(registry, "1", "model")
+    assert _ids(registry.find()) == ["1"]
+
+
+_OTHER_PROCESS = """
+import sys
+sys.path.insert(0, {root!r})
+from easytensor.registry import ModelRegistry
+registry = ModelRegistry(path={path!r})
+registry.record_model("2", "model", "address-2", 10, "tf")
+registry.record_tokens({{"2": "token-2"}})
+"""
+
+
+def test_writes_of_other_processes_are_picked_up(registry):
+    _record(registry, "1", "model")
+    assert registry.latest("model")["model_id"] == "1"
+    subprocess.run(
+        [sys.executable, "-c", _OTHER_PROCESS.format(root=ROOT, path=registry.path)],
+        check=True,
+    )
+    latest = registry.latest("model")
+    assert latest["model_id"] == "2"
+    assert latest["query_token"] == "token-2"
+    assert _ids(registry.find()) == ["2", "1"]
+
+
+def test_create_query_tokens_records_its_tokens(server):
+    tokens = upload.create_query_tokens(["registry-1", "registry-2"])
+    assert sorted(tokens) == ["registry-1", "registry-2"]
+    for model_id, token in tokens.items():
+        assert get_registry().query_token(model_id) == token
+    # the recorded tokens are reused instead of minted again.
+    server.state.reset()
+    assert upload.create_query_tokens(["registry-2", "registry-1"]) == {
+        "registry-2": tokens["registry-2"],
+        "registry-1": tokens["registry-1"],
+    }
+    assert server.state.requests["/v1/query-access-token/"] == 0
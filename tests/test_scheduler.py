@@ -0,0 +1,153 @@
+"""
+Tests for easytensor.scheduler: the token bucket's rate, the order slots are
+handed out in and the adaptation of the concurrency limit.
+"""
+import time
+import threading
+import pytest
+from easytensor.constants import Priority
+from easytensor.scheduler import TokenBucket, TransferScheduler
+
+
+def test_token_bucket_paces_to_rate():
+    bucket = TokenBucket(rate=1024 * 1024, capacity=64 * 1024)
+    start = time.monotonic()
+    # the burst is free, the next 512 KiB take half a second.
+    bucket.consume(64 * 1024)
+    for _ in range(8):
+        bucket.consume(64 * 1024)
+    elapsed = time.monotonic() - start
+    assert 0.45 <= elapsed < 0.8
+
+
+def test_token_bucket_rejects_bad_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def _start(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+def test_slots_go_to_urgent_transfers_first():
+    scheduler = TransferScheduler(
+        initial_concurrency=1, min_concurrency=1, max_concurrency=1
+    )
+    release = threading.Event()
+    order = []
+
+    def hold():
+        with scheduler.transfer(Priority.NORMAL):
+            release.wait()
+
+    def queue(priority):
+        with scheduler.transfer(priority):
+            order.append(priority)
+
+    threads = [_start(hold)]
+    _wait_for(lambda: scheduler.stats()["active"] == 1)
+    for priority in (Priority.LOW, Priority.NORMAL, Priority.HIGH):
+        threads.append(_start(lambda priority=priority: queue(priority)))
+        _wait_for(lambda count=len(threads) - 1: scheduler.stats()["waiting"] == count)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+    assert order == [Priority.HIGH, Priority.NORMAL, Priority.LOW]
+
+
+def test_yielding_transfer_gives_up_its_slot():
+    scheduler = TransferScheduler(
+        rate_limit=1024 * 1024 * 1024,
+        initial_concurrency=2,
+        min_concurrency=1,
+        max_concurrency=2,
+    )
+    release = threading.Event()
+    low_sent = threading.Event()
+
+    def urgent():
+        with scheduler.transfer(Priority.HIGH):
+            release.wait()
+
+    def bulk():
+        with scheduler.transfer(Priority.LOW) as transfer:
+            transfer.throttle(1024)
+            low_sent.set()
+
+    threads = [_start(urgent)]
+    _wait_for(lambda: scheduler.stats()["active"] == 1)
+    threads.append(_start(bulk))
+    # the paused LOW transfer frees its slot for the second HIGH transfer.
+    _wait_for(lambda: scheduler.stats()["active"] == 1 and threads[1].is_alive())
+    acquired = threading.Event()
+
+    def second_urgent():
+        with scheduler.transfer(Priority.HIGH):
+            acquired.set()
+
+    threads.append(_start(second_urgent))
+    assert acquired.wait(2)
+    assert not low_sent.is_set()
+    release.set()
+    assert low_sent.wait(2)
+    for thread in threads:
+        thread.join(2)
+    assert scheduler.stats()["active"] == 0
+
+
+def _adapt(scheduler, rate):
+    with scheduler._cond:
+        scheduler._adapt(rate)
+        scheduler._last_rate = rate
+    return scheduler.limit
+
+
+def test_concurrency_keeps_climbing_while_throughput_improves():
+    scheduler = TransferScheduler(
+        initial_concurrency=4, min_concurrency=1, max_concurrency=8
+    )
+    assert _adapt(scheduler, 100.0) == 5
+    assert _adapt(scheduler, 120.0) == 6
+    # throughput dropped: turn around.
+    assert _adapt(scheduler, 90.0) == 5
+    # no significant change: stay.
+    assert _adapt(scheduler, 91.0) == 5
+
+
+def test_concurrency_halves_on_errors_within_bounds():
+    scheduler = TransferScheduler(
+        initial_concurrency=8, min_concurrency=2, max_concurrency=8
+    )
+    scheduler._record_error()
+    assert scheduler.limit == 4
+    scheduler._record_error()
+    scheduler._record_error()
+    assert scheduler.limit == 2
+    assert scheduler.stats()["errors"] == 3
+
+
+def test_concurrency_only_adapts_in_saturated_windows(monkeypatch):
+    scheduler = TransferScheduler(
+        initial_concurrency=4, min_concurrency=1, max_concurrency=8
+    )
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    scheduler._reset_window()
+    clock[0] += 5
+    scheduler._record(1000)
+    assert scheduler.limit == 4
+    # a saturated window with a better throughput raises the limit.
+    scheduler._window_saturated = True
+    clock[0] += 5
+    scheduler._record(2000)
+    assert scheduler.limit == 5
@@ -0,0 +1,142 @@
+"""
+Tests for the parts of easytensor.serving that don't need a framework:
+unpacking archives, detecting their framework, latency stats and reading
+sample instances.
+"""
+import io
+import os
+import json
+import tarfile
+import pytest
+from easytensor.constants import Framework
+from easytensor.serving import (
+    ServingException,
+    detect_framework,
+    extract_archive,
+    latency_stats,
+    load_model_class,
+    read_instances,
+)
+
+
+def _add_file(tar, name, content=b"content"):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    tar.addfile(info, io.BytesIO(content))
+
+
+def _add_link(tar, name, target, kind=tarfile.SYMTYPE):
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.linkname = target
+    tar.addfile(info)
+
+
+def test_extract_skips_links_and_paths_leaving_the_directory(tmp_path):
+    location = tmp_path / "archive.tar.gz"
+    with tarfile.open(location, "w:gz") as tar:
+        _add_file(tar, "model.py", b"class Model: pass\n")
+        _add_file(tar, "model_weights/config.json", b"{}")
+        _add_file(tar, "../escaped.txt")
+        _add_file(tar, "model_weights/../../escaped_too.txt")
+        _add_file(tar, str(tmp_path / "absolute.txt"))
+        _add_link(tar, "passwd", "/etc/passwd")
+        _add_link(tar, "hardlink", "model.py", tarfile.LNKTYPE)
+    directory = tmp_path / "unpacked"
+    directory.mkdir()
+    assert extract_archive(str(location), str(directory)) == str(directory)
+    assert sorted(os.listdir(directory)) == ["model.py", "model_weights"]
+    assert os.listdir(directory / "model_weights") == ["config.json"]
+    assert sorted(os.listdir(tmp_path)) == ["archive.tar.gz", "unpacked"]
+
+
+def test_extract_uncompressed_archive_to_a_temporary_directory(tmp_path):
+    location = tmp_path / "archive.tar"
+    with tarfile.open(location, "w") as tar:
+        _add_file(tar, "saved_model.pb", b"graph")
+    directory = extract_archive(str(location))
+    try:
+        assert os.listdir(directory) == ["saved_model.pb"]
+        assert detect_framework(directory) == Framework.TENSORFLOW
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+@pytest.mark.parametrize(
+    "files, framework",
+    [
+        (["model.py", "model.safetensors"], Framework.PYTORCH),
+        (["model.py", "model.pt"], Framework.PYTORCH),
+        (["model.py", "model_weights/config.json"], Framework.TRANSFORMERS),
+        (["saved_model.pb"], Framework.TENSORFLOW),
+    ],
+)
+def test_detect_framework(tmp_path, files, framework):
+    for name in files:
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"")
+    assert detect_framework(str(tmp_path)) == framework
+
+
+def test_detect_framework_rejects_other_directories(tmp_path):
+    (tmp_path / "model.py").write_bytes(b"")
+    with pytest.raises(ServingException):
+        detect_framework(str(tmp_path))
+
+
+def test_load_model_class_imports_next_to_the_model_file(tmp_path):
+    (tmp_path / "helpers.py").write_text("SCALE = 3\n")
+    (tmp_path / "model.py").write_text(
+        "from helpers import SCALE\n\n\n"
+        "class Model:\n"
+        "    def predict_single(self, instance):\n"
+        "        return instance * SCALE\n"
+    )
+    model_class = load_model_class(str(tmp_path / "model.py"))
+    assert model_class().predict_single(2) == 6
+
+
+def test_load_model_class_needs_exactly_one_class(tmp_path):
+    (tmp_path / "model.py").write_text("class A: pass\n\n\nclass B: pass\n")
+    with pytest.raises(ServingException):
+        load_model_class(str(tmp_path / "model.py"))
+
+
+def test_latency_stats_percentiles():
+    durations = [index / 100 for index in range(100, 0, -1)]
+    stats = latency_stats(durations, 200)
+    assert stats["calls"] == 100
+    assert stats["instances"] == 200
+    assert stats["p50_s"] == 0.5
+    assert stats["p90_s"] == 0.9
+    assert stats["p99_s"] == 0.99
+    assert stats["max_s"] == 1.0
+    assert stats["mean_s"] == pytest.approx(0.505)
+    assert stats["instances_per_s"] == pytest.approx(200 / 50.5)
+
+
+def test_latency_stats_of_few_calls():
+    assert latency_stats([0.2], 1)["p99_s"] == 0.2
+    assert latency_stats([0.1, 0.3], 2)["p50_s"] == 0.1
+    assert latency_stats([], 0) == {"calls": 0, "instances": 0}
+
+
+def test_read_instances_from_json(tmp_path):
+    path = tmp_path / "samples.json"
+    path.write_text(json.dumps([[1, 2], {"text": "hi"}, "plain"]))
+    assert read_instances(str(path)) == [[1, 2], {"text": "hi"}, "plain"]
+
+
+def test_read_instances_from_json_lines(tmp_path):
+    path = tmp_path / "samples.jsonl"
+    path.write_text('[1, 2]\n\n{"text": "hi"}\n"plain"\n')
+    assert read_instances(str(path)) == [[1, 2], {"text": "hi"}, "plain"]
+
+
+def test_read_a_single_json_instance(tmp_path):
+    path = tmp_path / "sample.json"
+    path.write_text('{"text": "hi"}')
+    assert read_instances(str(path)) == [{"text": "hi"}]
@@ -0,0 +1,87 @@
+"""
+Tests for uploading sharded checkpoints with easytensor.shards against the
+fake API server.
+"""
+import os
+import json
+import pytest
+from easytensor.shards import MANIFEST_NAME, checkpoint_shards, sharded_members
+from easytensor.transformers.upload import upload_sharded_checkpoint
+
+SHARDS = ["pytorch_model-00001-of-00002.bin", "pytorch_model-00002-of-00002.bin"]
+LOOKUP = "/v1/model-uploads/lookup/"
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    """ A fake checkpoint of two shards listed in an index, and a model.py. """
+    directory = tmp_path / "model_weights"
+    directory.mkdir()
+    (directory / "config.json").write_text(json.dumps({"model_type": "fake"}))
+    index = {
+        "metadata": {"total_size": 3 * 1024},
+        "weight_map": {
+            "embeddings.weight": SHARDS[0],
+            "encoder.weight": SHARDS[1],
+            "decoder.weight": SHARDS[0],
+        },
+    }
+    (directory / "pytorch_model.bin.index.json").write_text(json.dumps(index))
+    for size, name in zip((2048, 1024), SHARDS):
+        (directory / name).write_bytes(os.urandom(size))
+    model_file = tmp_path / "model.py"
+    model_file.write_text("class Model:\n    pass\n")
+    return str(directory), str(model_file)
+
+
+def test_checkpoint_shards_come_from_the_index(checkpoint):
+    directory, _ = checkpoint
+    assert checkpoint_shards(directory) == SHARDS
+
+
+def test_checkpoint_without_index_has_its_weights_file(tmp_path):
+    (tmp_path / "model.safetensors").write_bytes(b"weights")
+    (tmp_path / "config.json").write_text("{}")
+    assert checkpoint_shards(str(tmp_path)) == ["model.safetensors"]
+
+
+def test_archive_holds_everything_but_the_shards(checkpoint, tmp_path):
+    directory, _ = checkpoint
+    manifest = {"version": 1, "shards": []}
+    members = sharded_members(
+        directory, SHARDS, manifest, "model_weights", str(tmp_path / MANIFEST_NAME)
+    )
+    assert [arcname for _, arcname in members] == [
+        "model_weights/config.json",
+        "model_weights/pytorch_model.bin.index.json",
+        "model_weights/" + MANIFEST_NAME,
+    ]
+    with open(str(tmp_path / MANIFEST_NAME)) as fin:
+        assert json.load(fin) == manifest
+
+
+def test_unchanged_shards_are_skipped(server, checkpoint):
+    directory, model_file = checkpoint
+    address, size, metadata = upload_sharded_checkpoint(directory, model_file)
+    assert address
+    assert metadata == {"shards": 2, "skipped_shards": 0, "shard_bytes": 3072}
+    assert size > 3072
+    # both shards, then the archive.
+    assert server.state.requests["sink"] == 3
+    with open(os.path.join(os.path.dirname(model_file), MANIFEST_NAME)) as fin:
+        manifest = json.load(fin)
+    assert manifest["version"] == 1
+    assert [shard["path"] for shard in manifest["shards"]] == SHARDS
+    assert [shard["size"] for shard in manifest["shards"]] == [2048, 1024]
+    first_addresses = [shard["address"] for shard in manifest["shards"]]
+    assert all(first_addresses)
+
+    server.state.reset()
+    _, _, metadata = upload_sharded_checkpoint(directory, model_file)
+    assert metadata["skipped_shards"] == 2
+    assert server.state.requests[LOOKUP] >= 2
+    # only the archive itself is uploaded again, if it changed.
+    assert server.state.requests["sink"] <= 1
+    with open(os.path.join(os.path.dirname(model_file), MANIFEST_NAME)) as fin:
+        manifest = json.load(fin)
+    assert [shard["address"] for shard in manifest["shards"]] == first_addresses
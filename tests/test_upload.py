@@ -0,0 +1,196 @@
+"""
+Tests for easytensor.upload against the fake API server: single and
+multipart uploads, part retries and resuming interrupted uploads.
+"""
+import os
+import time
+import shutil
+import pytest
+from easytensor import journal, tracing, upload
+from easytensor.archive import archive_digest
+from easytensor.client import get_client
+from easytensor.member_cache import _CACHE_DIR
+from easytensor.tensorflow import upload_model
+
+CHUNK = 64 * 1024
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    """ Retries parts right away. """
+    monkeypatch.setattr(upload, "MULTIPART_RETRY_BACKOFF", 0)
+
+
+def test_single_upload(server, archive):
+    location = archive(CHUNK + 1)
+    address, size = upload.upload_archive(location, dedup=False)
+    assert size == CHUNK + 1
+    assert address
+    assert server.state.requests["sink"] == 1
+    assert server.state.bytes_received >= size
+
+
+@pytest.mark.parametrize("multipart", [False, True])
+def test_transfer_rate_excludes_the_work_around_the_transfer(
+    server, archive, monkeypatch, multipart
+):
+    location = archive(3 * CHUNK)
+    digest = upload.archive_digest
+
+    def _slow_digest(filename):
+        time.sleep(0.2)
+        return digest(filename)
+
+    monkeypatch.setattr(upload, "archive_digest", _slow_digest)
+    recorder = tracing.add_sink(tracing.MetricsRecorder())
+    try:
+        upload.upload_archive(location, multipart=multipart, chunk_size=CHUNK)
+    finally:
+        tracing.remove_sink(recorder)
+    (span,) = [s for s in recorder.spans if s.name == "easytensor.upload_archive"]
+    attributes = span.attributes
+    assert attributes["transfer_seconds"] < span.duration - 0.2
+    assert attributes["bytes_per_second"] == pytest.approx(
+        3 * CHUNK / attributes["transfer_seconds"]
+    )
+
+
+def test_multipart_upload_sends_every_part(server, archive):
+    location = archive(5 * CHUNK + 1)
+    address, size = upload.upload_archive(
+        location, multipart=True, chunk_size=CHUNK, resume=False, dedup=False
+    )
+    assert address
+    assert size == 5 * CHUNK + 1
+    assert dict(server.state.part_uploads) == {number: 1 for number in range(1, 7)}
+    assert server.state.requests["complete"] == 1
+
+
+def test_failed_part_is_retried(server, archive):
+    location = archive(3 * CHUNK)
+    server.state.fail_parts[2] = 2
+    upload.upload_archive(
+        location, multipart=True, chunk_size=CHUNK, resume=False, dedup=False
+    )
+    assert server.state.part_uploads[2] == 3
+    assert server.state.part_uploads[1] == 1
+    assert server.state.requests["complete"] == 1
+
+
+def test_part_failing_past_its_retries_fails_the_upload(server, archive):
+    location = archive(3 * CHUNK)
+    server.state.fail_parts[2] = 10
+    with pytest.raises(upload.UploadException):
+        upload.upload_archive(
+            location,
+            multipart=True,
+            chunk_size=CHUNK,
+            max_retries=2,
+            resume=False,
+            dedup=False,
+        )
+    assert server.state.part_uploads[2] == 3
+    assert server.state.requests["complete"] == 0
+
+
+def test_failed_part_cancels_the_pending_parts(server, archive):
+    location = archive(8 * CHUNK)
+    server.state.fail_parts[1] = 10
+    with pytest.raises(upload.UploadException):
+        upload.upload_archive(
+            location,
+            multipart=True,
+            chunk_size=CHUNK,
+            max_workers=1,
+            max_retries=1,
+            resume=False,
+            dedup=False,
+        )
+    # the worker may pick up the next part before the others are cancelled.
+    assert server.state.part_uploads[1] == 2
+    assert set(server.state.part_uploads) <= {1, 2}
+
+
+def test_missing_part_urls_fail_the_upload(server, archive, monkeypatch):
+    get_upload_url = upload.get_upload_url
+
+    def _missing_part(*args, **kwargs):
+        res = get_upload_url(*args, **kwargs)
+        res["parts"] = res["parts"][:-1]
+        return res
+
+    monkeypatch.setattr(upload, "get_upload_url", _missing_part)
+    location = archive(3 * CHUNK)
+    with pytest.raises(upload.UploadException):
+        upload.upload_archive(
+            location, multipart=True, chunk_size=CHUNK, resume=False, dedup=False
+        )
+    assert server.state.requests["sink"] == 0
+
+
+@pytest.mark.parametrize(
+    "parts, upload_id, retry",
+    [(None, None, True), (3, None, False), (3, "upload-1", True)],
+)
+def test_only_side_effect_free_upload_url_requests_are_retried(
+    server, monkeypatch, parts, upload_id, retry
+):
+    client = get_client()
+    request = client.request
+    retries = []
+
+    def _request(method, url, retry=None, **kwargs):
+        if url == upload.UPLOAD_URL_REQUEST_URL:
+            retries.append(retry)
+        return request(method, url, retry=retry, **kwargs)
+
+    monkeypatch.setattr(client, "request", _request)
+    upload.get_upload_url("address", parts=parts, upload_id=upload_id)
+    assert retries == [retry]
+
+
+def test_interrupted_upload_resumes_missing_parts(server, archive):
+    location = archive(6 * CHUNK)
+    content_hash = archive_digest(location)
+    server.state.fail_parts[3] = 10
+    with pytest.raises(upload.UploadException):
+        upload.upload_archive(
+            location,
+            multipart=True,
+            chunk_size=CHUNK,
+            max_workers=1,
+            max_retries=1,
+        )
+    entry = journal.get_entry(content_hash)
+    committed = set(journal.committed_parts(entry))
+    assert {1, 2} <= committed
+    assert 3 not in committed
+
+    server.state.reset()
+    address, _ = upload.upload_archive(
+        location, multipart=True, chunk_size=CHUNK, max_workers=1
+    )
+    assert address == entry["address"]
+    assert set(server.state.part_uploads) == set(range(1, 7)) - committed
+    assert server.state.requests["complete"] == 1
+    # the finished upload leaves the journal.
+    assert journal.get_entry(content_hash) is None
+
+
+def test_uploaded_content_is_deduplicated(server, archive):
+    location = archive(CHUNK)
+    first, _ = upload.upload_archive(location)
+    server.state.reset()
+    second, _ = upload.upload_archive(location)
+    assert second == first
+    assert server.state.requests["sink"] == 0
+
+
+def test_tensorflow_upload_leaves_no_member_cache(server, tmp_path):
+    saved_model = tmp_path / "saved_model"
+    saved_model.mkdir()
+    (saved_model / "saved_model.pb").write_bytes(b"graph")
+    shutil.rmtree(_CACHE_DIR, ignore_errors=True)
+    model_id, _ = upload_model("tf model", str(saved_model))
+    assert model_id
+    assert not os.path.exists(_CACHE_DIR)
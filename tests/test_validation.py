@@ -0,0 +1,62 @@
+"""
+Tests for the memoized model file checks of easytensor.validation.
+"""
+import hashlib
+import collections
+import pytest
+from easytensor import validation
+from easytensor.validation import BadModelFile, check_model_class_definition_file
+
+VALID = "class Model:\n    def predict_single(self, instance):\n        return {}\n"
+
+
+def _model_file(tmp_path, source, name="model.py"):
+    path = tmp_path / name
+    path.write_text(source)
+    return str(path)
+
+
+def test_invalid_files_are_rejected(tmp_path):
+    with pytest.raises(BadModelFile):
+        check_model_class_definition_file(_model_file(tmp_path, "import missing\nx ="))
+    with pytest.raises(BadModelFile):
+        check_model_class_definition_file(_model_file(tmp_path, "x = 1\n"))
+    with pytest.raises(BadModelFile):
+        check_model_class_definition_file(
+            _model_file(tmp_path, "class A: pass\n\n\nclass B: pass\n")
+        )
+    with pytest.raises(BadModelFile):
+        check_model_class_definition_file(_model_file(tmp_path, VALID, "model.txt"))
+
+
+def test_results_are_memoized_by_content(tmp_path, monkeypatch):
+    calls = []
+    validate_source = validation._validate_source
+
+    def _counting(source, filename):
+        calls.append(filename)
+        return validate_source(source, filename)
+
+    monkeypatch.setattr(validation, "_validate_source", _counting)
+    source = VALID.format("'memoized'")
+    check_model_class_definition_file(_model_file(tmp_path, source, "first.py"))
+    check_model_class_definition_file(_model_file(tmp_path, source, "second.py"))
+    assert len(calls) == 1
+
+
+def test_remembered_results_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(validation, "RESULTS_MAX_ENTRIES", 2)
+    monkeypatch.setattr(validation, "_RESULTS", collections.OrderedDict())
+    sources = [VALID.format(index) for index in range(3)]
+    digests = [hashlib.sha256(source.encode()).hexdigest() for source in sources]
+    locations = [
+        _model_file(tmp_path, source, "model_{}.py".format(index))
+        for index, source in enumerate(sources)
+    ]
+    for location in locations:
+        check_model_class_definition_file(location)
+    assert list(validation._RESULTS) == digests[1:]
+    # a hit makes the result the most recently used one.
+    check_model_class_definition_file(locations[1])
+    check_model_class_definition_file(locations[0])
+    assert list(validation._RESULTS) == [digests[1], digests[0]]
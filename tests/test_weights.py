@@ -0,0 +1,98 @@
+"""
+Tests for the streamed safetensors export of easytensor.pytorch.weights.
+"""
+import json
+import struct
+import pytest
+from easytensor.constants import Precision
+
+torch = pytest.importorskip("torch")
+
+# pylint: disable=wrong-import-position
+from easytensor.pytorch.weights import (
+    SAFETENSORS_ALIGNMENT,
+    SafetensorsFile,
+    load_safetensors,
+)
+
+
+def _state_dict():
+    torch.manual_seed(0)
+    return {
+        "linear.weight": torch.randn(4, 3),
+        "linear.bias": torch.randn(4),
+        "transposed": torch.randn(3, 5).t(),
+        "steps": torch.tensor(7, dtype=torch.int64),
+        "mask": torch.tensor([True, False, True]),
+        "half": torch.randn(2, 2).to(torch.bfloat16),
+        "empty": torch.zeros(0, 3),
+    }
+
+
+def _write(weights, path):
+    written = 0
+    with open(path, "wb") as fout:
+        for chunk in weights.chunks():
+            written += fout.write(chunk)
+    return written
+
+
+def test_streamed_file_parses_back(tmp_path):
+    state_dict = _state_dict()
+    weights = SafetensorsFile(state_dict, {"format": "pt"})
+    path = tmp_path / "model.safetensors"
+    assert _write(weights, path) == weights.size == path.stat().st_size
+
+    tensors, metadata = load_safetensors(str(path))
+    assert metadata == {"format": "pt"}
+    assert list(tensors) == list(state_dict)
+    for name, tensor in state_dict.items():
+        assert tensors[name].dtype == tensor.dtype
+        assert torch.equal(tensors[name], tensor)
+
+
+def test_header_layout(tmp_path):
+    weights = SafetensorsFile(_state_dict())
+    path = tmp_path / "model.safetensors"
+    _write(weights, path)
+    data = path.read_bytes()
+    (header_size,) = struct.unpack("<Q", data[:8])
+    assert header_size % SAFETENSORS_ALIGNMENT == 0
+    header = json.loads(data[8 : 8 + header_size])
+    assert "__metadata__" not in header
+    offset = 0
+    for info in header.values():
+        start, end = info["data_offsets"]
+        assert start == offset
+        offset = end
+    assert 8 + header_size + offset == len(data) == weights.size
+    assert header["linear.weight"] == {
+        "dtype": "F32",
+        "shape": [4, 3],
+        "data_offsets": [0, 48],
+    }
+
+
+def test_precision_converts_floating_point_tensors(tmp_path):
+    state_dict = _state_dict()
+    weights = SafetensorsFile(state_dict, precision=Precision.FLOAT16)
+    path = tmp_path / "model.safetensors"
+    assert _write(weights, path) == weights.size
+    tensors, metadata = load_safetensors(str(path))
+    assert metadata == {"precision": Precision.FLOAT16.value}
+    assert tensors["linear.weight"].dtype == torch.float16
+    assert tensors["steps"].dtype == torch.int64
+    assert torch.allclose(
+        tensors["linear.weight"].float(), state_dict["linear.weight"], atol=1e-2
+    )
+    assert weights.report()["weights_bytes"] < weights.source_bytes
+
+
+def test_safetensors_reads_the_streamed_file(tmp_path):
+    safetensors_torch = pytest.importorskip("safetensors.torch")
+    state_dict = _state_dict()
+    path = tmp_path / "model.safetensors"
+    _write(SafetensorsFile(state_dict, {"format": "pt"}), path)
+    loaded = safetensors_torch.load_file(str(path))
+    for name, tensor in state_dict.items():
+        assert torch.equal(loaded[name], tensor)